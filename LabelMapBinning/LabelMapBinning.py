@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __main__ import vtk, qt, ctk, slicer
 import time
+import numpy
+from vtk.util import numpy_support
 
 class LabelMapBinning:
   def __init__(self, parent):
@@ -27,6 +29,7 @@ class LabelMapBinningWidget:
     self.layout = self.parent.layout()
     self.lastCommandId = 0
     self.timeoutCounter = 0
+    self.logic = LabelMapBinningLogic()
     if not parent:
       self.setup()
       self.parent.show()
@@ -82,34 +85,15 @@ class LabelMapBinningWidget:
     self.applyButton.connect('clicked(bool)', self.onApply)
     
 
-  def onApply(self):   
+  def onApply(self):
     oldNode = self.nodeSelector.currentNode()
     newNode = self.newNodeSelector.currentNode()
-
-    self.runThreshold(oldNode.GetID(), newNode.GetID(), "Below", self.thresholdSpinBox.value, 999999.0) #temporary outside value
-    self.runThreshold(newNode.GetID(), newNode.GetID(), "Below", 999999.0, self.highLabelSpinBox.value)
-    self.runThreshold(newNode.GetID(), newNode.GetID(), "Above", 999998.0, self.lowLabelSpinBox.value)
-    
-    self.convertToLabelMap(newNode, (newNode.GetName() + "_label"))
-
-
-  def runThreshold(self, oldNodeID, newNodeID, thresholdType, thresholdValue, outsideValue):
-    thresholdScalar = slicer.modules.thresholdscalarvolume
-
-    parameters = {}
-    parameters["InputVolume"] = oldNodeID
-    parameters["OutputVolume"] = newNodeID
-
-    parameters["ThresholdType"] = thresholdType
-    parameters["ThresholdValue"] = thresholdValue
-    parameters["OutsideValue"] = outsideValue
-    
-    return (slicer.cli.runSync(thresholdScalar, None, parameters))
+    if not newNode.IsA("vtkMRMLLabelMapVolumeNode"):
+      newNode = self.convertToLabelMap(newNode)
+    self.logic.binVolume(oldNode, newNode, [self.thresholdSpinBox.value], [self.lowLabelSpinBox.value, self.highLabelSpinBox.value])
 
 
-  def convertToLabelMap(self, volumeNode, name):
-    volumesLogic = slicer.modules.volumes.logic()
-
+  def convertToLabelMap(self, volumeNode):
     newLabelNode = slicer.vtkMRMLLabelMapVolumeNode()
     newLabelNode.SetName(volumeNode.GetName())
     newLabelNode.SetHideFromEditors(volumeNode.GetHideFromEditors())
@@ -119,16 +103,42 @@ class LabelMapBinningWidget:
     newLabelNode.SetDescription(volumeNode.GetDescription())
     #TODO: Attributes
     slicer.mrmlScene.AddNode(newLabelNode)
-    
-    volumesLogic.CreateLabelVolumeFromVolume(slicer.mrmlScene, newLabelNode, volumeNode)
-    slicer.mrmlScene.RemoveNode(volumeNode)  
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    return newLabelNode
 
-    
-  
-class LabelMapBinningLogic:
-  def __init__(self):
-    pass
- 
-  
 
 
+class LabelMapBinningLogic:
+  """
+  Bins a scalar volume into a label map in one pass over its voxels. With the increasing thresholds t1 < ... < tN,
+  voxels below t1 get labels[0], voxels in [ti, ti+1) get labels[i] and voxels from tN on get labels[N].
+  """
+  def __init__(self, blockSize=4 * 1024 * 1024):
+    # voxels binned at once, bounds the temporary bin indices
+    self.blockSize = blockSize
+
+  def binVolume(self, inputVolumeNode, outputLabelMapNode, thresholds, labels):
+    thresholds = numpy.asarray(thresholds, dtype=numpy.float64).ravel()
+    labels = numpy.asarray(labels, dtype=numpy.int16).ravel()
+    if len(labels) != len(thresholds) + 1:
+      raise ValueError("%d thresholds need %d labels, got %d" % (len(thresholds), len(thresholds) + 1, len(labels)))
+    if numpy.any(numpy.diff(thresholds) <= 0):
+      raise ValueError("Thresholds must be strictly increasing")
+    inputImageData = inputVolumeNode.GetImageData()
+    if inputImageData.GetNumberOfScalarComponents() != 1:
+      raise ValueError("Only single component volumes can be binned")
+    values = numpy_support.vtk_to_numpy(inputImageData.GetPointData().GetScalars())
+    # the labels are written straight into the scalars of the new image data
+    outputImageData = vtk.vtkImageData()
+    outputImageData.SetDimensions(inputImageData.GetDimensions())
+    outputImageData.AllocateScalars(vtk.VTK_SHORT, 1)
+    labelArray = numpy_support.vtk_to_numpy(outputImageData.GetPointData().GetScalars())
+    for start in range(0, len(values), self.blockSize):
+      labelArray[start:start + self.blockSize] = labels[numpy.searchsorted(thresholds, values[start:start + self.blockSize], side="right")]
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolumeNode.GetIJKToRASMatrix(ijkToRAS)
+    outputLabelMapNode.SetIJKToRASMatrix(ijkToRAS)
+    outputLabelMapNode.SetAndObserveImageData(outputImageData)
+    if not outputLabelMapNode.GetDisplayNode():
+      outputLabelMapNode.CreateDefaultDisplayNodes()
+    return outputLabelMapNode
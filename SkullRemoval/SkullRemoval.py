@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __main__ import vtk, qt, ctk, slicer
 import time
+import SimpleITK as sitk
+import sitkUtils
 
 class SkullRemoval:
   def __init__(self, parent):
@@ -27,6 +29,7 @@ class SkullRemovalWidget:
     self.layout = self.parent.layout()
     self.lastCommandId = 0
     self.timeoutCounter = 0
+    self.logic = SkullRemovalLogic()
     if not parent:
       self.setup()
       self.parent.show()
@@ -70,80 +73,46 @@ class SkullRemovalWidget:
     controlLayout.addRow(self.applyButton)
     self.applyButton.connect('clicked(bool)', self.onApply)
     
-  def runMask(self, volume, maskVolume, maskedVolume):
-    maskScalar = slicer.modules.maskscalarvolume
-    parameters = {}
-    parameters["InputVolume"] = volume.GetID()
-    parameters["MaskVolume"] = maskVolume.GetID()
-    parameters["OutputVolume"] = maskedVolume.GetID()
-    return slicer.cli.runSync(maskScalar, None, parameters)
-
-  def runSubtract(self, volume, maskedVolume, subtractedVolume):
-    subScalar = slicer.modules.subtractscalarvolumes
-    parameters = {}
-    parameters["inputVolume1"] = volume.GetID()
-    parameters["inputVolume2"] = maskedVolume.GetID()
-    parameters["order"] = 0
-    parameters["outputVolume"] = subtractedVolume.GetID()
-    return slicer.cli.runSync(subScalar, None, parameters)
-    
-    
   def onApply(self):   
     volume = self.nodeSelector.currentNode()
-    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
-    segmentationNode.CreateDefaultDisplayNodes()
-    segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volume)
-    addedSegmentID = segmentationNode.GetSegmentation().AddEmptySegment("Skull")
-
-    segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-    segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-    segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-    segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-    segmentEditorWidget.setSegmentationNode(segmentationNode)
-    segmentEditorWidget.setMasterVolumeNode(volume)
-
-    segmentEditorWidget.setActiveEffectByName("Threshold")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("MinimumThreshold","550")
-    effect.setParameter("MaximumThreshold","3000")
-    effect.self().onApply()
-
-    segmentEditorWidget.setActiveEffectByName("Islands")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("Operation","KEEP_LARGEST_ISLAND")
-    effect.self().onApply()
-
-    segmentEditorWidget.setActiveEffectByName("Margin")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("MarginSizeMm",str(self.marginBox.value))
-    effect.self().onApply()
+    strippedImage, skullMask = self.logic.removeSkull(sitkUtils.PullFromSlicer(volume.GetID()), self.marginBox.value)
+    sitkUtils.PushToSlicer(skullMask, "MaskVolume", 2, False)
+    sitkUtils.PushToSlicer(strippedImage, "Cropped_volume_sub", 0, False)
 
-    labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-    labelmapVolumeNode.SetName("MaskVolume")
-    slicer.modules.segmentations.logic().ExportAllSegmentsToLabelmapNode(segmentationNode, labelmapVolumeNode)
-
-    maskedVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
-    maskedVolume.SetName("MaskedVolume")    
-    self.runMask(volume, labelmapVolumeNode, maskedVolume)
-    
-    subtractedVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
-    subtractedVolume.SetName("Cropped_volume_sub")    
-    self.runSubtract(volume, maskedVolume, subtractedVolume)
-    
     if self.labelmapCheckBox.checkState():
-      labelMaskedVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
-      labelMaskedVolume.SetName("LabelMaskedVolume")    
-      self.runMask(self.labelmapSelector.currentNode(), labelmapVolumeNode, labelMaskedVolume)
-      
-      labelSubtractedVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
-      labelSubtractedVolume.SetName("Cropped_labelmap")    
-      self.runSubtract(self.labelmapSelector.currentNode(), labelMaskedVolume, labelSubtractedVolume)      
+      labelImage = sitkUtils.PullFromSlicer(self.labelmapSelector.currentNode().GetID())
+      sitkUtils.PushToSlicer(self.logic.applySkullMask(labelImage, skullMask), "Cropped_labelmap", 0, False)
     
 
 class SkullRemovalLogic:
-  def __init__(self):
-    pass
- 
-  
+  """
+  Strips the skull from a CT image without GUI objects or CLI modules. The skull is the largest connected component
+  of the voxels within [lowerThreshold, upperThreshold], grown by a margin in millimeters, and is set to 0.
+  """
+  def __init__(self, lowerThreshold=550, upperThreshold=3000):
+    self.lowerThreshold = lowerThreshold
+    self.upperThreshold = upperThreshold
+
+  def removeSkull(self, image, margin=3.5):
+    """
+    Returns the stripped image and the UInt8 skull mask, both on the grid of image.
+    """
+    skullMask = self.getSkullMask(image, margin)
+    return self.applySkullMask(image, skullMask), skullMask
 
+  def getSkullMask(self, image, margin):
+    skullMask = sitk.BinaryThreshold(image, self.lowerThreshold, self.upperThreshold, 1, 0)
+    # components are relabeled by decreasing size, the skull is label 1
+    components = sitk.RelabelComponent(sitk.ConnectedComponent(skullMask, False))
+    skullMask = sitk.BinaryThreshold(components, 1, 1, 1, 0)
+    radius = [int(round(margin / spacing)) for spacing in image.GetSpacing()]
+    if max(radius) > 0:
+      dilateFilter = sitk.BinaryDilateImageFilter()
+      dilateFilter.SetKernelType(sitk.sitkBall)
+      dilateFilter.SetKernelRadius(radius)
+      dilateFilter.SetForegroundValue(1)
+      skullMask = dilateFilter.Execute(skullMask)
+    return skullMask
 
+  def applySkullMask(self, image, skullMask):
+    return sitk.MaskNegated(image, skullMask)
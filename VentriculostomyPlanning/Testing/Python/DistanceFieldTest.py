@@ -0,0 +1,69 @@
+import unittest
+import numpy
+import SimpleITK as sitk
+from VentriculostomyPlanningUtils.DistanceField import DistanceField
+
+class DistanceFieldTest(unittest.TestCase):
+  """
+  Sampling of DistanceField on a linear field, which trilinear interpolation reproduces exactly.
+  """
+
+  def setUp(self):
+    self.size = (20, 16, 12)
+    self.origin = (10.0, -5.0, 3.0)
+    self.spacing = (1.0, 2.0, 3.0)
+    # value of the field at an LPS position
+    self.coefficients = numpy.array([1.0, 2.0, -0.5])
+    i, j, k = numpy.meshgrid(*[numpy.arange(size) for size in self.size], indexing='ij')
+    lps = numpy.stack((i, j, k), axis=-1) * self.spacing + self.origin
+    array = numpy.transpose(lps.dot(self.coefficients), (2, 1, 0))
+    image = sitk.GetImageFromArray(array.astype(numpy.float32))
+    image.SetOrigin(self.origin)
+    image.SetSpacing(self.spacing)
+    self.field = DistanceField.fromImage(image)
+    self.lower = numpy.array(self.origin)
+    self.upper = self.lower + (numpy.array(self.size) - 1) * self.spacing
+
+  def getValues(self, rasPoints):
+    return (numpy.asarray(rasPoints) * [-1.0, -1.0, 1.0]).dot(self.coefficients)
+
+  def getRandomPoints(self, numberOfPoints, seed=0):
+    # RAS points inside of the image
+    lps = numpy.random.RandomState(seed).uniform(self.lower, self.upper, (numberOfPoints, 3))
+    return lps * [-1.0, -1.0, 1.0]
+
+  def test_sample(self):
+    points = self.getRandomPoints(500)
+    self.assertTrue(numpy.allclose(self.field.sample(points), self.getValues(points), atol=1e-4))
+
+  def test_sampleOutsideIsClamped(self):
+    inside = self.getRandomPoints(10, seed=1)
+    outside = inside.copy()
+    outside[:, 2] = self.upper[2] + 50.0
+    border = inside.copy()
+    border[:, 2] = self.upper[2]
+    self.assertTrue(numpy.allclose(self.field.sample(outside), self.field.sample(border), atol=1e-4))
+
+  def test_segmentMinimumValue(self):
+    # the minimum of a linear field along a segment is at one of its ends
+    starts, ends = self.getRandomPoints(50, seed=2), self.getRandomPoints(50, seed=3)
+    segments = numpy.stack((starts, ends), axis=1)
+    expected = numpy.minimum(self.getValues(starts), self.getValues(ends))
+    self.assertTrue(numpy.allclose(self.field.segmentMinimumValue(segments), expected, atol=1e-4))
+    self.assertEqual(len(self.field.segmentMinimumValue(numpy.zeros((0, 2, 3)))), 0)
+
+  def test_segmentMinimumValueInBlocks(self):
+    segments = numpy.stack((self.getRandomPoints(50, seed=4), self.getRandomPoints(50, seed=5)), axis=1)
+    expected = self.field.segmentMinimumValue(segments)
+    self.field.sampleBlockSize = 64
+    self.assertTrue(numpy.array_equal(self.field.segmentMinimumValue(segments), expected))
+
+  def test_segmentCrossings(self):
+    start, end = self.getRandomPoints(2, seed=6)
+    threshold = 0.5 * (self.getValues(start) + self.getValues(end))
+    crossings = self.field.segmentCrossings(start, end, threshold)
+    self.assertEqual(len(crossings), 1)
+    self.assertTrue(numpy.allclose(crossings[0], 0.5 * (start + end), atol=1e-3))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import SimpleITK as sitk
+from VentriculostomyPlanningUtils.LRUCache import LRUCache, getImageBytes
+
+class LRUCacheTest(unittest.TestCase):
+  """
+  Eviction order, budget and statistics of the cache base of the locator, volume and image pyramid caches.
+  """
+
+  def test_evictsLeastRecentlyUsed(self):
+    cache = LRUCache(10)
+    cache.store(("a", 0), "first", 4)
+    cache.store(("b", 0), "second", 4)
+    self.assertEqual(cache.lookup(("a", 0)), "first")
+    cache.store(("c", 0), "third", 4)
+    self.assertIsNone(cache.lookup(("b", 0)))
+    self.assertEqual(cache.lookup(("a", 0)), "first")
+    self.assertEqual(cache.lookup(("c", 0)), "third")
+    self.assertEqual(cache.size, 8)
+
+  def test_keepsEntryLargerThanBudget(self):
+    cache = LRUCache(10)
+    cache.store(("a", 0), "small", 2)
+    self.assertEqual(cache.store(("b", 0), "large", 50), "large")
+    self.assertEqual(list(cache.entries), [("b", 0)])
+    self.assertEqual(cache.size, 50)
+
+  def test_storeReplacesEntry(self):
+    cache = LRUCache(10)
+    cache.store(("a", 0), "first", 4)
+    cache.store(("a", 0), "second", 6)
+    self.assertEqual(cache.lookup(("a", 0)), "second")
+    self.assertEqual(cache.size, 6)
+
+  def test_removeStaleEntries(self):
+    cache = LRUCache(100)
+    cache.store(("node", 1, "kind"), "former", 3)
+    cache.store(("node", 2, "kind"), "current", 5)
+    cache.store(("other", 1, "kind"), "other", 7)
+    cache.removeStaleEntries(("node", 2))
+    self.assertEqual(sorted(cache.entries), [("node", 2, "kind"), ("other", 1, "kind")])
+    self.assertEqual(cache.size, 12)
+
+  def test_statistics(self):
+    cache = LRUCache(10)
+    cache.lookup(("a", 0))
+    cache.store(("a", 0), "value")
+    cache.lookup(("a", 0))
+    self.assertEqual(cache.getStatistics(), {"hits": 1, "misses": 1, "entries": 1, "size": 1})
+    cache.clear()
+    self.assertEqual(cache.getStatistics(), {"hits": 0, "misses": 0, "entries": 0, "size": 0})
+
+  def test_getImageBytes(self):
+    self.assertEqual(getImageBytes(sitk.Image(10, 20, 30, sitk.sitkFloat32)), 10 * 20 * 30 * 4)
+    self.assertEqual(getImageBytes(sitk.Image([4, 5, 6], sitk.sitkVectorInt16, 3)), 4 * 5 * 6 * 3 * 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,139 @@
+import logging
+import time
+import unittest
+import numpy
+import vtk
+from VentriculostomyPlanningUtils.PlanningEngine import PlanningEngine
+from VentriculostomyPlanningUtils.Constants import CandidatePathFeasibility
+
+def createEllipsoidModel(semiAxes, resolution=370, center=(0.0, 0.0, 0.0)):
+  sphere = vtk.vtkSphereSource()
+  sphere.SetRadius(1.0)
+  sphere.SetThetaResolution(resolution)
+  sphere.SetPhiResolution(resolution)
+  transform = vtk.vtkTransform()
+  transform.Translate(*center)
+  transform.Scale(*semiAxes)
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetInputConnection(sphere.GetOutputPort())
+  transformFilter.SetTransform(transform)
+  transformFilter.Update()
+  return transformFilter.GetOutput()
+
+def createSkullModel(resolution=370):
+  """
+  Skull sized model: outer and inner table as two ellipsoid shells 6 mm apart, about 5.4e5 triangles with the
+  default resolution, the size of a skull model segmented from a clinical CT.
+  """
+  appendFilter = vtk.vtkAppendPolyData()
+  for semiAxes in ((75.0, 95.0, 80.0), (69.0, 89.0, 74.0)):
+    appendFilter.AddInputData(createEllipsoidModel(semiAxes, resolution))
+  appendFilter.Update()
+  return appendFilter.GetOutput()
+
+def createCandidateSegments(posTarget, direction, entryRadius=80.0, radiusResolution=1.0, phiResolution=numpy.pi/180.0):
+  # candidate cone of prepareCandidatePath, (N,2,3) [entry, target] segments on a 1 mm x 1 degree disc
+  direction = numpy.array(direction, dtype=numpy.float64) / numpy.linalg.norm(direction)
+  firstAxis = numpy.cross(direction, [1.0, 0.0, 0.0])
+  firstAxis /= numpy.linalg.norm(firstAxis)
+  secondAxis = numpy.cross(direction, firstAxis)
+  radii, angles = [grid.ravel() for grid in numpy.meshgrid(numpy.arange(radiusResolution, entryRadius + radiusResolution, radiusResolution),
+                                                           numpy.arange(0, 2 * numpy.pi, phiResolution), indexing='ij')]
+  entries = numpy.array(posTarget) + 120.0 * direction + (radii * numpy.cos(angles))[:, numpy.newaxis] * firstAxis \
+            + (radii * numpy.sin(angles))[:, numpy.newaxis] * secondAxis
+  segments = numpy.empty((len(entries), 2, 3))
+  segments[:, 0, :] = entries
+  segments[:, 1, :] = posTarget
+  return segments
+
+def intersectSegmentsPerPath(segments, polyData):
+  # the former filtering loop: a locator built for the call and one IntersectWithLine per path
+  locator = vtk.vtkCellLocator()
+  locator.SetDataSet(polyData)
+  locator.BuildLocator()
+  t = vtk.mutable(0)
+  x = [0.0, 0.0, 0.0]
+  pcoords = [0.0, 0.0, 0.0]
+  subId = vtk.mutable(0)
+  hits = numpy.zeros(len(segments), dtype=bool)
+  hitPoints = numpy.zeros((len(segments), 3))
+  for index in range(len(segments)):
+    if locator.IntersectWithLine(segments[index, 0], segments[index, 1], 1e-2, t, x, pcoords, subId):
+      hits[index] = True
+      hitPoints[index] = x
+  return hits, hitPoints
+
+class PlanningEngineBenchmark(unittest.TestCase):
+  """
+  Timings of the planning core on a skull sized synthetic model. It is not part of the CTest suite, run it by hand
+  with python PlanningEngineBenchmark.py from a Python which finds VentriculostomyPlanningUtils, e.g. PythonSlicer.
+  The correctness checks of the same functions are in PlanningEngineTest.py.
+  """
+
+  @classmethod
+  def setUpClass(cls):
+    cls.skullPolyData = createSkullModel()
+    cls.posTarget = numpy.array([20.0, 10.0, 0.0])
+    cls.segments = createCandidateSegments(cls.posTarget, [0.3, 0.4, 1.0])
+
+  def timeCall(self, function, *args):
+    startTime = time.time()
+    result = function(*args)
+    return result, time.time() - startTime
+
+  def test_intersectSegmentsWithPolyData(self):
+    engine = PlanningEngine()
+    (hits, hitPoints), perPathTime = self.timeCall(intersectSegmentsPerPath, self.segments, self.skullPolyData)
+    (batchHits, batchPoints, batchDistances), firstTime = self.timeCall(engine.intersectSegmentsWithPolyData, self.segments, self.skullPolyData)
+    (batchHits, batchPoints, batchDistances), cachedTime = self.timeCall(engine.intersectSegmentsWithPolyData, self.segments, self.skullPolyData)
+    logging.info("%d segments, %d triangles: per path loop %.2f s, batch %.2f s (locator built), %.2f s (locator cached)" %
+          (len(self.segments), self.skullPolyData.GetNumberOfCells(), perPathTime, firstTime, cachedTime))
+    self.assertTrue(numpy.array_equal(hits, batchHits))
+    self.assertTrue(numpy.allclose(hitPoints[hits], batchPoints[hits]))
+    self.assertTrue(numpy.allclose(batchDistances[hits], numpy.linalg.norm(batchPoints[hits] - self.segments[hits, 0, :], axis=1)))
+
+  def test_geodesicReferenceContourInPlane(self):
+    # the reference curves are traced in the band of their plane, a trace on the unrestricted field can leave it
+    engine = PlanningEngine()
+    geodesic = engine.getGeodesicDistance(createSkullModel(150))
+    referencePoint = numpy.array([0.0, 0.0, 80.0])
+    tolerance = 2.0 * numpy.mean(geodesic.edgeLengths)
+    for normal in ([1.0, 0.0, 0.0], [0.3, 0.95, 0.0]):
+      normal = numpy.array(normal) / numpy.linalg.norm(normal)
+      bandMask = engine.getGeodesicPlaneMask(geodesic, referencePoint, normal)
+      mask = bandMask & (geodesic.vertices[:, 1] >= referencePoint[1])
+      vertex, freePath = geodesic.findPointAtDistance(referencePoint, 100.0, mask)
+      vertex, bandPath = geodesic.findPointAtDistance(referencePoint, 100.0, mask, bandMask)
+      freeDeviation = numpy.abs((freePath - referencePoint).dot(normal)).max()
+      bandDeviation = numpy.abs((bandPath - referencePoint).dot(normal)).max()
+      logging.info("plane normal %s: largest distance of the path to the plane %.1f mm unrestricted, %.1f mm in the band" %
+            (numpy.round(normal, 2), freeDeviation, bandDeviation))
+      self.assertLess(bandDeviation, tolerance)
+      self.assertTrue(numpy.allclose(bandPath[0], geodesic.vertices[geodesic.findClosestVertex(referencePoint)]))
+
+  def test_planTrajectory(self):
+    # head surface of the outer table, with a vessel next to the Kocher point of the left hemisphere
+    engine = PlanningEngine()
+    skullPolyData = createEllipsoidModel((75.0, 95.0, 80.0))
+    posNasion = numpy.array([0.0, 95.0 * numpy.cos(-0.2), 80.0 * numpy.sin(-0.2)])
+    landmarks = (skullPolyData, posNasion, [0.0, -50.0, 0.0], [-15.0, 25.0, 10.0], [-17.0, 30.0, 20.0], 100.0, 25.0)
+    posKocher = engine.planTrajectory(*landmarks)["posKocher"]
+    vesselPolyData = createEllipsoidModel((4.0, 4.0, 4.0), 30, posKocher + [0.0, 3.0, -3.0])
+    results = {}
+    for adaptiveSearch in (False, True):
+      results[adaptiveSearch], planningTime = self.timeCall(lambda: engine.planTrajectory(*landmarks, vesselPolyData=vesselPolyData,
+                                                                                           adaptiveSearch=adaptiveSearch))
+      candidatePaths, bestPath = results[adaptiveSearch]["candidatePaths"], results[adaptiveSearch]["bestPath"]
+      logging.info("planTrajectory, %s search: %.2f s, %d entry points, %d collision free, %d meeting all the conditions, best path %.2f mm from the Kocher point" %
+            ("adaptive" if adaptiveSearch else "full", planningTime, len(candidatePaths),
+             ((candidatePaths["feasibility"] & CandidatePathFeasibility.CollisionFree) > 0).sum(),
+             (candidatePaths["feasibility"] == CandidatePathFeasibility.All).sum(), bestPath["distanceToKocher"]))
+      self.assertEqual(bestPath["feasibility"], CandidatePathFeasibility.All)
+      self.assertLess(bestPath["distanceToKocher"], 20.0)
+      self.assertFalse(engine.intersectSegmentsWithPolyData(numpy.array([[bestPath["entry"], bestPath["target"]]]), vesselPolyData)[0][0])
+    self.assertTrue(((results[False]["candidatePaths"]["feasibility"] & CandidatePathFeasibility.CollisionFree) == 0).any())
+    self.assertTrue(numpy.allclose(results[True]["bestPath"]["skullEntry"], results[False]["bestPath"]["skullEntry"], atol=1.0))
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.INFO)
+  unittest.main()
@@ -0,0 +1,174 @@
+import unittest
+import numpy
+import vtk
+from VentriculostomyPlanningUtils.PlanningEngine import PlanningEngine
+from VentriculostomyPlanningUtils.Constants import CandidatePathFeasibility
+
+def createSphereModel(radius=50.0, center=(0.0, 0.0, 0.0), resolution=40):
+  sphere = vtk.vtkSphereSource()
+  sphere.SetRadius(radius)
+  sphere.SetCenter(*center)
+  sphere.SetThetaResolution(resolution)
+  sphere.SetPhiResolution(resolution)
+  sphere.Update()
+  return sphere.GetOutput()
+
+def createRandomSegments(numberOfSegments, seed=0):
+  # segments from outside of the sphere of createSphereModel, about half of them crossing it
+  random = numpy.random.RandomState(seed)
+  segments = numpy.empty((numberOfSegments, 2, 3))
+  segments[:, 0, :] = random.uniform(-100.0, 100.0, (numberOfSegments, 3))
+  segments[:, 1, :] = random.uniform(-30.0, 30.0, (numberOfSegments, 3))
+  return segments
+
+class PlanningEngineTest(unittest.TestCase):
+  """
+  Fast checks of the headless planning core on small synthetic models.
+  """
+
+  def setUp(self):
+    self.engine = PlanningEngine()
+    self.polyData = createSphereModel()
+
+  def test_intersectSegmentsWithPolyData(self):
+    segments = createRandomSegments(200)
+    hits, hitPoints, hitDistances = self.engine.intersectSegmentsWithPolyData(segments, self.polyData)
+    locator = vtk.vtkCellLocator()
+    locator.SetDataSet(self.polyData)
+    locator.BuildLocator()
+    t = vtk.mutable(0.0)
+    x = [0.0, 0.0, 0.0]
+    pcoords = [0.0, 0.0, 0.0]
+    subId = vtk.mutable(0)
+    for index, (start, end) in enumerate(segments.tolist()):
+      hit = locator.IntersectWithLine(start, end, 1e-2, t, x, pcoords, subId)
+      self.assertEqual(bool(hit), hits[index])
+      if hit:
+        self.assertTrue(numpy.allclose(x, hitPoints[index]))
+        self.assertAlmostEqual(hitDistances[index], numpy.linalg.norm(numpy.array(x) - start))
+      else:
+        self.assertEqual(hitDistances[index], numpy.inf)
+    self.assertTrue(hits.any() and not hits.all())
+
+  def test_intersectSegmentsWithEmptyPolyData(self):
+    segments = createRandomSegments(5)
+    hits, hitPoints, hitDistances = self.engine.intersectSegmentsWithPolyData(segments, vtk.vtkPolyData())
+    self.assertFalse(hits.any())
+    self.assertTrue(numpy.isinf(hitDistances).all())
+    hits, hitPoints, hitDistances = self.engine.intersectSegmentsWithPolyData(numpy.zeros((0, 2, 3)), self.polyData)
+    self.assertEqual(len(hits), 0)
+
+  def test_mapInParallel(self):
+    values = numpy.arange(1000, dtype=numpy.float64)
+    function = lambda shard: (shard * 2.0, shard + 1.0)
+    self.engine.parallelShardSize = 64
+    self.engine.numberOfWorkers = 3
+    for useProcesses in (False, True):
+      doubled, incremented = self.engine.mapInParallel(function, values, useProcesses=useProcesses)
+      self.assertTrue(numpy.array_equal(doubled, values * 2.0))
+      self.assertTrue(numpy.array_equal(incremented, values + 1.0))
+    self.assertTrue(numpy.array_equal(self.engine.mapInParallel(numpy.sqrt, values), numpy.sqrt(values)))
+
+  def test_intersectPathSegmentsInShards(self):
+    # the sharded queries match a single batch
+    segments = createRandomSegments(300, seed=1)
+    expected = self.engine.intersectSegmentsWithPolyData(segments, self.polyData)
+    self.engine.parallelShardSize = 50
+    self.engine.numberOfWorkers = 4
+    for result, expectedResult in zip(self.engine.intersectPathSegments(segments, self.polyData), expected):
+      self.assertTrue(numpy.array_equal(result, expectedResult))
+
+  def test_filterCandidatePaths(self):
+    # paths from outside of the sphere to its center, and one path which misses it
+    directions = numpy.array([[0.0, 0.0, 1.0], [1.0, 0.0, 0.0], [0.6, 0.0, 0.8], [0.2, 0.0, numpy.sqrt(0.96)]])
+    segments = numpy.zeros((len(directions) + 1, 2, 3))
+    segments[:-1, 0, :] = 100.0 * directions
+    segments[-1] = [[100.0, 100.0, 100.0], [90.0, 90.0, 90.0]]
+    posKocher, posNasion = numpy.array([0.0, 0.0, 50.0]), numpy.array([0.0, 50.0, 0.0])
+    clearance = numpy.arange(len(segments), dtype=numpy.float64)
+    candidatePaths = self.engine.filterCandidatePaths(segments, self.polyData, posKocher, posNasion, 30.0, 20.0, clearance, [0.0, 0.0, 1.0])
+    All, CollisionFree = CandidatePathFeasibility.All, CandidatePathFeasibility.CollisionFree
+    PosteriorEnough = CandidatePathFeasibility.PosteriorEnough
+    self.assertEqual(candidatePaths["feasibility"].tolist(), [All, CollisionFree, CollisionFree | PosteriorEnough, All, CollisionFree])
+    # the skull entries are on the faceted sphere
+    self.assertTrue(numpy.allclose(candidatePaths["skullEntry"][:-1], 50.0 * directions, atol=0.5))
+    self.assertTrue(numpy.isnan(candidatePaths["skullEntry"][-1]).all())
+    self.assertEqual(candidatePaths["distanceToKocher"][-1], numpy.inf)
+    self.assertTrue(numpy.allclose(candidatePaths["distanceToNasion"][:-1],
+                                   numpy.linalg.norm(candidatePaths["skullEntry"][:-1] - posNasion, axis=1)))
+    self.assertTrue(numpy.array_equal(candidatePaths["clearance"], clearance))
+    self.assertTrue(numpy.allclose(candidatePaths["angleToVentricleAxis"][:-1], numpy.arccos(directions[:, 2])))
+    best = self.engine.getTopCandidatePaths(candidatePaths, 5)
+    self.assertEqual(len(best), 2)
+    self.assertLess(best[0]["distanceToKocher"], best[1]["distanceToKocher"])
+    self.assertTrue(numpy.allclose(best[0]["entry"], segments[0, 0]))
+
+  def test_evaluateCandidateEntryPointsClearsCollisions(self):
+    entryPoints = numpy.array([[0.0, 0.0, 100.0], [100.0, 0.0, 0.0]])
+    vesselPolyData = createSphereModel(5.0, (70.0, 0.0, 0.0), 12)
+    candidatePaths = self.engine.evaluateCandidateEntryPoints(numpy.zeros(3), entryPoints, [0.0, 0.0, 50.0], [0.0, 50.0, 0.0],
+                                                              self.polyData, 30.0, 20.0, vesselPolyData)
+    self.assertEqual(candidatePaths["feasibility"].tolist(), [CandidatePathFeasibility.All, 0])
+
+  def test_rankCandidatePaths(self):
+    values = [3.0, numpy.nan, 1.0, 2.0, 5.0]
+    self.assertEqual(self.engine.rankCandidatePaths(values, 3).tolist(), [2, 3, 0])
+    self.assertEqual(self.engine.rankCandidatePaths(values, 2, largestFirst=True).tolist(), [4, 0])
+    self.assertEqual(self.engine.rankCandidatePaths(values, 10).tolist(), [2, 3, 0, 4, 1])
+    self.assertEqual(len(self.engine.rankCandidatePaths(values, 0)), 0)
+    self.assertEqual(len(self.engine.getTopCandidatePaths(None, 3)), 0)
+
+  def getHalfPlaneEvaluation(self, pointOfInterest):
+    # paths are feasible beyond x = 10, ranked by the distance of their entry to pointOfInterest
+    def evaluate(points):
+      candidatePaths = numpy.zeros(len(points), dtype=self.engine.candidatePathDtype)
+      candidatePaths["entry"] = points
+      candidatePaths["distanceToKocher"] = numpy.linalg.norm(points - pointOfInterest, axis=1)
+      candidatePaths["feasibility"] = numpy.where(points[:, 0] > 10.0, CandidatePathFeasibility.All, CandidatePathFeasibility.CollisionFree)
+      return candidatePaths
+    return evaluate
+
+  def test_adaptiveCandidateEntryPoints(self):
+    matrix = vtk.vtkMatrix4x4()
+    evaluate = self.getHalfPlaneEvaluation(numpy.array([9.0, 5.0, 0.0]))
+    fullPoints = self.engine.generateCandidateEntryPoints(matrix, [0.0, 0.0, 0.0], 40.0, 1.0, numpy.pi / 90.0)
+    fullBest = self.engine.getTopCandidatePaths(evaluate(fullPoints.astype(numpy.float64)))[0]
+    points, candidatePaths = self.engine.adaptiveCandidateEntryPoints(matrix, [0.0, 0.0, 0.0], 40.0, 1.0, numpy.pi / 90.0, evaluate,
+                                                                      refinementBudget=100000, refinementDistance=5.0)
+    self.assertLess(len(points), len(fullPoints) / 2)
+    self.assertTrue(numpy.allclose(candidatePaths["entry"], points, atol=1e-4))
+    # every evaluated point is a point of the full grid
+    distances = numpy.linalg.norm(points[:, numpy.newaxis, :] - fullPoints[numpy.newaxis, :, :], axis=2)
+    self.assertLess(distances.min(axis=1).max(), 1e-4)
+    self.assertTrue(numpy.allclose(self.engine.getTopCandidatePaths(candidatePaths)[0]["entry"], fullBest["entry"], atol=1e-4))
+
+  def test_adaptiveCandidateEntryPointsBudget(self):
+    matrix = vtk.vtkMatrix4x4()
+    evaluate = self.getHalfPlaneEvaluation(numpy.array([9.0, 5.0, 0.0]))
+    coarsePoints, coarsePaths = self.engine.adaptiveCandidateEntryPoints(matrix, [0.0, 0.0, 0.0], 40.0, 1.0, numpy.pi / 90.0, evaluate,
+                                                                         refinementBudget=0)
+    points, candidatePaths = self.engine.adaptiveCandidateEntryPoints(matrix, [0.0, 0.0, 0.0], 40.0, 1.0, numpy.pi / 90.0, evaluate,
+                                                                      refinementBudget=len(coarsePoints) + 50)
+    self.assertLessEqual(len(points), len(coarsePoints) + 50)
+    self.assertGreater(len(points), len(coarsePoints))
+    firstPoint = [1.0, 2.0, 3.0]
+    points, candidatePaths = self.engine.adaptiveCandidateEntryPoints(matrix, [0.0, 0.0, 0.0], 40.0, 1.0, numpy.pi / 90.0, evaluate,
+                                                                      refinementBudget=0, firstPoint=firstPoint)
+    self.assertTrue(numpy.allclose(points[0], firstPoint))
+    self.assertEqual(len(points), len(coarsePoints) + 1)
+
+  def test_getCandidateConeBounds(self):
+    posTarget, posDistal = numpy.array([0.0, 0.0, -10.0]), numpy.array([3.0, 4.0, 10.0])
+    bounds = self.engine.getCandidateConeBounds(self.polyData, posTarget, posDistal, radiusResolution=0.5)
+    posEntry, posCenter, entryRadius, basePoint, direction = self.engine.getCandidateCone(self.polyData, posTarget, posDistal)
+    entryPoints = self.engine.generateCandidateEntryPoints(self.engine.getAxisTransform(posTarget, posDistal).GetMatrix(), basePoint,
+                                                           entryRadius, 0.5, numpy.pi / 180.0, firstPoint=posEntry)
+    points = numpy.vstack((entryPoints, posCenter))
+    self.assertTrue((points >= bounds[0] - 1e-4).all() and (points <= bounds[1] + 1e-4).all())
+    # the box is tight up to the sampling of the disc
+    self.assertTrue(numpy.allclose(points.min(axis=0), bounds[0], atol=0.1))
+    self.assertTrue(numpy.allclose(points.max(axis=0), bounds[1], atol=0.1))
+    self.assertIsNone(self.engine.getCandidateConeBounds(self.polyData, [200.0, 0.0, 0.0], [210.0, 0.0, 0.0]))
+
+if __name__ == '__main__':
+  unittest.main()
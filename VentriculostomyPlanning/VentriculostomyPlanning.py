@@ -1,5 +1,6 @@
 import os, inspect
 import json
+import math
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
@@ -10,18 +11,21 @@ from ctk import ctkAxesWidget
 import numpy
 import SimpleITK as sitk
 import sitkUtils
+from vtk.util import numpy_support
 import DICOM
 from DICOM import DICOMWidget
-import PercutaneousApproachAnalysis
-from PercutaneousApproachAnalysis import *
+from LabelMapBinning import LabelMapBinningLogic
+from SkullRemoval import SkullRemovalLogic
 from numpy import linalg
 from code import interact
 from VentriculostomyPlanningUtils.SlicerCaseManager import SlicerCaseManagerWidget, beforeRunProcessEvents
 from VentriculostomyPlanningUtils.PopUpMessageBox import SerialAssignMessageBox, SagittalCorrectionMessageBox, VentricleSideMessageBox
 from VentriculostomyPlanningUtils.UserEvents import VentriculostomyUserEvents
 from VentriculostomyPlanningUtils.UsefulFunctions import UsefulFunctions
+from VentriculostomyPlanningUtils.DistanceField import DistanceField
+from VentriculostomyPlanningUtils.SplineCurve import SplineCurveLogic
 from VentriculostomyPlanningUtils.WatchDog import WatchDog
-from VentriculostomyPlanningUtils.Constants import EndPlacementModes, SagittalCorrectionStatus, CandidatePathStatus, VentricleSideStatus
+from VentriculostomyPlanningUtils.Constants import EndPlacementModes, SagittalCorrectionStatus, CandidatePathStatus, CandidatePathFeasibility, VentricleSideStatus
 from VentriculostomyPlanningUtils.VentriclostomyButtons import *
 from SlicerDevelopmentToolboxUtils.buttons import FourUpLayoutButton
 from SlicerDevelopmentToolboxUtils.mixins import ModuleWidgetMixin, ModuleLogicMixin
@@ -32,6 +36,7 @@ from abc import ABCMeta, abstractmethod
 import datetime
 import time
 from functools import wraps
+from contextlib import contextmanager
 from subprocess import check_output
 # VentriculostomyPlanning
 
@@ -868,7 +873,7 @@ class VentriculostomyPlanningWidget(ScriptedLoadableModuleWidget, ModuleWidgetMi
         self.logic.cannulaManager.connectModelNode(slicer.mrmlScene.GetNodeByID(cannulaModelID))
         self.logic.cannulaManager.curveFiducials = slicer.mrmlScene.GetNodeByID(cannulaFiducialsID)
         self.logic.cannulaManager.curveFiducials.AddObserver(slicer.vtkMRMLMarkupsNode().PointStartInteractionEvent, self.logic.updateSelectedMarker)
-        self.logic.cannulaManager.curveFiducials.AddObserver(slicer.vtkMRMLMarkupsNode().PointModifiedEvent, self.logic.updateCannulaPosition)
+        self.logic.cannulaManager.curveFiducials.AddObserver(slicer.vtkMRMLMarkupsNode().PointModifiedEvent, self.logic.onCannulaPointModified)
         self.logic.cannulaManager.curveFiducials.AddObserver(slicer.vtkMRMLMarkupsNode().PointEndInteractionEvent, self.logic.endCannulaInteraction)
         self.logic.cannulaManager.setModifiedEventHandler(self.onCannulaModified)
         self.logic.cannulaManager.startEditLine()
@@ -1124,94 +1129,26 @@ class VentriculostomyPlanningWidget(ScriptedLoadableModuleWidget, ModuleWidgetMi
 
   def prepareCandidatePath(self):
   # Try out candidate paths
-    targetNodeID = self.logic.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_target")
-    distalNodeID = self.logic.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_distal")
-    nasionNodeID = self.logic.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_nasion")
-    if targetNodeID and distalNodeID and nasionNodeID:
-      targetNode = slicer.mrmlScene.GetNodeByID(targetNodeID)
-      distalNode = slicer.mrmlScene.GetNodeByID(distalNodeID)
-      nasionNode = slicer.mrmlScene.GetNodeByID(nasionNodeID)
-      if targetNode.GetNumberOfFiducials() and distalNode.GetNumberOfFiducials() and nasionNode.GetNumberOfFiducials():
-        posTarget = numpy.array([0.0, 0.0, 0.0])
-        targetNode.GetNthFiducialPosition(0, posTarget)
-        posDistal = numpy.array([0.0, 0.0, 0.0])
-        distalNode.GetNthFiducialPosition(0, posDistal)
-        posNasion = numpy.array([0.0, 0.0, 0.0])
-        nasionNode.GetNthFiducialPosition(0, posNasion)
-        direction = (numpy.array(posDistal) - numpy.array(posTarget))/numpy.linalg.norm(numpy.array(posDistal) - numpy.array(posTarget))
-        if self.logic.trajectoryProjectedMarker.GetNumberOfFiducials() == 0:
-          self.logic.trajectoryProjectedMarker.AddFiducial(0,0,0)
-        vesselModelWithMarginNodeID = self.logic.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_vesselnessWithMarginModel")
-        vesselModelWithMarginNode = slicer.mrmlScene.GetNodeByID(vesselModelWithMarginNodeID)
-        modelID = self.logic.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_model")
-        inputModelNode = slicer.mrmlScene.GetNodeByID(modelID)
-        surfacePolyData = inputModelNode.GetPolyData()
-        FiducialPointAlongVentricle = slicer.mrmlScene.CreateNodeByClass("vtkMRMLMarkupsFiducialNode")
-        self.logic.functions.calculateLineModelIntersect(surfacePolyData, posDistal+1e6*direction, posTarget-1e6*direction, FiducialPointAlongVentricle)
-        posEntry = numpy.array([0.0, 0.0, 0.0])
-        FiducialPointAlongVentricle.GetNthFiducialPosition(0,posEntry)
-        # I believe new versions of VTK add 0,0,0 as an intersection point causing a bug
-        if numpy.array_equal(posEntry, [0,0,0]):
-          FiducialPointAlongVentricle.GetNthFiducialPosition(1,posEntry)
-        self.logic.cylinderMiddlePointNode.RemoveAllMarkups()
-        posCenter = numpy.array([(posTarget[0]+posDistal[0])/2.0, (posTarget[1]+posDistal[1])/2.0, (posTarget[2]+posDistal[2])/2.0])
-        self.logic.cylinderMiddlePointNode.AddFiducial(posCenter[0], posCenter[1], posCenter[2])
-        pathPlanningBasePoint = numpy.array(posTarget) + (numpy.array(posEntry) - numpy.array(posTarget)) * 1.2
-        self.logic.calculateCylinderTransform()
-        matrix = self.logic.transform.GetMatrix()
-        points = vtk.vtkPoints()
-        phiResolution = 1*numpy.pi/180.0 # Increase number to reduce candidates generated
-        #phiResolution = 100*numpy.pi/180.0
-        radiusResolution = 1.0
-        #radiusResolution = 12.0
-        points.InsertNextPoint(posEntry)
-        distance2 = numpy.linalg.norm(numpy.array(posTarget) - numpy.array(posEntry))
-        distance1 = numpy.linalg.norm(numpy.array(posTarget) - numpy.array(posDistal))/2 # Divided by 2 is because, all the cylinder bottom are possible target points
-        self.logic.entryRadius = self.logic.cylinderRadius * distance2 / distance1
-        for radius in numpy.arange(radiusResolution, self.logic.entryRadius+radiusResolution, radiusResolution):
-          for angle in numpy.arange(0, numpy.pi, phiResolution):
-            point = matrix.MultiplyPoint(numpy.array([radius*math.cos(angle), radius*math.sin(angle),0,1]))
-            pointTranslated = [point[0]+pathPlanningBasePoint[0],point[1]+pathPlanningBasePoint[1],point[2]+pathPlanningBasePoint[2]]
-            points.InsertNextPoint(pointTranslated)
-          for angle in numpy.arange(numpy.pi, 2*numpy.pi, phiResolution):
-            point = matrix.MultiplyPoint(numpy.array([-radius * math.cos(angle), radius * math.sin(angle), 0, 1]))
-            pointTranslated = [point[0] + pathPlanningBasePoint[0], point[1] + pathPlanningBasePoint[1], point[2] + pathPlanningBasePoint[2]]
-            points.InsertNextPoint(pointTranslated)
-        self.logic.synthesizedData.SetPoints(points)
-        tempModel = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
-        tempModel.SetName("candicateCannula")
-        tempModel.SetAndObservePolyData(self.logic.synthesizedData)
-        numOfRef = self.logic.coronalReferenceCurveManager.curveFiducials.GetNumberOfFiducials()
-        if self.logic.synthesizedData.GetNumberOfPoints() and numOfRef >= 1:
-          # display all paths model
-          posKocher = [0.0,0.0,0.0]
-          self.logic.coronalReferenceCurveManager.curveFiducials.GetNthFiducialPosition(numOfRef-1,posKocher)
-          if not self.logic.pathCandidatesModel.GetPolyData():
-            polyData = vtk.vtkPolyData()
-            self.logic.pathCandidatesModel.SetAndObservePolyData(polyData)
-          self.logic.pathReceived, self.logic.nPathReceived, self.logic.apReceived, self.logic.minimumPoint, self.logic.minimumDistance, self.logic.maximumPoint, self.logic.maximumDistance = self.logic.PercutaneousApproachAnalysisLogic.makePaths(
-            self.logic.cylinderMiddlePointNode, None, 0, vesselModelWithMarginNode, tempModel)
-          if self.logic.nPathReceived <= 0:
-            slicer.util.warningDisplay("No cannula candidate is venous-collision free, consider redefining the ventricle area.")
-            self.disableVentricleModification(False)
-            return False
-          else:
-            status = self.logic.makePathMeetAllConditions(self.logic.pathReceived, self.logic.nPathReceived, self.logic.pathCandidatesModel.GetPolyData(), posKocher, posNasion, surfacePolyData)
-            self.logic.pathCandidatesModel.GetDisplayNode().SetVisibility(1)
-            self.logic.pathCandidatesModel.GetDisplayNode().SetSliceIntersectionOpacity(0.2)
-            self.disableVentricleModification(False)
-            if status == CandidatePathStatus.NoPosteriorAndNoWithinKocherPoint:
-              slicer.util.warningDisplay("Cannula candidates are both too close to the forehead and too far from the kocher's point, consider redefining the ventricle area.")
-            elif status == CandidatePathStatus.NoPosteriorPoint:
-              slicer.util.warningDisplay("Cannula candidates are too close to the forehead, consider redefining the ventricle area.")
-            elif status == CandidatePathStatus.NoWithinKocherPoint:
-              slicer.util.warningDisplay("Cannula candidates are too far from the kocher's point, consider redefining the ventricle area.")
-            else:
-              self.disableVentricleModification(True)
-            return True
-    else:
+    result = self.logic.planCandidatePaths()
+    if result is None:
       return False
-    return False
+    numOfCollisionFreePaths, status = result
+    if numOfCollisionFreePaths <= 0:
+      slicer.util.warningDisplay("No cannula candidate is venous-collision free, consider redefining the ventricle area.")
+      self.disableVentricleModification(False)
+      return False
+    self.logic.pathCandidatesModel.GetDisplayNode().SetVisibility(1)
+    self.logic.pathCandidatesModel.GetDisplayNode().SetSliceIntersectionOpacity(0.2)
+    self.disableVentricleModification(False)
+    if status == CandidatePathStatus.NoPosteriorAndNoWithinKocherPoint:
+      slicer.util.warningDisplay("Cannula candidates are both too close to the forehead and too far from the kocher's point, consider redefining the ventricle area.")
+    elif status == CandidatePathStatus.NoPosteriorPoint:
+      slicer.util.warningDisplay("Cannula candidates are too close to the forehead, consider redefining the ventricle area.")
+    elif status == CandidatePathStatus.NoWithinKocherPoint:
+      slicer.util.warningDisplay("Cannula candidates are too far from the kocher's point, consider redefining the ventricle area.")
+    else:
+      self.disableVentricleModification(True)
+    return True
 
   def disableVentricleModification(self, status):
     targetNodeID = self.logic.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_target")
@@ -1989,13 +1926,7 @@ class VentriculostomyPlanningWidget(ScriptedLoadableModuleWidget, ModuleWidgetMi
 class CurveManager():
 
   def __init__(self):
-    try:
-      import CurveMaker
-    except ImportError:
-      return slicer.util.warningDisplay(
-            "Error: Could not find extension CurveMaker. Open Slicer Extension Manager and install "
-       "CurveMaker.", "Missing Extension")
-    self.cmLogic = CurveMaker.CurveMakerLogic()
+    self.cmLogic = SplineCurveLogic()
     self.curveFiducials = None
     self._curveModel = None
     self.opacity = 1
@@ -2129,15 +2060,13 @@ class CurveManager():
     if self.tagEventExternal == None and self.externalHandler:
       self.tagEventExternal = self._curveModel.AddObserver(vtk.vtkCommand.ModifiedEvent, self.externalHandler)
       
-    self.cmLogic.DestinationNode = self._curveModel
-    self.cmLogic.SourceNode = self.curveFiducials
-    self.cmLogic.SourceNode.SetAttribute('CurveMaker.CurveModel', self.cmLogic.DestinationNode.GetID())
-    self.cmLogic.updateCurve()
-
-    self.cmLogic.CurvePoly = vtk.vtkPolyData() ## For CurveMaker bug
-    self.cmLogic.enableAutomaticUpdate(1)
-    self.cmLogic.setInterpolationMethod(1)
-    self.cmLogic.setTubeRadius(self.tubeRadius)
+    # the curve is built once, with the final interpolation method and tube radius
+    with self.cmLogic.batchUpdate():
+      self.cmLogic.DestinationNode = self._curveModel
+      self.cmLogic.SourceNode = self.curveFiducials
+      self.cmLogic.enableAutomaticUpdate(1)
+      self.cmLogic.setInterpolationMethod(1)
+      self.cmLogic.setTubeRadius(self.tubeRadius)
 
     self.tagSourceNode = self.cmLogic.SourceNode.AddObserver('ModifiedEvent', self.onLineSourceUpdated)
 
@@ -2301,11 +2230,13 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
 
 
     ##Path Planning variables
-    self.PercutaneousApproachAnalysisLogic = PercutaneousApproachAnalysisLogic()
-    self.cylinderMiddlePointNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLMarkupsFiducialNode")
-    self.synthesizedData = vtk.vtkPolyData()
+    self.candidateEntryPoints = None
     ##
     self.pathReceived = None
+    self.candidatePaths = None
+    # reference curves of both hemispheres, valid for referenceCurveKey
+    self.referenceCurveKey = None
+    self.referenceCurves = {}
     self.pathCandidatesModel = None
     self.pathNavigationModel = None
     self.cylinderInteractor = None
@@ -2316,6 +2247,26 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
 
     self.distanceMapFilter = sitk.SignedMaurerDistanceMapImageFilter()
     self.distanceMapFilter.SquaredDistanceOff()
+    # check the vessel clearance by sampling the in-memory distance map instead of ray casting the margin model.
+    # The map is sampled every half voxel and clamped at the image border, so the accepted paths can differ slightly
+    # from the ray casting, off until both have been compared on clinical cases
+    self.useDistanceFieldCollision = False
+    # the distance map is only computed in a band of venousMargin around the vessels, clearances beyond it saturate.
+    # The distance field of the collision test is also restricted to the box of the candidate cone
+    self.useNarrowBandVenousDistance = False
+    # target reduction of the triangles of the vessel margin model
+    self.marginModelDecimation = 0.25
+    self.venousDistanceField = None
+    # RAS box covered by the narrow band distance field, None when it covers the whole band
+    self.venousDistanceFieldBounds = None
+    self.pathClearance = None
+    # adaptive candidate search: coarse grid 2**candidateCoarseLevel times the full resolution, refined up to
+    # candidateRefinementBudget evaluated entry points
+    self.useAdaptiveCandidateSearch = False
+    self.candidateCoarseLevel = 3
+    self.candidateRefinementBudget = 3000
+    # reference and planning curves follow geodesics on the skull model instead of plane cuts
+    self.useGeodesicReference = False
     self.thresholdProgressiveFactor = 0.2
     self.addImageFilter = sitk.AddImageFilter()
     self.statsFilter = sitk.LabelStatisticsImageFilter()
@@ -2326,6 +2277,7 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
     self.holeFilledImageNode = None
     self.subtractedImageNode = None
     self.functions = UsefulFunctions()
+    self.engine = self.functions.engine
     self.useLeftHemisphere = False
     self.cliNode = None
     self.samplingFactor = 2
@@ -2335,6 +2287,8 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
     #self.morphologyParameters = [[10,10,6], [3,3,1]]
     #self.morphologyParameters = [[1,1,1], [10,10,5]]
     self.morphologyParameters = [[1,1,1], [4,4,4]]
+    # the skull morphology only runs inside the bounding box of the head
+    self.restrictMorphologyToHead = False
     self.distanceMapThreshold = 100
     self.venousMargin = 5.0 #in mm
     self.minimalVentricleLen = 5.0 # in mm
@@ -2356,6 +2310,15 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
     self.entryRadius = 25.0
     self.transform = vtk.vtkTransform()
     self.placeWidget = slicer.qSlicerMarkupsPlaceWidget()
+    # cannula drag events are coalesced to the display refresh rate, latencies of the last updates are kept in ms
+    self.cannulaUpdateInterval = 16
+    self.cannulaUpdateTimer = qt.QTimer()
+    self.cannulaUpdateTimer.setSingleShot(True)
+    self.cannulaUpdateTimer.setInterval(self.cannulaUpdateInterval)
+    self.cannulaUpdateTimer.connect('timeout()', self.flushCannulaUpdate)
+    self.pendingCannulaNode = None
+    self.isUpdatingCannula = False
+    self.cannulaUpdateLatencies = []
     self.interactionMode = EndPlacementModes.NotSpecifiedMode
     
     self.guideHoleDiameter = 5.0
@@ -2456,6 +2419,14 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
     self.ventricleVolume = None
     self.venousMedianValue = -10000
     self.venousMaxValue = -10000
+    self.engine.locatorCache.clear()
+    self.functions.imagePyramid.clear()
+    self.functions.volumeAccess.clear()
+    self.venousDistanceField = None
+    self.pathClearance = None
+    self.candidatePaths = None
+    self.referenceCurveKey = None
+    self.referenceCurves = {}
 
   def appendPlanningTimeStampToJson(self, JSONFile, parameterName, value):
     data = {}
@@ -2510,6 +2481,28 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
       return False
     return True
 
+  @contextmanager
+  def batchMarkupEdits(self, markupNodes, detachedObservers=()):
+    """
+    Group the bulk edits of markupNodes done in the with block. The nodes stay in StartModify state while the
+    block runs, so MRML queues their Modified, PointModified and MarkupAdded events and fires each of them once
+    at EndModify. The (event, handler) observers of detachedObservers are removed for the batch and added back
+    after EndModify, so they do not receive the consolidated events either.
+    """
+    markupNodes = [node for node in markupNodes if node]
+    for node in markupNodes:
+      for event, handler in detachedObservers:
+        node.RemoveObservers(event)
+    modifyStates = [node.StartModify() for node in markupNodes]
+    try:
+      yield
+    finally:
+      for node, wasModifying in zip(markupNodes, modifyStates):
+        node.EndModify(wasModifying)
+      for node in markupNodes:
+        for event, handler in detachedObservers:
+          node.AddObserver(event, handler)
+
   def lockReferenceLine(self):
     self.sagittalReferenceCurveManager.lockLine()
     self.coronalReferenceCurveManager.lockLine()
@@ -2520,7 +2513,13 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
 
   def getOrCreateHoleSkullVolumeNode(self):
     if (self.holeFilledImageNode is None) or (self.subtractedImageNode is None):
-      self.holeFilledImageNode, self.subtractedImageNode = self.functions.createHoleFilledVolumeNode2(self.ventricleVolume, self.surfaceModelThreshold, self.samplingFactor, self.morphologyParameters)
+      self.holeFilledImageNode, self.subtractedImageNode = self.functions.createHoleFilledVolumeNode2(self.ventricleVolume, self.surfaceModelThreshold, self.samplingFactor,
+                                                                                                     self.morphologyParameters, self.restrictMorphologyToHead)
+      peakName = "peak" if self.functions.morphologyPeakPerStage else "process peak"
+      for stage, imageBytes, startBytes, peakBytes, endBytes in self.functions.morphologyMemoryReport:
+        logging.info("Skull morphology %s: image %.1f MB, resident memory %s" % (stage, imageBytes / 1048576.0,
+                     "%.1f MB to %.1f MB, %s %.1f MB" % (startBytes / 1048576.0, endBytes / 1048576.0, peakName, peakBytes / 1048576.0)
+                     if startBytes and peakBytes and endBytes else "unknown"))
     return self.holeFilledImageNode, self.subtractedImageNode
 
   def startEditPlanningTarget(self):
@@ -2597,6 +2596,104 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
   def endEditTrajectory(self):
     self.cylinderManager.endEditLine()
 
+  def calculateVenousClearanceImage(self, connectedImageNode, bounds=None):
+    # signed distance to the vessels, negative inside of them. The narrow band is restricted to the RAS bounds if given
+    connectedImage = self.functions.volumeAccess.getImage(connectedImageNode, sitk.sitkInt8)
+    if self.useNarrowBandVenousDistance:
+      # the band is padded where it reaches beyond the volume
+      return self.functions.getNarrowBandDistanceMap(connectedImage, self.distanceMapFilter, self.venousMargin, bounds)
+    # padding is necessary, because some venous could be very close to the volume boundary. Which causes distance map to be incomplete at the coundary.
+    # In the end, the incomplete distance map will create holes in the venous margin model
+    padFilter = sitk.ConstantPadImageFilter()
+    padFilter.SetPadLowerBound([int(self.venousMargin), int(self.venousMargin), int(self.venousMargin)])
+    padFilter.SetPadUpperBound([int(self.venousMargin), int(self.venousMargin), int(self.venousMargin)])
+    paddedImage = padFilter.Execute(connectedImage)
+    return self.distanceMapFilter.Execute(paddedImage)
+
+  def getConnectedImageNode(self):
+    imageCollection = slicer.mrmlScene.GetNodesByClassByName("vtkMRMLLabelMapVolumeNode", "connectedImage")
+    if imageCollection:
+      return imageCollection.GetItemAsObject(0)
+    return None
+
+  def getVenousDistanceField(self, bounds=None):
+    """
+    Distance field of the vessels, rebuilt from the connected image when it is not in memory, e.g. after loading a case.
+    The narrow band field covers the RAS bounds [lower, upper] it was requested for, it is rebuilt for the box of both
+    when bounds reach beyond them, and for the whole band when bounds is None.
+    """
+    if self.useNarrowBandVenousDistance and (self.venousDistanceField is not None) and (self.venousDistanceFieldBounds is not None):
+      fieldBounds = self.venousDistanceFieldBounds
+      if bounds is None or (bounds[0] < fieldBounds[0]).any() or (bounds[1] > fieldBounds[1]).any():
+        self.venousDistanceField = None
+        if bounds is not None:
+          bounds = numpy.array([numpy.minimum(bounds[0], fieldBounds[0]), numpy.maximum(bounds[1], fieldBounds[1])])
+    if self.venousDistanceField is None:
+      connectedImageNode = self.getConnectedImageNode()
+      if connectedImageNode and connectedImageNode.GetImageData():
+        fieldBounds = bounds if self.useNarrowBandVenousDistance else None
+        try:
+          self.venousDistanceField = DistanceField.fromImage(self.calculateVenousClearanceImage(connectedImageNode, fieldBounds))
+          self.venousDistanceFieldBounds = fieldBounds
+        except ValueError:
+          self.venousDistanceField = None
+    return self.venousDistanceField
+
+  def planCandidatePaths(self):
+    """
+    Candidate paths of the current case, see PlanningEngine.planCandidatePaths. The landmarks, the skull model and the
+    vessel margin model or distance field are read from the scene, the entry points and the candidate path table are
+    kept in candidateEntryPoints and candidatePaths and the paths meeting all the conditions are shown in
+    pathCandidatesModel. Returns the number of collision free paths and the CandidatePathStatus of setCandidatePaths,
+    or None when the landmarks, the models or the Kocher point are missing.
+    """
+    if not self.baseVolumeNode:
+      return None
+    positions = []
+    for attribute in ("vtkMRMLScalarVolumeNode.rel_target", "vtkMRMLScalarVolumeNode.rel_distal", "vtkMRMLScalarVolumeNode.rel_nasion"):
+      node = slicer.mrmlScene.GetNodeByID(self.baseVolumeNode.GetAttribute(attribute)) if self.baseVolumeNode.GetAttribute(attribute) else None
+      if not (node and node.GetNumberOfFiducials()):
+        return None
+      position = numpy.array([0.0, 0.0, 0.0])
+      node.GetNthFiducialPosition(0, position)
+      positions.append(position)
+    posTarget, posDistal, posNasion = positions
+    modelID = self.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_model")
+    inputModelNode = slicer.mrmlScene.GetNodeByID(modelID) if modelID else None
+    numOfRef = self.coronalReferenceCurveManager.curveFiducials.GetNumberOfFiducials()
+    if not (inputModelNode and inputModelNode.GetPolyData()) or numOfRef < 1:
+      return None
+    if self.trajectoryProjectedMarker.GetNumberOfFiducials() == 0:
+      self.trajectoryProjectedMarker.AddFiducial(0,0,0)
+    posKocher = [0.0, 0.0, 0.0]
+    self.coronalReferenceCurveManager.curveFiducials.GetNthFiducialPosition(numOfRef-1, posKocher)
+    vesselModelWithMarginNodeID = self.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_vesselnessWithMarginModel")
+    vesselModelWithMarginNode = slicer.mrmlScene.GetNodeByID(vesselModelWithMarginNodeID) if vesselModelWithMarginNodeID else None
+    vesselPolyData = vesselModelWithMarginNode.GetPolyData() if vesselModelWithMarginNode else None
+    distanceField = None
+    if self.useDistanceFieldCollision:
+      bounds = None
+      if self.useNarrowBandVenousDistance:
+        bounds = self.engine.getCandidateConeBounds(inputModelNode.GetPolyData(), posTarget, posDistal, self.cylinderRadius,
+                                                      radiusResolution=1.0)
+      distanceField = self.getVenousDistanceField(bounds)
+    # Increase the resolutions to reduce the candidates generated
+    candidates = self.engine.planCandidatePaths(inputModelNode.GetPolyData(), posNasion, posTarget, posDistal, posKocher, vesselPolyData,
+                                                distanceField, self.cylinderRadius, self.posteriorMargin, self.kocherMargin, self.venousMargin,
+                                                radiusResolution=1.0, phiResolution=1*numpy.pi/180.0, adaptiveSearch=self.useAdaptiveCandidateSearch,
+                                                coarseLevel=self.candidateCoarseLevel, refinementBudget=self.candidateRefinementBudget)
+    if candidates is None:
+      return None
+    logging.debug("Candidate search evaluated %d entry points" % len(candidates["entryPoints"]))
+    self.entryRadius = candidates["entryRadius"]
+    self.candidateEntryPoints = candidates["entryPoints"]
+    candidatePaths = candidates["candidatePaths"]
+    self.pathClearance = None if distanceField is None else candidatePaths["clearance"]
+    if not self.pathCandidatesModel.GetPolyData():
+      self.pathCandidatesModel.SetAndObservePolyData(vtk.vtkPolyData())
+    status = self.setCandidatePaths(candidatePaths, self.pathCandidatesModel.GetPolyData())
+    return int(((candidatePaths["feasibility"] & CandidatePathFeasibility.CollisionFree) > 0).sum()), status
+
   # connectedImage should be the image of the vessels, and it is in turn padded with the venousMargin
   def calculateConnectedCompWithMargin(self):
     marginNodeID = self.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_vesselnessWithMarginModel")
@@ -2610,30 +2707,18 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
         slicer.util.warningDisplay("vessel was not segmented yet, abort current procedure")
         return None
       if marginNode and (marginNode.GetAttribute("vtkMRMLModelNode.modelCreated") == "False"):
-        connectedImage = sitk.Cast(sitkUtils.PullFromSlicer(connectedImageNode.GetID()), sitk.sitkInt8)
-        # padding is necessary, because some venous could be very close to the volume boundary. Which causes distance map to be incomplete at the coundary.
-        # In the end, the incomplete distance map will create holes in the venous margin model
-        padFilter = sitk.ConstantPadImageFilter()
-        padFilter.SetPadLowerBound([int(self.venousMargin), int(self.venousMargin), int(self.venousMargin)])
-        padFilter.SetPadUpperBound([int(self.venousMargin), int(self.venousMargin), int(self.venousMargin)])
-        paddedImage = padFilter.Execute(connectedImage)
         try:
-          distanceMap = sitk.Multiply(self.distanceMapFilter.Execute(paddedImage),-1)
+          clearanceImage = self.calculateVenousClearanceImage(connectedImageNode)
         except ValueError:
           slicer.util.warningDisplay("distance map calucation failed, try use different settings")
           return None
-        sitkUtils.PushToSlicer(distanceMap, "distanceMap", 0, True)
-        imageCollection = slicer.mrmlScene.GetNodesByClassByName("vtkMRMLScalarVolumeNode", "distanceMap")
-        if imageCollection:
-          distanceMapNode = imageCollection.GetItemAsObject(0)
-          parameters = {}
-          parameters["InputVolume"] = distanceMapNode.GetID()
-          parameters["OutputGeometry"] = marginNode.GetID()
-          parameters["Threshold"] = -self.venousMargin
-          grayMaker = slicer.modules.grayscalemodelmaker
-          self.cliNode = slicer.cli.run(grayMaker, None, parameters, wait_for_completion=True)
-          self.baseVolumeNode.SetAttribute("vtkMRMLScalarVolumeNode.rel_vesselnessWithMarginModel", marginNode.GetID())
-          marginNode.SetAttribute("vtkMRMLModelNode.modelCreated", "True")
+        # the float copy is only kept for the distance field collisions, getVenousDistanceField builds it on demand otherwise
+        self.venousDistanceField = DistanceField.fromImage(clearanceImage) if self.useDistanceFieldCollision else None
+        self.venousDistanceFieldBounds = None
+        # the margin model is still generated for display
+        self.functions.createIsoSurfaceModel(clearanceImage, self.venousMargin, marginNode, self.marginModelDecimation)
+        self.baseVolumeNode.SetAttribute("vtkMRMLScalarVolumeNode.rel_vesselnessWithMarginModel", marginNode.GetID())
+        marginNode.SetAttribute("vtkMRMLModelNode.modelCreated", "True")
         self.update_observers(VentriculostomyUserEvents.SetSliceViewerEvent)  
     return marginNode
 
@@ -2648,13 +2733,7 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
         targetNode.GetNthFiducialPosition(0, posTarget)
         posDistal = numpy.array([0.0, 0.0, 0.0])
         distalNode.GetNthFiducialPosition(0, posDistal)
-        cylinderDirection = (numpy.array(posDistal) - numpy.array(posTarget)) / numpy.linalg.norm(
-          numpy.array(posTarget) - numpy.array(posDistal))
-        angle = math.acos(numpy.dot(numpy.array([0, 0, 1.0]), cylinderDirection))
-        rotationAxis = numpy.cross(numpy.array([0, 0, 1.0]), cylinderDirection)
-        self.transform.Identity()
-        self.transform.RotateWXYZ(angle * 180.0 / numpy.pi, rotationAxis[0], rotationAxis[1], rotationAxis[2])
-        return self.transform
+        return self.engine.getAxisTransform(posTarget, posDistal, self.transform)
     return None
 
   def calculateCannulaTransform(self):
@@ -2666,131 +2745,31 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
         cannulaNode.GetNthFiducialPosition(0, posTarget)
         posEntry = numpy.array([0.0, 0.0, 0.0])
         cannulaNode.GetNthFiducialPosition(1, posEntry)
-        cannulaDirection = (numpy.array(posEntry) - numpy.array(posTarget)) / numpy.linalg.norm(
-          numpy.array(posTarget) - numpy.array(posEntry))
-        angle = math.acos(numpy.dot(numpy.array([0, 0, 1.0]), cannulaDirection))
-        rotationAxis = numpy.cross(numpy.array([0, 0, 1.0]), cannulaDirection)
-        transform = vtk.vtkTransform()
-        transform.Identity()
-        transform.RotateWXYZ(angle * 180.0 / numpy.pi, rotationAxis[0], rotationAxis[1], rotationAxis[2])
-        return transform
+        return self.engine.getAxisTransform(posTarget, posEntry)
     return None
 
-  def makeNavigationLines(self, path, approachablePoints, polyData):
-    points = vtk.vtkPoints()
-    polyData.SetPoints(points)
-
-    lines = vtk.vtkCellArray()
-    polyData.SetLines(lines)
-    linesIDArray = lines.GetData()
-    linesIDArray.Reset()
-    linesIDArray.InsertNextTuple1(0)
-
-    polygons = vtk.vtkCellArray()
-    polyData.SetPolys(polygons)
-    idArray = polygons.GetData()
-    idArray.Reset()
-    idArray.InsertNextTuple1(0)
-
-    if approachablePoints != 0:
-      for point in path:
-        pointIndex = points.InsertNextPoint(*point)
-        linesIDArray.InsertNextTuple1(pointIndex)
-        linesIDArray.SetTuple1(0, linesIDArray.GetNumberOfTuples() - 1)
-        lines.SetNumberOfCells(1)
-    # Create model node
-    pass
-  
-  def createCandidatesWithinKocherPoint(self, entryPoints, posCenter, polyData, posKocher, surfacePolyData):
-    points = vtk.vtkPoints()
-    polyData.SetPoints(points)
-
-    lines = vtk.vtkCellArray()
-    polyData.SetLines(lines)
-    linesIDArray = lines.GetData()
-    linesIDArray.Reset()
-    linesIDArray.InsertNextTuple1(0)
-
-    polygons = vtk.vtkCellArray()
-    polyData.SetPolys(polygons)
-    idArray = polygons.GetData()
-    idArray.Reset()
-    idArray.InsertNextTuple1(0)
-
-    locator = vtk.vtkCellLocator()
-    locator.SetDataSet(surfacePolyData)
-    locator.BuildLocator()
-    t = vtk.mutable(0)
-    x = [0.0, 0.0, 0.0]
-    pcoords = [0.0, 0.0, 0.0]
-    subId = vtk.mutable(0)
-    for pointIndex in range(entryPoints.GetNumberOfPoints()):
-        hasIntersection = locator.IntersectWithLine(entryPoints.GetPoint(pointIndex), posCenter, 1e-2, t, x,
-                                                  pcoords, subId)
-        if (hasIntersection > 0) and numpy.linalg.norm(numpy.array(x)-numpy.array(posKocher)) < self.kocherMargin:
-          index = points.InsertNextPoint(*posCenter)
-          linesIDArray.InsertNextTuple1(index)
-          linesIDArray.SetTuple1(0, linesIDArray.GetNumberOfTuples() - 1)
-          lines.SetNumberOfCells(1)
-          point = entryPoints.GetPoint(pointIndex)
-          index = points.InsertNextPoint(*point)
-          linesIDArray.InsertNextTuple1(index)
-          linesIDArray.SetTuple1(0, linesIDArray.GetNumberOfTuples() - 1)
-          lines.SetNumberOfCells(1)
-    # Create model node
-    pass
-
-  def makePathMeetAllConditions(self, path, approachablePoints, polyData, posKocher, posNasion, surfacePolyData):
-
-    trimmedPath = []
-    points = vtk.vtkPoints()
-    polyData.SetPoints(points)
-
-    lines = vtk.vtkCellArray()
-    polyData.SetLines(lines)
-    linesIDArray = lines.GetData()
-    linesIDArray.Reset()
-    linesIDArray.InsertNextTuple1(0)
-
-    polygons = vtk.vtkCellArray()
-    polyData.SetPolys(polygons)
-    idArray = polygons.GetData()
-    idArray.Reset()
-    idArray.InsertNextTuple1(0)
-
-    locator = vtk.vtkCellLocator()
-    locator.SetDataSet(surfacePolyData)
-    locator.BuildLocator()
-    t = vtk.mutable(0)
-    x = [0.0, 0.0, 0.0]
-    pcoords = [0.0, 0.0, 0.0]
-    subId = vtk.mutable(0)
-    numOfRef = self.coronalReferenceCurveManager.curveFiducials.GetNumberOfFiducials()
-    hasPosteriorPoints = False
-    hasWithinKocherPoints = False
-    if approachablePoints != 0 and numOfRef >=1:
-      for pointIndex in range(1, len(path), 2):
-          hasIntersection = locator.IntersectWithLine(path[pointIndex], path[pointIndex - 1], 1e-2, t, x, pcoords, subId)
-          isPosteriorEnough = (abs(x[2] - posNasion[2]) > self.posteriorMargin)
-          #isPosteriorEnough = (abs(x[1] - posNasion[1]) > self.posteriorMargin)
-          isWithinKocherMargin = (numpy.linalg.norm(numpy.array(x) - numpy.array(posKocher)) < self.kocherMargin)
-          if (hasIntersection > 0) and isPosteriorEnough and isWithinKocherMargin:
-            pointPre = path[pointIndex - 1]
-            index = points.InsertNextPoint(*pointPre)
-            linesIDArray.InsertNextTuple1(index)
-            linesIDArray.SetTuple1(0, linesIDArray.GetNumberOfTuples() - 1)
-            lines.SetNumberOfCells(1)
-            point = path[pointIndex]
-            index = points.InsertNextPoint(*point)
-            linesIDArray.InsertNextTuple1(index)
-            linesIDArray.SetTuple1(0, linesIDArray.GetNumberOfTuples() - 1)
-            lines.SetNumberOfCells(1)
-            trimmedPath.append(path[pointIndex - 1])
-            trimmedPath.append(path[pointIndex])
-          hasPosteriorPoints = isPosteriorEnough if hasPosteriorPoints == False else hasPosteriorPoints
-          hasWithinKocherPoints = isWithinKocherMargin if hasWithinKocherPoints == False else hasWithinKocherPoints
-    self.pathReceived = trimmedPath
-    self.nPathReceived = int(len(trimmedPath)/2)
+  def setCandidatePaths(self, candidatePaths, polyData):
+    """
+    Keep the candidate path table, show the paths meeting all the conditions in polyData and return the
+    CandidatePathStatus of the collision free paths.
+    """
+    self.candidatePaths = candidatePaths
+    if candidatePaths is None:
+      candidatePaths = numpy.zeros(0, dtype=self.engine.candidatePathDtype)
+    collisionFree = candidatePaths[(candidatePaths["feasibility"] & CandidatePathFeasibility.CollisionFree) > 0]
+    isPosteriorEnough = (collisionFree["feasibility"] & CandidatePathFeasibility.PosteriorEnough) > 0
+    isWithinKocherMargin = (collisionFree["feasibility"] & CandidatePathFeasibility.WithinKocherMargin) > 0
+    accepted = collisionFree[isPosteriorEnough & isWithinKocherMargin]
+    if self.pathClearance is not None:
+      self.pathClearance = accepted["clearance"]
+    acceptedPaths = numpy.empty((len(accepted), 2, 3))
+    acceptedPaths[:, 0, :] = accepted["target"]
+    acceptedPaths[:, 1, :] = accepted["entry"]
+    self.engine.setLineSegments(polyData, acceptedPaths)
+    self.pathReceived = [tuple(point) for point in acceptedPaths.reshape(-1, 3)]
+    self.nPathReceived = len(acceptedPaths)
+    hasPosteriorPoints = bool(isPosteriorEnough.any())
+    hasWithinKocherPoints = bool(isWithinKocherMargin.any())
     if  hasPosteriorPoints == False and hasWithinKocherPoints == False:
       return CandidatePathStatus.NoPosteriorAndNoWithinKocherPoint
     elif  hasPosteriorPoints == False:
@@ -2798,6 +2777,13 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
     elif  hasWithinKocherPoints == False:
       return CandidatePathStatus.NoWithinKocherPoint
 
+  def getTopCandidatePaths(self, k=1, column="distanceToKocher", largestFirst=False, feasibility=CandidatePathFeasibility.All):
+    """
+    Return the k best rows of candidatePaths ranked by column, best first, among the paths having all the feasibility bits.
+    e.g. getTopCandidatePaths(5, "clearance", largestFirst=True) gives the five paths furthest away from the vessels.
+    """
+    return self.engine.getTopCandidatePaths(self.candidatePaths, k, column, largestFirst, feasibility)
+
   def relocateCannula(self, optimizationMethod=1):
     if self.pathReceived:
       #self.cannulaManager.curveFiducials.RemoveAllMarkups()
@@ -2809,13 +2795,10 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
       angleCalc =numpy.pi
       if optimizationMethod == 0: # the cannula is relocated so that its direction is closer to the ventricle center
         optimizedEntry = numpy.array([])
-        for pointIndex in range(1, len(self.pathReceived),2):
-          direction2 = numpy.array(self.pathReceived[pointIndex]) - numpy.array(self.pathReceived[pointIndex-1])
-          direction2Norm = direction2/numpy.linalg.norm(direction2)
-          angle = math.acos(numpy.dot(direction1Norm, direction2Norm))
-          if angle < angleCalc:
-            angleCalc = angle
-            optimizedEntry = numpy.array(self.pathReceived[pointIndex])
+        bestPaths = self.getTopCandidatePaths(1, "angleToVentricleAxis")
+        if len(bestPaths) and bestPaths["angleToVentricleAxis"][0] < angleCalc:
+          angleCalc = bestPaths["angleToVentricleAxis"][0]
+          optimizedEntry = bestPaths["entry"][0]
         if optimizedEntry.any():
           posEntry = numpy.array([0.0] * 3)
           self.trajectoryProjectedMarker.GetNthFiducialPosition(0, posEntry)
@@ -2830,34 +2813,21 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
         if inputModelNodeID:
           inputModelNode = slicer.mrmlScene.GetNodeByID(inputModelNodeID) 
           if (inputModelNode.GetAttribute("vtkMRMLModelNode.modelCreated") == "True"):
-            polyData = inputModelNode.GetPolyData()
-            locator = vtk.vtkCellLocator()
-            locator.SetDataSet(polyData)
-            locator.BuildLocator()
-            t = vtk.mutable(0)
-            x = [0.0,0.0,0.0]
-            pcoords = [0.0,0.0,0.0]
-            subId = vtk.mutable(0)
             numOfRef = self.coronalReferenceCurveManager.curveFiducials.GetNumberOfFiducials()
-            distanceMin = 1e20
-            minIndex = 1
             if numOfRef >= 1:
-              posKocher = [0.0,0.0,0.0]
-              self.coronalReferenceCurveManager.curveFiducials.GetNthFiducialPosition(numOfRef-1,posKocher)
-              for pointIndex in range(1, len(self.pathReceived),2):
-                hasIntersection = locator.IntersectWithLine(self.pathReceived[pointIndex], self.pathReceived[pointIndex-1], 1e-2, t, x, pcoords, subId)
-                if hasIntersection>0:
-                  if distanceMin > numpy.linalg.norm(numpy.array(posKocher)-numpy.array(x)):
-                    distanceMin = numpy.linalg.norm(numpy.array(posKocher)-numpy.array(x))
-                    minIndex = pointIndex
+              bestPaths = self.getTopCandidatePaths(1, "distanceToKocher")
+              if len(bestPaths):
+                posPathTarget, posPathEntry = bestPaths["target"][0], bestPaths["entry"][0]
+              else:
+                posPathTarget, posPathEntry = numpy.array(self.pathReceived[0]), numpy.array(self.pathReceived[1])
               self.cannulaManager.curveFiducials.RemoveAllMarkups()
               self.cannulaManager.curveFiducials.AddFiducial(0, 0, 0)
               self.cannulaManager.curveFiducials.AddFiducial(0, 0, 0)
-              self.cannulaManager.curveFiducials.SetNthFiducialPositionFromArray(0, self.pathReceived[minIndex-1])
-              self.cannulaManager.curveFiducials.SetNthFiducialPositionFromArray(1, self.pathReceived[minIndex])
-              direction2 = numpy.array(self.pathReceived[minIndex]) - numpy.array(self.pathReceived[minIndex-1])
+              self.cannulaManager.curveFiducials.SetNthFiducialPositionFromArray(0, posPathTarget)
+              self.cannulaManager.curveFiducials.SetNthFiducialPositionFromArray(1, posPathEntry)
+              direction2 = posPathEntry - posPathTarget
               direction2Norm = direction2/numpy.linalg.norm(direction2)
-              angleCalc = math.acos(numpy.dot(direction1Norm, direction2Norm))
+              angleCalc = math.acos(numpy.clip(numpy.dot(direction1Norm, direction2Norm), -1.0, 1.0))
       self.activeTrajectoryMarkup = 1
       self.updateCannulaPosition(self.cannulaManager.curveFiducials)
       posProject =  numpy.array([0.0] * 3)
@@ -2884,13 +2854,7 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
   def calculateVenousStat(self, venousVolume, thresholdValue):
     if float(venousVolume.GetAttribute("vtkMRMLScalarVolumeNode.rel_venousMedianValue")) < self.surfaceModelThreshold \
         or float(venousVolume.GetAttribute("vtkMRMLScalarVolumeNode.rel_venousMaxValue")) < self.surfaceModelThreshold:
-      venousImage = sitk.Cast(sitkUtils.PullFromSlicer(venousVolume.GetID()), sitk.sitkInt16)
-      resampleFilter = sitk.ResampleImageFilter()
-      resampleFilter.SetSize(numpy.array(venousImage.GetSize()) / self.samplingFactor)
-      resampleFilter.SetOutputSpacing(numpy.array(venousImage.GetSpacing()) * self.samplingFactor)
-      resampleFilter.SetOutputDirection(venousImage.GetDirection())
-      resampleFilter.SetOutputOrigin(numpy.array(venousImage.GetOrigin()))
-      resampledVenousImage = resampleFilter.Execute(venousImage)
+      resampledVenousImage = self.functions.imagePyramid.getImage(venousVolume, self.samplingFactor, antiAlias=False)
       thresholdFilter = sitk.BinaryThresholdImageFilter()
       thresholdImage = thresholdFilter.Execute(resampledVenousImage, thresholdValue, 10000, 1, 0)
       self.statsFilter.Execute(resampledVenousImage, thresholdImage)
@@ -2936,19 +2900,12 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
         dir_path = os.path.dirname(os.path.realpath(__file__))
 
         # Strip skull from image
-        skullRemoval = slicer.modules.skullremoval
-        skullRemovalWidget = skullRemoval.widgetRepresentation().self()
-        skullRemovalWidget.nodeSelector.currentNodeID = inputVolumeNode.GetID()
-        skullRemovalWidget.labelmapCheckBox.setCheckState(0)
-        skullRemovalWidget.marginBox.value = 3.0
-        skullRemovalWidget.onApply()
+        skullStrippedImage, skullMask = SkullRemovalLogic().removeSkull(self.functions.volumeAccess.getImage(inputVolumeNode), 3.0)
 
         # Save for NiftyNet
-        skullStrippedVolumeNode = slicer.mrmlScene.GetNodesByClassByName("vtkMRMLScalarVolumeNode", "Cropped_volume_sub").GetItemAsObject(0)
         skullStrippedSavePath = dir_path + "\\NiftyNet\\brainVolume.nii.gz"
-        slicer.util.saveNode(skullStrippedVolumeNode, skullStrippedSavePath)
+        sitk.WriteImage(skullStrippedImage, skullStrippedSavePath)
         slicer.app.processEvents()
-        time.sleep(3)
 
         # Run NiftyNet segmentation
         batchDir = dir_path + "\\NiftyNet\\RunSegmentation.bat"
@@ -2978,31 +2935,21 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
     if imageCollection:
       connectedImageNode = imageCollection.GetItemAsObject(0)
       slicer.mrmlScene.RemoveNode(connectedImageNode)
+    self.venousDistanceField = None
     connectedImageNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLLabelMapVolumeNode")
     connectedImageNode.SetName("connectedImage")
     slicer.mrmlScene.AddNode(connectedImageNode)
-    labelMapBinning = slicer.modules.labelmapbinning
-    labelMapBinningWidget = labelMapBinning.widgetRepresentation().self()
-    labelMapBinningWidget.nodeSelector.currentNodeID = segmentedNode.GetID()
-    labelMapBinningWidget.newNodeSelector.currentNodeID = connectedImageNode.GetID()
-    labelMapBinningWidget.lowLabelSpinBox.setValue(1)
-    labelMapBinningWidget.thresholdSpinBox.setValue(self.labelMapThreshold)
-    #labelMapBinningWidget.thresholdSpinBox.setValue(-0.02)
-    labelMapBinningWidget.highLabelSpinBox.setValue(0)
-    labelMapBinningWidget.onApply()
+    LabelMapBinningLogic().binVolume(segmentedNode, connectedImageNode, [self.labelMapThreshold], [1, 0])
 
     # Create vessel model
-    imageCollection = slicer.mrmlScene.GetNodesByClassByName("vtkMRMLScalarVolumeNode", "connectedImage")
-    if imageCollection:
-      connectedImageNode = imageCollection.GetItemAsObject(0)
-      parameters = {}
-      parameters["InputVolume"] = connectedImageNode.GetID()
-      parameters["OutputGeometry"] = vesselnessModelNode.GetID()
-      parameters["Threshold"] = 0.5
-      grayMaker = slicer.modules.grayscalemodelmaker
-      self.cliNode = slicer.cli.run(grayMaker, None, parameters, wait_for_completion=True)
-      self.baseVolumeNode.SetAttribute("vtkMRMLScalarVolumeNode.rel_vesselnessModel", vesselnessModelNode.GetID())
-      vesselnessModelNode.SetAttribute("vtkMRMLModelNode.modelCreated", "True")
+    parameters = {}
+    parameters["InputVolume"] = connectedImageNode.GetID()
+    parameters["OutputGeometry"] = vesselnessModelNode.GetID()
+    parameters["Threshold"] = 0.5
+    grayMaker = slicer.modules.grayscalemodelmaker
+    self.cliNode = slicer.cli.run(grayMaker, None, parameters, wait_for_completion=True)
+    self.baseVolumeNode.SetAttribute("vtkMRMLScalarVolumeNode.rel_vesselnessModel", vesselnessModelNode.GetID())
+    vesselnessModelNode.SetAttribute("vtkMRMLModelNode.modelCreated", "True")
 
   def enableRelatedVolume(self, attributeName, volumeName, visibility = True):
     volumeNode = None
@@ -3103,13 +3050,47 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
     self.activeTrajectoryMarkup = callData
     pass
   
+  def onCannulaPointModified(self, fiducicalMarkerNode, eventID = None):
+    # Events fired by the update itself (updateCannulaTargetPoint moves the target point) are dropped,
+    # the others only schedule one update for the next frame
+    if self.isUpdatingCannula:
+      return
+    self.pendingCannulaNode = fiducicalMarkerNode
+    if not self.cannulaUpdateTimer.isActive():
+      self.cannulaUpdateTimer.start()
+
+  def flushCannulaUpdate(self):
+    self.cannulaUpdateTimer.stop()
+    fiducicalMarkerNode = self.pendingCannulaNode
+    self.pendingCannulaNode = None
+    if fiducicalMarkerNode is None:
+      return
+    startTime = time.time()
+    self.isUpdatingCannula = True
+    try:
+      self.updateCannulaPosition(fiducicalMarkerNode)
+    finally:
+      self.isUpdatingCannula = False
+    latency = (time.time() - startTime) * 1000.0
+    self.cannulaUpdateLatencies.append(latency)
+    del self.cannulaUpdateLatencies[:-100]
+    if latency > self.cannulaUpdateInterval:
+      logging.debug("Cannula update took %.1f ms, longer than the %d ms frame budget" % (latency, self.cannulaUpdateInterval))
+
+  def getCannulaUpdateLatency(self):
+    # mean and maximum latency in ms of the recent cannula updates
+    if not self.cannulaUpdateLatencies:
+      return 0.0, 0.0
+    return float(numpy.mean(self.cannulaUpdateLatencies)), float(numpy.max(self.cannulaUpdateLatencies))
+
   def updateCannulaPosition(self, fiducicalMarkerNode, eventID = None):
     inputModelNodeID =  self.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_model")
     if inputModelNodeID and self.activeTrajectoryMarkup == 1:
       inputModelNode = slicer.mrmlScene.GetNodeByID(inputModelNodeID)
       if (inputModelNode.GetAttribute("vtkMRMLModelNode.modelCreated") == "True"):
-        self.trajectoryProjectedMarker.RemoveAllMarkups()
-        self.trajectoryProjectedMarker.AddFiducial(0,0,0)
+        if self.trajectoryProjectedMarker.GetNumberOfFiducials() != 1:
+          self.trajectoryProjectedMarker.RemoveAllMarkups()
+          self.trajectoryProjectedMarker.AddFiducial(0,0,0)
         self.trajectoryProjectedMarker.GetMarkupsDisplayNode().SetVisibility(1)
         polyData = inputModelNode.GetPolyData()
         posFirst = [0.0,0.0,0.0]
@@ -3118,14 +3099,16 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
         fiducicalMarkerNode.GetNthFiducialPosition(1,posSecond)
         if fiducicalMarkerNode.GetNumberOfFiducials()>=2: #  self.activeTrajectoryMarkup == 0 means the target fiducial, 1 is the fiducial closer to the surface
           direction = numpy.array(posSecond)- numpy.array(posFirst)
-          locator = vtk.vtkCellLocator()
-          locator.SetDataSet(polyData)
-          locator.BuildLocator()
+          if numpy.linalg.norm(direction) > 0:
+            direction = direction/numpy.linalg.norm(direction)
+          # long enough for both ends to be outside of the model bounding box
+          rayLength = polyData.GetLength() + numpy.linalg.norm(numpy.array(posSecond) - numpy.array(polyData.GetCenter()))
+          locator = self.engine.locatorCache.getCellLocator(polyData)
           t = vtk.mutable(0)
           x = [0.0,0.0,0.0]
           pcoords = [0.0,0.0,0.0]
           subId = vtk.mutable(0)
-          hasIntersection = locator.IntersectWithLine( posSecond + 1e6*direction, posFirst -  1e6*direction, 1e-2, t, x, pcoords, subId)
+          hasIntersection = locator.IntersectWithLine( posSecond + rayLength*direction, posFirst -  rayLength*direction, 1e-2, t, x, pcoords, subId)
           if hasIntersection>0:
             self.trajectoryProjectedMarker.SetNthFiducialPositionFromArray(0,x)
             self.trajectoryProjectedMarker.SetNthFiducialLabel(0,"")
@@ -3166,6 +3149,11 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
     pass
     
   def endCannulaInteraction(self, fiducialNode, event=None):
+    self.flushCannulaUpdate()
+    if self.cannulaUpdateLatencies:
+      meanLatency, maxLatency = self.getCannulaUpdateLatency()
+      logging.info("Cannula drag updates: %d, mean latency %.1f ms, max latency %.1f ms" % (len(self.cannulaUpdateLatencies), meanLatency, maxLatency))
+      self.cannulaUpdateLatencies = []
     posEntry = [0.0, 0.0, 0.0]
     if (not self.trajectoryProjectedMarker.GetNthFiducialLabel(0) == "invalid") and self.trajectoryProjectedMarker.GetNumberOfFiducials():
       self.trajectoryProjectedMarker.GetNthFiducialPosition(0, posEntry)
@@ -3188,7 +3176,15 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
       nasionNode.GetNthFiducialPosition(0, posNasion)
       for index in range(1, self.trajectoryProjectedMarker.GetNumberOfFiducials()):
         self.trajectoryProjectedMarker.RemoveMarkup(index)
-      self.functions.calculateLineModelIntersect(polyData, posEntry, posTarget, self.trajectoryProjectedMarker)
+      trajectoryBounds = numpy.array([numpy.minimum(posEntry, posTarget), numpy.maximum(posEntry, posTarget)])
+      if self.useDistanceFieldCollision and self.getVenousDistanceField(trajectoryBounds):
+        crossings = self.venousDistanceField.segmentCrossings(posEntry, posTarget, self.venousMargin)
+        for posCrossing in crossings:
+          validPosIndex = self.trajectoryProjectedMarker.AddFiducial(posCrossing[0], posCrossing[1], posCrossing[2])
+          self.trajectoryProjectedMarker.SetNthFiducialLabel(validPosIndex, "")
+          self.trajectoryProjectedMarker.SetNthFiducialVisibility(validPosIndex, True)
+      else:
+        self.functions.calculateLineModelIntersect(polyData, posEntry, posTarget, self.trajectoryProjectedMarker)
       if self.trajectoryProjectedMarker.GetNumberOfFiducials()>1: # The intersection is not only the projected skull point
         slicer.util.warningDisplay("Within the margin area of the vessel")
       if abs(posEntry[2] - posNasion[2]) < self.posteriorMargin:
@@ -3390,59 +3386,23 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
         self.cylinderManager.onLineSourceUpdated()
     pass
       
-  def constructCurveReference(self, CurveManager,points, distance):
-    step = int(0.02*points.GetNumberOfPoints()) if int(0.02*points.GetNumberOfPoints()) > 0 else 1
-    CurveManager.step = step
-    ApproximityPos = distance * 0.85
-    DestiationPos = distance
-  
+  def setCurveFiducials(self, CurveManager, positions):
+    # the markups are added in one batch and the curve is updated once
     if CurveManager.curveFiducials == None:
       CurveManager.curveFiducials = slicer.mrmlScene.CreateNodeByClass("vtkMRMLMarkupsFiducialNode")
       CurveManager.curveFiducials.SetName(CurveManager.curveName)
-      slicer.mrmlScene.AddNode(CurveManager.curveFiducials) 
-    else:
-      CurveManager.curveFiducials.RemoveAllMarkups()
-      CurveManager.cmLogic.updateCurve()
-      
-    iPos = 0
-    iPosValid = iPos
-    posModel = numpy.array(points.GetPoint(iPos))
-    CurveManager.cmLogic.DestinationNode = CurveManager._curveModel
-    CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2]) 
-    CurveManager.cmLogic.CurvePoly = vtk.vtkPolyData() ## For CurveMaker bug
-    for iPos in range(step,points.GetNumberOfPoints(),step):
-      posModel = numpy.array(points.GetPoint(iPos))
-      posModelValid = numpy.array(points.GetPoint(iPosValid))
-      if  numpy.linalg.norm(posModel-posModelValid)> 50.0:
-        continue
-      iPosValid = iPos
-      CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2]) #adding fiducials takes too long, check the event triggered by this operation
+      slicer.mrmlScene.AddNode(CurveManager.curveFiducials)
+    with CurveManager.cmLogic.batchUpdate():
+      CurveManager.cmLogic.DestinationNode = CurveManager._curveModel
       CurveManager.cmLogic.SourceNode = CurveManager.curveFiducials
-      CurveManager.cmLogic.updateCurve()
-      if CurveManager.cmLogic.CurveLength>ApproximityPos:
-        break
-    jPos = iPosValid 
-    jPosValid = jPos
-    posApprox = numpy.array(points.GetPoint(iPos))
-    for jPos in range(iPosValid,points.GetNumberOfPoints(), 1):
-      posModel = numpy.array(points.GetPoint(jPos))
-      posModelValid = numpy.array(points.GetPoint(jPosValid))
-      if  numpy.linalg.norm(posModel-posModelValid)> 50.0:
-        continue
-      distance = numpy.linalg.norm(posModel-posApprox)+ CurveManager.cmLogic.CurveLength
-      if (distance>DestiationPos) or (jPos==points.GetNumberOfPoints()-1):
-        CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2])  
-        jPosValid = jPos 
-        break
-       
-    #CurveManager.cmLogic.SourceNode.SetAttribute('CurveMaker.CurveModel', CurveManager.cmLogic.DestinationNode.GetID())
-    CurveManager.cmLogic.updateCurve()
-    CurveManager.cmLogic.CurvePoly = vtk.vtkPolyData() ## For CurveMaker bug
-    CurveManager.cmLogic.enableAutomaticUpdate(1)
-    CurveManager.cmLogic.setInterpolationMethod(1)
-    CurveManager.cmLogic.setTubeRadius(0.5)  
-    self.topPoint = points.GetPoint(jPos)
-  
+      with self.batchMarkupEdits([CurveManager.curveFiducials]):
+        CurveManager.curveFiducials.RemoveAllMarkups()
+        for posModel in positions:
+          CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2])
+      CurveManager.cmLogic.enableAutomaticUpdate(1)
+      CurveManager.cmLogic.setInterpolationMethod(1)
+      CurveManager.cmLogic.setTubeRadius(0.5)
+
   def constructCurvePlanning(self, CurveManager,CurveManagerReference, points, axis):
     posNasion = numpy.array([0.0,0.0,0.0])
     if self.sagittalReferenceCurveManager.curveFiducials:
@@ -3451,94 +3411,93 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
       CurveManager.curveFiducials = slicer.mrmlScene.CreateNodeByClass("vtkMRMLMarkupsFiducialNode")
       CurveManager.curveFiducials.SetName(CurveManager.curveName)
       slicer.mrmlScene.AddNode(CurveManager.curveFiducials) 
-    else:
+
+    # the curve is filled and reversed in one batch, the curve model is updated once at the end
+    with self.batchMarkupEdits([CurveManager.curveFiducials]):
       CurveManager.curveFiducials.RemoveAllMarkups()
-      CurveManager.cmLogic.updateCurve()
-      
-    iPos = 0
-    iPosValid = iPos
-    posModel = numpy.array(points.GetPoint(iPos))
-    step = CurveManagerReference.step
-    CurveManager.cmLogic.DestinationNode = CurveManager._curveModel
-    CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2]) 
+      iPos = 0
+      iPosValid = iPos
+      posModel = numpy.array(points.GetPoint(iPos))
+      step = CurveManagerReference.step
+      CurveManager.cmLogic.DestinationNode = CurveManager._curveModel
+      CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2]) 
     
-    numOfRef = CurveManagerReference.curveFiducials.GetNumberOfFiducials()
+      numOfRef = CurveManagerReference.curveFiducials.GetNumberOfFiducials()
     
-    eps = 1e-2
-    if axis == 1:
-      lastRefPos = [0.0]*3
-      CurveManagerReference.curveFiducials.GetNthFiducialPosition(numOfRef-1, lastRefPos)
-      if numpy.linalg.norm(numpy.array(lastRefPos)-numpy.array(points.GetPoint(0)))<eps: #if the planning and reference entry points are identical
-        pos = [0.0]*3  
-        for iPos in range(1,numOfRef): 
-          CurveManagerReference.curveFiducials.GetNthFiducialPosition(numOfRef-iPos-1, pos)
-          CurveManager.curveFiducials.AddFiducial(pos[0],pos[1],pos[2])
-        CurveManagerReference.curveFiducials.GetNthFiducialPosition(0, pos)    
-        self.topPoint = pos       
-      else:
-        posIntersect = [0.0]*3
-        posSearch = [0.0]*3
-        minDistance = 1e10
-        for iSearch in range(points.GetNumberOfPoints()):
-          posSearch = points.GetPoint(iSearch)
-          if posSearch[2] > posNasion[2]: #Only the upper part of the cutted sagittal plan is considered
-            distance = self.trueSagittalPlane.DistanceToPlane(posSearch)
-            if distance < minDistance:
-              minDistance = distance
-              posIntersect = posSearch
-
-        shift = step
-        """
-        for iPos in range(1,numOfRef):
-          pos = [0.0]*3
-          CurveManagerReference.curveFiducials.GetNthFiducialPosition(numOfRef-iPos-1, pos)
-          #check if the points is aligned with the reference coronal line, if yes, take the point into the planning curvemanager
-          if abs(pos[0]-posIntersect[0])< abs(points.GetPoint(0)[0]-posIntersect[0])and abs(pos[1]-points.GetPoint(0)[1])<eps and abs(pos[2]-points.GetPoint(0)[2])<eps:
+      eps = 1e-2
+      if axis == 1:
+        lastRefPos = [0.0]*3
+        CurveManagerReference.curveFiducials.GetNthFiducialPosition(numOfRef-1, lastRefPos)
+        if numpy.linalg.norm(numpy.array(lastRefPos)-numpy.array(points.GetPoint(0)))<eps: #if the planning and reference entry points are identical
+          pos = [0.0]*3  
+          for iPos in range(1,numOfRef): 
+            CurveManagerReference.curveFiducials.GetNthFiducialPosition(numOfRef-iPos-1, pos)
             CurveManager.curveFiducials.AddFiducial(pos[0],pos[1],pos[2])
-            shift = iPos
-            break
-        """
-        for iPos in range(shift,points.GetNumberOfPoints(),step):
-          posModel = numpy.array(points.GetPoint(iPos))
-          posModelValid = numpy.array(points.GetPoint(iPosValid))
-          if  numpy.linalg.norm(posModel-posModelValid)> 50.0:
-            continue
-          if (not self.useLeftHemisphere) and (abs(posModel[0]-posIntersect[0])<eps or (posModel[0]<posIntersect[0])):
-            break
-          elif self.useLeftHemisphere and (abs(posModel[0]-posIntersect[0])<eps or (posModel[0]>posIntersect[0])):
-            break
-          iPosValid = iPos
-          CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2]) #adding fiducials takes too long, check the event triggered by this operation
-        jPos = iPosValid
-        jPosValid = jPos
-        for jPos in range(iPosValid, points.GetNumberOfPoints(), 1):
-          posModel = numpy.array(points.GetPoint(jPos))
-          posModelValid = numpy.array(points.GetPoint(jPosValid))
-          if  numpy.linalg.norm(posModel-posModelValid)> 50.0:
-            continue
-          if (not self.useLeftHemisphere) and (abs(posModel[0]-posIntersect[0])<eps or (posModel[0]<posIntersect[0])):
-            break
-          elif self.useLeftHemisphere and (abs(posModel[0]-posIntersect[0])<eps or (posModel[0]>posIntersect[0])):
-            break
+          CurveManagerReference.curveFiducials.GetNthFiducialPosition(0, pos)    
+          self.topPoint = pos       
+        else:
+          posIntersect = [0.0]*3
+          posSearch = [0.0]*3
+          minDistance = 1e10
+          for iSearch in range(points.GetNumberOfPoints()):
+            posSearch = points.GetPoint(iSearch)
+            if posSearch[2] > posNasion[2]: #Only the upper part of the cutted sagittal plan is considered
+              distance = self.trueSagittalPlane.DistanceToPlane(posSearch)
+              if distance < minDistance:
+                minDistance = distance
+                posIntersect = posSearch
+
+          shift = step
+          """
+          for iPos in range(1,numOfRef):
+            pos = [0.0]*3
+            CurveManagerReference.curveFiducials.GetNthFiducialPosition(numOfRef-iPos-1, pos)
+            #check if the points is aligned with the reference coronal line, if yes, take the point into the planning curvemanager
+            if abs(pos[0]-posIntersect[0])< abs(points.GetPoint(0)[0]-posIntersect[0])and abs(pos[1]-points.GetPoint(0)[1])<eps and abs(pos[2]-points.GetPoint(0)[2])<eps:
+              CurveManager.curveFiducials.AddFiducial(pos[0],pos[1],pos[2])
+              shift = iPos
+              break
+          """
+          for iPos in range(shift,points.GetNumberOfPoints(),step):
+            posModel = numpy.array(points.GetPoint(iPos))
+            posModelValid = numpy.array(points.GetPoint(iPosValid))
+            if  numpy.linalg.norm(posModel-posModelValid)> 50.0:
+              continue
+            if (not self.useLeftHemisphere) and (abs(posModel[0]-posIntersect[0])<eps or (posModel[0]<posIntersect[0])):
+              break
+            elif self.useLeftHemisphere and (abs(posModel[0]-posIntersect[0])<eps or (posModel[0]>posIntersect[0])):
+              break
+            iPosValid = iPos
+            CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2]) #adding fiducials takes too long, check the event triggered by this operation
+          jPos = iPosValid
           jPosValid = jPos
-        self.topPoint = points.GetPoint(jPosValid)
-        posModel = numpy.array(points.GetPoint(jPosValid))
-        CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2])
-
-    if axis ==0:
-      for iPos in range(1,numOfRef): 
-        pos = [0.0]*3
-        CurveManagerReference.curveFiducials.GetNthFiducialPosition(numOfRef-iPos-1, pos)  
-        if float(pos[2])<self.topPoint[2]:
-          CurveManager.curveFiducials.AddFiducial(pos[0],pos[1],pos[2]) 
+          for jPos in range(iPosValid, points.GetNumberOfPoints(), 1):
+            posModel = numpy.array(points.GetPoint(jPos))
+            posModelValid = numpy.array(points.GetPoint(jPosValid))
+            if  numpy.linalg.norm(posModel-posModelValid)> 50.0:
+              continue
+            if (not self.useLeftHemisphere) and (abs(posModel[0]-posIntersect[0])<eps or (posModel[0]<posIntersect[0])):
+              break
+            elif self.useLeftHemisphere and (abs(posModel[0]-posIntersect[0])<eps or (posModel[0]>posIntersect[0])):
+              break
+            jPosValid = jPos
+          self.topPoint = points.GetPoint(jPosValid)
+          posModel = numpy.array(points.GetPoint(jPosValid))
+          CurveManager.curveFiducials.AddFiducial(posModel[0],posModel[1],posModel[2])
+
+      if axis ==0:
+        for iPos in range(1,numOfRef): 
+          pos = [0.0]*3
+          CurveManagerReference.curveFiducials.GetNthFiducialPosition(numOfRef-iPos-1, pos)  
+          if float(pos[2])<self.topPoint[2]:
+            CurveManager.curveFiducials.AddFiducial(pos[0],pos[1],pos[2]) 
     
-    for i in range(CurveManager.curveFiducials.GetNumberOfFiducials()/2):
-      pos = [0.0]*3  
-      CurveManager.curveFiducials.GetNthFiducialPosition(i,pos)
-      posReverse = [0.0]*3  
-      CurveManager.curveFiducials.GetNthFiducialPosition(CurveManager.curveFiducials.GetNumberOfFiducials()-i-1,posReverse)
-      CurveManager.curveFiducials.SetNthFiducialPositionFromArray(i,posReverse)
-      CurveManager.curveFiducials.SetNthFiducialPositionFromArray(CurveManager.curveFiducials.GetNumberOfFiducials()-i-1,pos)
+      numOfFiducials = CurveManager.curveFiducials.GetNumberOfFiducials()
+      positions = numpy.zeros((numOfFiducials, 3))
+      for i in range(numOfFiducials):
+        CurveManager.curveFiducials.GetNthFiducialPosition(i,positions[i])
+      for i in range(numOfFiducials):
+        CurveManager.curveFiducials.SetNthFiducialPositionFromArray(i,positions[numOfFiducials-i-1])
     """  
     for i in range(CurveManager.curveFiducials.GetNumberOfFiducials()):
       pos = [0.0]*3  
@@ -3547,57 +3506,62 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
       CurveManagerReference.curveFiducials.GetNthFiducialPosition(i,pos)
       print "Reference Pos: ", pos
     """  
-    CurveManager.cmLogic.SourceNode = CurveManager.curveFiducials
-    CurveManager.cmLogic.updateCurve()
-    CurveManager.cmLogic.CurvePoly = vtk.vtkPolyData() ## For CurveMaker bug   
-    CurveManager.cmLogic.SourceNode.SetAttribute('CurveMaker.CurveModel', CurveManager.cmLogic.DestinationNode.GetID())  
-    CurveManager.cmLogic.enableAutomaticUpdate(1)
-    CurveManager.cmLogic.setInterpolationMethod(1)
-    CurveManager.cmLogic.setTubeRadius(0.5)
+    with CurveManager.cmLogic.batchUpdate():
+      CurveManager.cmLogic.SourceNode = CurveManager.curveFiducials
+      CurveManager.cmLogic.enableAutomaticUpdate(1)
+      CurveManager.cmLogic.setInterpolationMethod(1)
+      CurveManager.cmLogic.setTubeRadius(0.5)
+
+  def getReferenceCurves(self, polyData, posNasion, sagittalReferenceLength, coronalReferenceLength):
+    """
+    Reference curves of both hemispheres, see PlanningEngine.computeReferenceCurves. They are recomputed only when the skull model,
+    the nasion, the true sagittal plane or the reference lengths change, so switching hemisphere is a lookup.
+    """
+    key = (polyData.GetAddressAsString("vtkPolyData"), polyData.GetMTime(), tuple(numpy.round(posNasion, 3)),
+           tuple(numpy.round(self.trueSagittalPlane.GetOrigin(), 3)), tuple(numpy.round(self.trueSagittalPlane.GetNormal(), 6)),
+           sagittalReferenceLength, coronalReferenceLength, self.useGeodesicReference)
+    if key != self.referenceCurveKey:
+      self.referenceCurves = self.engine.computeReferenceCurves(polyData, posNasion, self.trueSagittalPlane, self.sagittalYawAngle, sagittalReferenceLength,
+                                                                   coronalReferenceLength, self.useGeodesicReference)
+      self.referenceCurveKey = key
+    return self.referenceCurves
+
+  def constructGeodesicPlanningCurves(self, polyData, posEntry, posNasion):
+    """
+    Geodesic counterpart of the plane cuts of createPlanningLine. The coronal planning curve joins the midline to the
+    entry point along the shortest path in the band of the coronal plane of the entry, the sagittal planning curve
+    follows the distance field of the nasion in the band of the true sagittal plane from there back to the nasion.
+    """
+    geodesic = self.engine.getGeodesicDistance(polyData)
+    sagittalMask = self.engine.getGeodesicPlaneMask(geodesic, self.trueSagittalPlane.GetOrigin(), self.trueSagittalPlane.GetNormal())
+    coronalMask = self.engine.getGeodesicPlaneMask(geodesic, posEntry, [-numpy.sin(self.sagittalYawAngle), numpy.cos(self.sagittalYawAngle), 0])
+    midlineMask = sagittalMask & coronalMask & (geodesic.vertices[:, 2] >= posNasion[2])
+    vertex, coronalPath = geodesic.findPointAtDistance(posEntry, 0.0, midlineMask, coronalMask)
+    if vertex is None:
+      return False
+    vertices, nasionDistances = geodesic.getDistanceField([posNasion], sagittalMask)
+    if not numpy.isfinite(nasionDistances[vertex]):
+      return False
+    sagittalPath = geodesic.tracePath(nasionDistances, vertex)
+    self.topPoint = tuple(vertices[vertex])
+    self.setCurvePath(self.coronalPlanningCurveManager, coronalPath[::-1])
+    self.setCurvePath(self.sagittalPlanningCurveManager, sagittalPath[::-1])
+    return True
+
+  def setCurvePath(self, CurveManager, path):
+    # every step-th point of the path, and its end, becomes a curve fiducial
+    step = max(1, int(0.02*len(path)))
+    selected = numpy.unique(numpy.append(numpy.arange(0, len(path), step), len(path)-1))
+    CurveManager.step = step
+    self.setCurveFiducials(CurveManager, path[selected])
 
   def getIntersectPoints(self, polyData, plane, referencePoint, targetDistance, axis, intersectPoints):
-    cutter = vtk.vtkCutter()
-    cutter.SetCutFunction(plane)
-    cutter.SetInputData(polyData)
-    cutter.Update()
-    cuttedPolyData = cutter.GetOutput()
-    points = cuttedPolyData.GetPoints()
-    for iPos in range(points.GetNumberOfPoints()):
-      posModel = numpy.array(points.GetPoint(iPos))
-      ## distance calculation could be simplified if the patient is well aligned in the scanner
-      distanceModelNasion = numpy.linalg.norm(posModel - referencePoint)
-      valid = False
-      if axis == 0:
-        valid = posModel[2] >= referencePoint[2]
-      elif axis == 1:
-        if self.useLeftHemisphere:
-          valid = posModel[0] <= referencePoint[0]
-        else:
-          valid = posModel[0] >= referencePoint[0]
-      if (distanceModelNasion < targetDistance) and valid:
-        intersectPoints.InsertNextPoint(posModel)
-          
+    contour = self.engine.extractContourPoints(polyData, plane, referencePoint, axis, self.useLeftHemisphere, targetDistance)
+    intersectPoints.SetData(numpy_support.numpy_to_vtk(contour, deep=True))
+
   def getIntersectPointsPlanning(self, polyData, plane, referencePoint, axis, intersectPoints):
-    cutter = vtk.vtkCutter()
-    cutter.SetCutFunction(plane)
-    cutter.SetInputData(polyData)
-    cutter.Update()
-    cuttedPolyData = cutter.GetOutput()
-    points = cuttedPolyData.GetPoints()      
-    for iPos in range(points.GetNumberOfPoints()):
-      posModel = numpy.array(points.GetPoint(iPos))
-      ## distance calculation could be simplified if the patient is well aligned in the scanner
-      distanceModelNasion = numpy.linalg.norm(posModel-referencePoint)
-      valid = False
-      if axis == 0:
-        valid = (posModel[2]<=referencePoint[2] or abs(posModel[2]-referencePoint[2])<1e-3 )
-      elif axis == 1:
-        if self.useLeftHemisphere:
-          valid = (posModel[0]>=referencePoint[0] or abs(posModel[0]-referencePoint[0])<1e-3 )
-        else:
-          valid = (posModel[0]<=referencePoint[0] or abs(posModel[0]-referencePoint[0])<1e-3 )
-      if valid:        
-          intersectPoints.InsertNextPoint(posModel)        
+    contour = self.engine.extractContourPoints(polyData, plane, referencePoint, axis, self.useLeftHemisphere, planning=True)
+    intersectPoints.SetData(numpy_support.numpy_to_vtk(contour, deep=True))
 
   def createTrueSagittalPlane(self):
     nasionNodeID = self.baseVolumeNode.GetAttribute("vtkMRMLScalarVolumeNode.rel_nasion")
@@ -3613,14 +3577,10 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
           posSagittal = numpy.array([0.0, 0.0, 0.0])
           sagittalPointNode.GetNthFiducialPosition(sagittalPointNode.GetNumberOfMarkups() - 1, posSagittal)
           if sagittalPointNode.GetNumberOfMarkups() > 1:
-            sagittalPointNode.RemoveObservers(slicer.vtkMRMLMarkupsNode.MarkupAddedEvent)
-            sagittalPointNode.RemoveAllMarkups()
-            sagittalPointNode.AddFiducial(posSagittal[0], posSagittal[1], posSagittal[2])
-            sagittalPointNode.AddObserver(slicer.vtkMRMLMarkupsNode.MarkupAddedEvent, self.endPlacement)
-          self.sagittalYawAngle = -numpy.arctan2(posNasion[0] - posSagittal[0], posNasion[1] - posSagittal[1])
-          self.trueSagittalPlane = vtk.vtkPlane()
-          self.trueSagittalPlane.SetOrigin(posNasion[0], posNasion[1], posNasion[2])
-          self.trueSagittalPlane.SetNormal(math.cos(self.sagittalYawAngle), math.sin(self.sagittalYawAngle), 0)
+            with self.batchMarkupEdits([sagittalPointNode], [(slicer.vtkMRMLMarkupsNode.MarkupAddedEvent, self.endPlacement)]):
+              sagittalPointNode.RemoveAllMarkups()
+              sagittalPointNode.AddFiducial(posSagittal[0], posSagittal[1], posSagittal[2])
+          self.sagittalYawAngle, self.trueSagittalPlane = self.engine.getTrueSagittalPlane(posNasion, posSagittal)
         sagittalPointNode.SetLocked(True)
 
   def createEntryPoint(self) :
@@ -3645,34 +3605,18 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
         posNasion = numpy.array([0.0,0.0,0.0])
         nasionNode.GetNthFiducialPosition(nasionNode.GetNumberOfMarkups()-1,posNasion)
         if nasionNode.GetNumberOfMarkups()>1:
-          nasionNode.RemoveObservers(slicer.vtkMRMLMarkupsNode.MarkupAddedEvent)
-          nasionNode.RemoveAllMarkups()
-          nasionNode.AddFiducial(posNasion[0],posNasion[1],posNasion[2])
-          nasionNode.AddObserver(slicer.vtkMRMLMarkupsNode.MarkupAddedEvent, self.endPlacement)
-        sagittalPoints = vtk.vtkPoints()
-        self.getIntersectPoints(polyData, self.trueSagittalPlane, posNasion, sagittalReferenceLength, 0, sagittalPoints)
-
-        if sagittalPoints.GetNumberOfPoints() <= 0:
+          with self.batchMarkupEdits([nasionNode], [(slicer.vtkMRMLMarkupsNode.MarkupAddedEvent, self.endPlacement)]):
+            nasionNode.RemoveAllMarkups()
+            nasionNode.AddFiducial(posNasion[0],posNasion[1],posNasion[2])
+        curves = self.getReferenceCurves(polyData, posNasion, sagittalReferenceLength, coronalReferenceLength)
+        if not self.useLeftHemisphere in curves:
           return
-        ## Sorting   
-        self.functions.sortVTKPoints(sagittalPoints, posNasion)
-        self.constructCurveReference(self.sagittalReferenceCurveManager, sagittalPoints, sagittalReferenceLength)
-        ##To do, calculate the curvature value points by point might be necessary to exclude the outliers
-        if not (self.topPoint == []):
-          posNasionBack100 = self.topPoint
-          coronalPoints = vtk.vtkPoints()
-          coronalPlane = vtk.vtkPlane()
-          coronalPlane.SetOrigin(posNasionBack100[0],posNasionBack100[1],posNasionBack100[2])
-          coronalPlane.SetNormal(math.sin(self.sagittalYawAngle),-math.cos(self.sagittalYawAngle),0)
-          self.getIntersectPoints(polyData, coronalPlane, posNasionBack100, coronalReferenceLength, 1, coronalPoints)
-          if coronalPoints.GetNumberOfPoints() <= 0:
-            return
-          ## Sorting
-          self.functions.sortVTKPoints(coronalPoints, posNasionBack100)
-          self.constructCurveReference(self.coronalReferenceCurveManager, coronalPoints, coronalReferenceLength)
-          posEntry = [0.0, 0.0, 0.0]
-          self.coronalReferenceCurveManager.getLastPoint(posEntry)
-          kocherNode.AddFiducial(posEntry[0], posEntry[1], posEntry[2])
+        sagittalPositions, self.sagittalReferenceCurveManager.step, coronalPositions, self.coronalReferenceCurveManager.step, self.topPoint = curves[self.useLeftHemisphere]
+        self.setCurveFiducials(self.sagittalReferenceCurveManager, sagittalPositions)
+        self.setCurveFiducials(self.coronalReferenceCurveManager, coronalPositions)
+        posEntry = [0.0, 0.0, 0.0]
+        self.coronalReferenceCurveManager.getLastPoint(posEntry)
+        kocherNode.AddFiducial(posEntry[0], posEntry[1], posEntry[2])
         
         # Create face mask ROI
         self.generateFaceMaskROI(maskROI)
@@ -3719,6 +3663,10 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
           if entryPointAtLeft < 0 and self.useLeftHemisphere == True:
             self.useLeftHemisphere = False
             self.createEntryPoint()
+          if self.useGeodesicReference and self.constructGeodesicPlanningCurves(polyData, posEntry, posNasion):
+            self.sagittalPlanningCurveManager.lockLine()
+            self.coronalPlanningCurveManager.lockLine()
+            return True
           coronalPlane = vtk.vtkPlane()
           coronalPlane.SetOrigin(posEntry[0], posEntry[1], posEntry[2])
           coronalPlane.SetNormal(-math.sin(self.sagittalYawAngle), math.cos(self.sagittalYawAngle), 0)
@@ -3727,8 +3675,6 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
 
           if coronalPoints.GetNumberOfPoints() <= 0:
             return False
-          ## Sorting   
-          self.functions.sortVTKPoints(coronalPoints, posEntry)
           self.constructCurvePlanning(self.coronalPlanningCurveManager, self.coronalReferenceCurveManager, coronalPoints, 1)
               
           ##To do, calculate the curvature value points by point might be necessary to exclude the outliers   
@@ -3741,8 +3687,6 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
             self.getIntersectPointsPlanning(polyData, sagittalPlane, posTractoryBack, 0, sagittalPoints)
             if sagittalPoints.GetNumberOfPoints() <= 0:
               return False
-            ## Sorting      
-            self.functions.sortVTKPoints(sagittalPoints, posTractoryBack)
             self.constructCurvePlanning(self.sagittalPlanningCurveManager, self.sagittalReferenceCurveManager, sagittalPoints, 0)
             self.sagittalPlanningCurveManager.lockLine()
             self.coronalPlanningCurveManager.lockLine()
@@ -3879,90 +3823,28 @@ class VentriculostomyPlanningLogic(ScriptedLoadableModuleLogic, ModuleLogicMixin
           self.cannulaManager.curveFiducials.GetNthFiducialPosition(0,posTarget)
           posEntry = [0.0,0.0,0.0]
           self.cannulaManager.curveFiducials.GetNthFiducialPosition(1,posEntry)
-          p_ES = numpy.array([math.cos(self.sagittalYawAngle), math.sin(self.sagittalYawAngle), 0])
-          p_EC = numpy.array([-math.sin(self.sagittalYawAngle), math.cos(self.sagittalYawAngle), 0])
-          p_EN = self.calculateModelNorm(inputModelNode, posEntry, self.entryRadius)#numpy.array([-0.5,math.sqrt(0.5),0.5]) #this vector we need to get from the skull Norm calculation
-
-          self.skullNormToCoronalAngle = 90.0 - math.acos(abs(numpy.dot(p_EC, p_EN))) * 180.0 / numpy.pi
-          self.skullNormToSaggitalAngle = 90.0 - math.acos(abs(numpy.dot(p_ES, p_EN))) * 180.0 / numpy.pi
-          p_EC = p_EC/numpy.linalg.norm(p_EC)
-          p_EN = p_EN/numpy.linalg.norm(p_EN)
-          p_ET = numpy.array(posEntry) - numpy.array(posTarget)
-          p_ET = p_ET / numpy.linalg.norm(p_ET)
-          cosCalc = numpy.dot(p_EN, p_ET)
-          sinCalc = math.sqrt(1 - cosCalc*cosCalc)
-          p_EM = numpy.array([])
-          if cosCalc>1e-6: # make sure the p_EN and p_ET are not perpenticular.
-            sinTheta1 = numpy.dot(p_EC, p_EN)
-            cosTheta1 = math.sqrt(1-sinTheta1*sinTheta1)
-            if cosTheta1 < cosCalc:  # here means no intesection between the coronal plan and the cone composed by p_EN and p_ET
-              p_EN2 = p_EN - p_EC * sinTheta1
-              p_EM = p_EN2 + p_EC * cosTheta1*(sinTheta1 * cosCalc - cosTheta1 * sinCalc) / (cosTheta1 * cosCalc + sinTheta1 * sinCalc)  # sin(theta1 - Calc) = sin(theta1)*cos(Calc) - cos(theta1)*sin(Calc)
-              p_EM = p_EM / numpy.linalg.norm(p_EM)
-            else:
-              p_EN2 = p_EN - p_EC * (sinTheta1)
-              cosTheta2 = cosCalc/cosTheta1
-              tanTheta2 =  math.sqrt(1/(cosTheta2*cosTheta2) - 1)
-              p_EM = p_EN2 + numpy.cross(p_EC, p_EN2)*tanTheta2
-              p_EM = p_EM / numpy.linalg.norm(p_EM)
-            cosMT = numpy.dot(p_EM, p_ET)
-            cosMN = numpy.dot(p_EN, p_EM)
-            if p_EM.any():
-              self.cannulaToCoronalAngle = math.acos(cosMT) * 180.0 / numpy.pi
-              self.cannulaToNormAngle = math.acos(cosCalc) * 180.0 / numpy.pi
-              pathNavigationPoints = [numpy.array(posEntry), numpy.array(posEntry) + p_EN * 80,
-                                      #numpy.array(posEntry), numpy.array(posEntry) + p_EM * 50,
-                                      numpy.array(posEntry), numpy.array(posEntry) + p_ET * 20]
-              if not self.pathNavigationModel.GetPolyData():
-                polyData = vtk.vtkPolyData()
-                self.pathNavigationModel.SetAndObservePolyData(polyData)
-              self.makeNavigationLines(pathNavigationPoints, 3, self.pathNavigationModel.GetPolyData())
-              self.pathNavigationModel.GetDisplayNode().SetVisibility(1)
-              return 1
-            else:
-              return 0
-          else:
-            self.cannulaToCoronalAngle = 0.0
-            self.cannulaToNormAngle = 0.0
-            return 1
+          p_EN = self.calculateModelNorm(inputModelNode, posEntry, self.entryRadius)
+          skullNormToCoronalAngle, skullNormToSagittalAngle, cannulaToCoronalAngle, cannulaToNormAngle, navigationLines = \
+            self.engine.computeCannulaAngles(posTarget, posEntry, p_EN, self.sagittalYawAngle)
+          self.skullNormToCoronalAngle = skullNormToCoronalAngle
+          self.skullNormToSaggitalAngle = skullNormToSagittalAngle
+          if cannulaToCoronalAngle is None:
+            return 0
+          self.cannulaToCoronalAngle = cannulaToCoronalAngle
+          self.cannulaToNormAngle = cannulaToNormAngle
+          if navigationLines is not None:
+            if not self.pathNavigationModel.GetPolyData():
+              polyData = vtk.vtkPolyData()
+              self.pathNavigationModel.SetAndObservePolyData(polyData)
+            self.engine.setLineSegments(self.pathNavigationModel.GetPolyData(), navigationLines)
+            self.pathNavigationModel.GetDisplayNode().SetVisibility(1)
+          return 1
         
     return 0
 
   def calculateModelNorm(self, inputModel, spherePos, sphereRadius):
-    sphere = vtk.vtkSphere()
-    sphere.SetCenter(spherePos)
-    sphere.SetRadius(sphereRadius)
-
-    triangle = vtk.vtkTriangleFilter()
-    triangle.SetInputData(inputModel.GetPolyData())
-    triangle.Update()
-
-    clip = vtk.vtkClipPolyData()
-    clip.SetInputData(triangle.GetOutput())
-    clip.SetClipFunction(sphere)
-    clip.InsideOutOn()
-    clip.Update()
-
-    clean = vtk.vtkCleanPolyData()
-    clean.SetInputConnection(clip.GetOutputPort())
-    clean.Update()
-
-    clippedModel = clip.GetOutput()
-    cellsNormal = clippedModel.GetPointData().GetNormals()
-
-    averageNormal = numpy.array([0.0, 0.0, 0.0])
-
-    for cellIndex in range(0, cellsNormal.GetNumberOfTuples()):
-      cellNormal = [0.0, 0.0, 0.0]
-      cellsNormal.GetTuple(cellIndex, cellNormal)
-
-      if not (math.isnan(cellNormal[0]) or math.isnan(cellNormal[1]) or math.isnan(cellNormal[2])):
-        averageNormal[0] = averageNormal[0] + cellNormal[0]
-        averageNormal[1] = averageNormal[1] + cellNormal[1]
-        averageNormal[2] = averageNormal[2] + cellNormal[2]
-    averageNormal = averageNormal/numpy.linalg.norm(averageNormal)
-
-    return averageNormal
+    # the point normals and the kd-tree of the model are cached until the model is modified
+    return self.engine.getSurfaceNormals(inputModel.GetPolyData(), [spherePos], sphereRadius)[0]
     
   def updateSliceViewBasedOnPoints(self, firstPos, lastPos):
     ## due to the RAS and vtk space difference, the X axis is flipped, So the standard rotation matrix is multiplied by -1 in the X axis
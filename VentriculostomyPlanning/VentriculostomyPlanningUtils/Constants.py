@@ -19,4 +19,10 @@ class CandidatePathStatus(object):
 class VentricleSideStatus(object):
   NotYetChecked = 1
   RightSide = 2
-  LeftSide = 3
\ No newline at end of file
+  LeftSide = 3
+
+class CandidatePathFeasibility(object):
+  CollisionFree = 1
+  PosteriorEnough = 2
+  WithinKocherMargin = 4
+  All = 7
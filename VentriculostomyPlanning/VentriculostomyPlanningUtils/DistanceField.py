@@ -0,0 +1,95 @@
+import numpy
+import SimpleITK as sitk
+
+class DistanceField(object):
+  """
+  In-memory distance map that can be sampled at RAS positions.
+  The array is indexed [k, j, i] as returned by sitk.GetArrayFromImage, origin and direction follow the
+  SimpleITK (LPS) convention. Positions outside of the image are clamped to the image border.
+  """
+
+  def __init__(self, array, origin, spacing, direction):
+    self.array = numpy.ascontiguousarray(array, dtype=numpy.float32)
+    self.spacing = numpy.array(spacing, dtype=numpy.float64)
+    lpsToRAS = numpy.diag([-1.0, -1.0, 1.0])
+    indexToRAS = lpsToRAS.dot(numpy.array(direction, dtype=numpy.float64).reshape(3, 3)).dot(numpy.diag(self.spacing))
+    self.rasToIndex = numpy.linalg.inv(indexToRAS)
+    self.originRAS = lpsToRAS.dot(numpy.array(origin, dtype=numpy.float64))
+    self.maximumIndex = numpy.array(self.array.shape[::-1]) - 1
+    # upper bound of the number of samples interpolated at once
+    self.sampleBlockSize = 1 << 20
+
+  @staticmethod
+  def fromImage(image):
+    return DistanceField(sitk.GetArrayFromImage(image), image.GetOrigin(), image.GetSpacing(), image.GetDirection())
+
+  def sample(self, points):
+    """
+    Trilinear interpolation of the field at the (N,3) RAS positions.
+    """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    index = numpy.clip((points - self.originRAS).dot(self.rasToIndex.T), 0, self.maximumIndex)
+    lower = numpy.minimum(numpy.floor(index).astype(numpy.int64), numpy.maximum(self.maximumIndex - 1, 0))
+    upper = numpy.minimum(lower + 1, self.maximumIndex)
+    fraction = index - lower
+    i0, j0, k0 = lower[:, 0], lower[:, 1], lower[:, 2]
+    i1, j1, k1 = upper[:, 0], upper[:, 1], upper[:, 2]
+    fx, fy, fz = fraction[:, 0], fraction[:, 1], fraction[:, 2]
+    field = self.array
+    c00 = field[k0, j0, i0] * (1 - fx) + field[k0, j0, i1] * fx
+    c10 = field[k0, j1, i0] * (1 - fx) + field[k0, j1, i1] * fx
+    c01 = field[k1, j0, i0] * (1 - fx) + field[k1, j0, i1] * fx
+    c11 = field[k1, j1, i0] * (1 - fx) + field[k1, j1, i1] * fx
+    c0 = c00 * (1 - fy) + c10 * fy
+    c1 = c01 * (1 - fy) + c11 * fy
+    return c0 * (1 - fz) + c1 * fz
+
+  def getNumberOfSegmentSamples(self, segments, step):
+    if step is None:
+      step = 0.5 * self.spacing.min()
+    if len(segments) == 0:
+      return 2
+    lengths = numpy.linalg.norm(segments[:, 1, :] - segments[:, 0, :], axis=1)
+    return max(2, int(numpy.ceil(lengths.max() / step)) + 1)
+
+  def sampleSegments(self, segments, step=None):
+    """
+    Sample the field along (N,2,3) [start, end] segments, returns the (N,S) profiles and the (S,) fractions
+    of the segment length at which they were taken. step defaults to half of the smallest spacing.
+    """
+    segments = numpy.asarray(segments, dtype=numpy.float64).reshape(-1, 2, 3)
+    numberOfSamples = self.getNumberOfSegmentSamples(segments, step)
+    fractions = numpy.linspace(0.0, 1.0, numberOfSamples)
+    profiles = numpy.empty((len(segments), numberOfSamples))
+    blockSize = max(1, self.sampleBlockSize // numberOfSamples)
+    for begin in range(0, len(segments), blockSize):
+      block = segments[begin:begin + blockSize]
+      samples = block[:, numpy.newaxis, 0, :] + fractions[numpy.newaxis, :, numpy.newaxis] * (block[:, 1, :] - block[:, 0, :])[:, numpy.newaxis, :]
+      profiles[begin:begin + blockSize] = self.sample(samples.reshape(-1, 3)).reshape(len(block), numberOfSamples)
+    return profiles, fractions
+
+  def segmentMinimumValue(self, segments, step=None):
+    """
+    Minimum of the field along each of the (N,2,3) segments, computed in one vectorized pass.
+    """
+    segments = numpy.asarray(segments, dtype=numpy.float64).reshape(-1, 2, 3)
+    numberOfSamples = self.getNumberOfSegmentSamples(segments, step)
+    minimumValues = numpy.empty(len(segments))
+    blockSize = max(1, self.sampleBlockSize // numberOfSamples)
+    for begin in range(0, len(segments), blockSize):
+      profiles, fractions = self.sampleSegments(segments[begin:begin + blockSize], step)
+      minimumValues[begin:begin + blockSize] = profiles.min(axis=1)
+    return minimumValues
+
+  def segmentCrossings(self, start, end, threshold, step=None):
+    """
+    Positions along the segment where the field crosses threshold, linearly interpolated between samples.
+    """
+    start = numpy.array(start, dtype=numpy.float64)
+    end = numpy.array(end, dtype=numpy.float64)
+    profiles, fractions = self.sampleSegments(numpy.array([[start, end]]), step)
+    offsets = profiles[0] - threshold
+    crossing = numpy.nonzero(numpy.signbit(offsets[:-1]) != numpy.signbit(offsets[1:]))[0]
+    weights = offsets[crossing] / (offsets[crossing] - offsets[crossing + 1])
+    crossingFractions = fractions[crossing] + weights * (fractions[crossing + 1] - fractions[crossing])
+    return start + crossingFractions[:, numpy.newaxis] * (end - start)
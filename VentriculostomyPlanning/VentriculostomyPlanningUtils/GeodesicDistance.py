@@ -0,0 +1,211 @@
+import heapq
+from collections import OrderedDict
+import numpy
+try:
+  import scipy.sparse
+  import scipy.sparse.linalg
+  import scipy.sparse.csgraph
+except ImportError:
+  scipy = None
+
+class GeodesicDistance(object):
+  """
+  Geodesic distances on a triangle mesh, given as the vertices (V,3) and triangles (T,3) of getTriangleArrays.
+  With scipy the heat method is used: the two sparse systems (heat flow and Poisson) are factorized at the first
+  query which needs them, once per mesh, and each query costs two back substitutions. Queries restricted to a band
+  are shortest paths and never factorize them. Without scipy, or with method "dijkstra", distances are
+  shortest paths along the mesh edges. The fields of the last sources are kept, so repeated queries from the
+  same landmark are free.
+  """
+
+  def __init__(self, vertices, triangles, method=None, maximumNumberOfFields=8):
+    vertices = numpy.asarray(vertices, dtype=numpy.float64)
+    triangles = numpy.asarray(triangles, dtype=numpy.int64).reshape(-1, 3)
+    edge1 = vertices[triangles[:, 1]] - vertices[triangles[:, 0]]
+    edge2 = vertices[triangles[:, 2]] - vertices[triangles[:, 0]]
+    triangles = triangles[numpy.linalg.norm(numpy.cross(edge1, edge2), axis=1) > 1e-12]
+    # vertices which are not used by any triangle are dropped, they would make the systems singular
+    self.meshVertexIds, triangles = numpy.unique(triangles, return_inverse=True)
+    self.triangles = triangles.reshape(-1, 3)
+    self.vertices = vertices[self.meshVertexIds]
+    self.numberOfVertices = len(self.vertices)
+    self.method = method if method else ("heat" if scipy else "dijkstra")
+    if self.method == "heat" and not scipy:
+      raise ValueError("The heat method needs scipy")
+    self.maximumNumberOfFields = maximumNumberOfFields
+    self.fields = OrderedDict()
+    self.buildEdges()
+    # built by the first solveHeat
+    self.solveHeatFlow = None
+    self.solvePoisson = None
+
+  def buildEdges(self):
+    # vertex adjacency in CSR form, neighbors of vertex i are neighbors[offsets[i]:offsets[i+1]]
+    edges = numpy.vstack((self.triangles[:, [0, 1]], self.triangles[:, [1, 2]], self.triangles[:, [2, 0]]))
+    edges = numpy.vstack((edges, edges[:, ::-1]))
+    edges = edges[numpy.lexsort((edges[:, 1], edges[:, 0]))]
+    edges = edges[numpy.concatenate(([True], numpy.any(edges[1:] != edges[:-1], axis=1)))]
+    self.neighbors = edges[:, 1]
+    self.offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(edges[:, 0], minlength=self.numberOfVertices))))
+    self.edgeLengths = numpy.linalg.norm(self.vertices[edges[:, 1]] - self.vertices[edges[:, 0]], axis=1)
+    self.edges = edges
+
+  def getCotangents(self):
+    # cotangent of the corner angle of every triangle, column c is the corner at triangles[:, c]
+    cotangents = numpy.zeros(self.triangles.shape)
+    for corner in range(3):
+      origin = self.vertices[self.triangles[:, corner]]
+      vector1 = self.vertices[self.triangles[:, (corner + 1) % 3]] - origin
+      vector2 = self.vertices[self.triangles[:, (corner + 2) % 3]] - origin
+      cotangents[:, corner] = numpy.einsum('ij,ij->i', vector1, vector2) / numpy.linalg.norm(numpy.cross(vector1, vector2), axis=1)
+    return cotangents
+
+  def buildHeatSolvers(self):
+    vertices, triangles = self.vertices, self.triangles
+    numberOfVertices = self.numberOfVertices
+    self.cotangents = self.getCotangents()
+    # positive semi-definite cotangent Laplacian, the weight of an edge is half the cotangent of the opposite corners
+    rows, columns, weights = [], [], []
+    for corner in range(3):
+      first, second = triangles[:, (corner + 1) % 3], triangles[:, (corner + 2) % 3]
+      weight = 0.5 * self.cotangents[:, corner]
+      rows.extend((first, second, first, second))
+      columns.extend((second, first, first, second))
+      weights.extend((-weight, -weight, weight, weight))
+    laplacian = scipy.sparse.coo_matrix((numpy.concatenate(weights), (numpy.concatenate(rows), numpy.concatenate(columns))),
+                                        shape=(numberOfVertices, numberOfVertices)).tocsc()
+    normals = numpy.cross(vertices[triangles[:, 1]] - vertices[triangles[:, 0]], vertices[triangles[:, 2]] - vertices[triangles[:, 0]])
+    self.triangleAreas = 0.5 * numpy.linalg.norm(normals, axis=1)
+    self.triangleNormals = normals / (2.0 * self.triangleAreas[:, numpy.newaxis])
+    masses = numpy.bincount(triangles.ravel(), weights=numpy.repeat(self.triangleAreas / 3.0, 3), minlength=numberOfVertices)
+    mass = scipy.sparse.diags(masses, 0, format="csc")
+    timeStep = numpy.mean(self.edgeLengths) ** 2
+    self.solveHeatFlow = scipy.sparse.linalg.factorized((mass + timeStep * laplacian).tocsc())
+    # the Poisson system is only defined up to a constant, the small mass term makes it invertible
+    self.solvePoisson = scipy.sparse.linalg.factorized((laplacian + 1e-8 * mass).tocsc())
+
+  def findClosestVertex(self, point, vertexIds=None):
+    # with vertexIds, the index of the closest of these vertices in vertexIds
+    vertices = self.vertices if vertexIds is None else self.vertices[vertexIds]
+    return int(numpy.argmin(numpy.sum((vertices - numpy.asarray(point, dtype=numpy.float64)) ** 2, axis=1)))
+
+  def getDistanceField(self, sourcePoints, bandMask=None):
+    """
+    Geodesic distance of every mesh vertex to the closest of the (N,3) sourcePoints, which are snapped to the mesh.
+    With bandMask (V,) the distances are shortest paths along the edges between the selected vertices, e.g. the band
+    of a plane, so that the paths traced on the field stay in the band; the other vertices are at an infinite distance.
+    Returns the vertices (V,3) and the distances (V,).
+    """
+    sourcePoints = numpy.asarray(sourcePoints, dtype=numpy.float64).reshape(-1, 3)
+    bandKey = None
+    if bandMask is None:
+      sources = tuple(sorted(set(self.findClosestVertex(point) for point in sourcePoints)))
+    else:
+      bandMask = numpy.asarray(bandMask, dtype=bool)
+      if not bandMask.any():
+        return self.vertices, numpy.full(self.numberOfVertices, numpy.inf)
+      bandIds = numpy.nonzero(bandMask)[0]
+      sources = tuple(sorted(set(int(bandIds[self.findClosestVertex(point, bandIds)]) for point in sourcePoints)))
+      bandKey = numpy.packbits(bandMask).tobytes()
+    key = (sources, bandKey)
+    field = self.fields.pop(key, None)
+    if field is None:
+      if bandMask is not None:
+        field = self.solveDijkstra(sources, bandMask)
+      else:
+        field = self.solveHeat(sources) if self.method == "heat" else self.solveDijkstra(sources)
+    self.fields[key] = field
+    while len(self.fields) > self.maximumNumberOfFields:
+      self.fields.popitem(last=False)
+    return self.vertices, field
+
+  def solveHeat(self, sources):
+    if self.solveHeatFlow is None:
+      self.buildHeatSolvers()
+    sources = numpy.array(sources)
+    vertices, triangles = self.vertices, self.triangles
+    initialHeat = numpy.zeros(self.numberOfVertices)
+    initialHeat[sources] = 1.0
+    heat = self.solveHeatFlow(initialHeat)
+    # normalized gradient of the heat per triangle, the sum over the corners of u_c (N x opposite edge) / 2A
+    gradient = numpy.zeros((len(triangles), 3))
+    for corner in range(3):
+      oppositeEdge = vertices[triangles[:, (corner + 2) % 3]] - vertices[triangles[:, (corner + 1) % 3]]
+      gradient += heat[triangles[:, corner]][:, numpy.newaxis] * numpy.cross(self.triangleNormals, oppositeEdge)
+    gradient /= (2.0 * self.triangleAreas)[:, numpy.newaxis]
+    field = -gradient / numpy.maximum(numpy.linalg.norm(gradient, axis=1), 1e-20)[:, numpy.newaxis]
+    # integrated divergence at each corner: (cot of the corner opposite to e1 * e1.X + cot opposite to e2 * e2.X) / 2
+    divergence = numpy.zeros(self.numberOfVertices)
+    for corner in range(3):
+      first, second = (corner + 1) % 3, (corner + 2) % 3
+      origin = vertices[triangles[:, corner]]
+      edge1 = vertices[triangles[:, first]] - origin
+      edge2 = vertices[triangles[:, second]] - origin
+      contribution = 0.5 * (self.cotangents[:, second] * numpy.einsum('ij,ij->i', edge1, field)
+                            + self.cotangents[:, first] * numpy.einsum('ij,ij->i', edge2, field))
+      divergence += numpy.bincount(triangles[:, corner], weights=contribution, minlength=self.numberOfVertices)
+    distance = self.solvePoisson(-divergence)
+    distance -= distance[sources].min()
+    return numpy.maximum(distance, 0.0)
+
+  def solveDijkstra(self, sources, bandMask=None):
+    # with bandMask only the edges between two selected vertices are followed
+    edgeMask = None if bandMask is None else (bandMask[self.edges[:, 0]] & bandMask[self.edges[:, 1]])
+    if scipy:
+      edges, edgeLengths = self.edges, self.edgeLengths
+      if edgeMask is not None:
+        edges, edgeLengths = edges[edgeMask], edgeLengths[edgeMask]
+      graph = scipy.sparse.csr_matrix((edgeLengths, (edges[:, 0], edges[:, 1])), shape=(self.numberOfVertices, self.numberOfVertices))
+      return numpy.atleast_2d(scipy.sparse.csgraph.dijkstra(graph, directed=False, indices=list(sources))).min(axis=0)
+    distance = numpy.full(self.numberOfVertices, numpy.inf)
+    queue = [(0.0, source) for source in sources]
+    distance[list(sources)] = 0.0
+    while queue:
+      currentDistance, vertex = heapq.heappop(queue)
+      if currentDistance > distance[vertex]:
+        continue
+      for index in range(self.offsets[vertex], self.offsets[vertex + 1]):
+        if edgeMask is not None and not edgeMask[index]:
+          continue
+        neighbor = self.neighbors[index]
+        candidateDistance = currentDistance + self.edgeLengths[index]
+        if candidateDistance < distance[neighbor]:
+          distance[neighbor] = candidateDistance
+          heapq.heappush(queue, (candidateDistance, neighbor))
+    return distance
+
+  def tracePath(self, distances, startVertex):
+    """
+    Follow the steepest descent of distances along the mesh edges from startVertex to a source vertex. Vertices at an
+    infinite distance are never entered, so on a field of getDistanceField with bandMask the path stays in the band.
+    Returns the (N,3) path points, from startVertex to the source.
+    """
+    path = [startVertex]
+    vertex = startVertex
+    while distances[vertex] > 0.0:
+      neighbors = self.neighbors[self.offsets[vertex]:self.offsets[vertex + 1]]
+      if not len(neighbors):
+        break
+      nextVertex = neighbors[numpy.argmin(distances[neighbors])]
+      if distances[nextVertex] >= distances[vertex]:
+        break
+      vertex = nextVertex
+      path.append(vertex)
+    return self.vertices[numpy.array(path)]
+
+  def findPointAtDistance(self, sourcePoint, distance, candidateMask=None, bandMask=None):
+    """
+    Among the vertices selected by candidateMask (V,), find the vertex whose geodesic distance to sourcePoint is
+    the closest to distance. With bandMask the distances and the path are restricted to the band, see getDistanceField.
+    Returns the index of that vertex and the geodesic path from sourcePoint to it, or (None, None) when no vertex
+    is selected.
+    """
+    vertices, distances = self.getDistanceField([sourcePoint], bandMask)
+    candidates = numpy.isfinite(distances)
+    if candidateMask is not None:
+      candidates &= candidateMask
+    if not candidates.any():
+      return None, None
+    candidateIds = numpy.nonzero(candidates)[0]
+    vertex = int(candidateIds[numpy.argmin(numpy.abs(distances[candidateIds] - distance))])
+    return vertex, self.tracePath(distances, vertex)[::-1]
@@ -0,0 +1,64 @@
+import numpy
+import SimpleITK as sitk
+from VentriculostomyPlanningUtils.LRUCache import LRUCache, getImageBytes
+
+class ImagePyramidCache(LRUCache):
+  """
+  Downsampled Int16 levels of scalar volume nodes, shared by the stages that work on a coarse volume.
+  Level f has the spacing multiplied by f, the same origin and direction and floor(size / f) voxels. With antiAlias
+  it is smoothed with a Gaussian of f / 2 voxels before resampling to avoid aliasing, otherwise it samples every f-th
+  voxel like the former resampling of the stages, which keeps binary thresholds of the level sharp. A level is built
+  from the finest cached level of the same kind whose factor divides f, the full resolution level comes from
+  volumeAccess. Entries are keyed like the images of VolumeAccessCache and replaced in the same way when the node is
+  modified, the least recently used levels are evicted once they take more than maximumNumberOfBytes.
+  """
+
+  def __init__(self, volumeAccess, maximumNumberOfBytes=128 * 1024 * 1024):
+    super(ImagePyramidCache, self).__init__(maximumNumberOfBytes)
+    self.volumeAccess = volumeAccess
+
+  def getImage(self, volumeNode, factor=1, antiAlias=True):
+    """
+    Return level factor of volumeNode as a SimpleITK Int16 image, it is shared by all callers and must not be modified.
+    Stages thresholding the level should pass antiAlias=False.
+    """
+    factor = int(factor)
+    if factor <= 1:
+      return self.volumeAccess.getImage(volumeNode, sitk.sitkInt16)
+    volumeKey = self.volumeAccess.getVolumeKey(volumeNode)
+    key = volumeKey + (factor, bool(antiAlias))
+    image = self.lookup(key)
+    if image is not None:
+      return image
+    self.removeStaleEntries(volumeKey)
+    finerFactors = [cachedKey[-2] for cachedKey in self.entries
+                    if cachedKey[:-2] == volumeKey and cachedKey[-1] == bool(antiAlias) and factor % cachedKey[-2] == 0]
+    finerFactor = max(finerFactors) if finerFactors else 1
+    image = self.downsample(self.getImage(volumeNode, finerFactor, antiAlias), factor // finerFactor, antiAlias)
+    return self.store(key, image, getImageBytes(image))
+
+  def getArray(self, volumeNode, factor=1, antiAlias=True):
+    """
+    Return level factor of volumeNode as a read-only NumPy array indexed [k, j, i], see VolumeAccessCache.getArray.
+    It stays valid while the image is referenced.
+    """
+    return self.volumeAccess.getArray(self.getImage(volumeNode, factor, antiAlias))
+
+  def downsample(self, image, factor, antiAlias=True):
+    if factor <= 1:
+      return image
+    spacing = numpy.array(image.GetSpacing())
+    resampleFilter = sitk.ResampleImageFilter()
+    resampleFilter.SetSize([int(size // factor) for size in image.GetSize()])
+    resampleFilter.SetOutputSpacing([float(value) for value in spacing * factor])
+    resampleFilter.SetOutputDirection(image.GetDirection())
+    resampleFilter.SetOutputOrigin(image.GetOrigin())
+    if not antiAlias:
+      # the output voxels fall on input voxels, which are taken as they are
+      resampleFilter.SetInterpolator(sitk.sitkNearestNeighbor)
+      return resampleFilter.Execute(image)
+    smoothingFilter = sitk.DiscreteGaussianImageFilter()
+    smoothingFilter.SetVariance([float(variance) for variance in (factor / 2.0 * spacing) ** 2])
+    smoothingFilter.SetUseImageSpacing(True)
+    smoothedImage = smoothingFilter.Execute(sitk.Cast(image, sitk.sitkFloat32))
+    return sitk.Cast(resampleFilter.Execute(smoothedImage), sitk.sitkInt16)
@@ -0,0 +1,56 @@
+import numpy
+from collections import OrderedDict
+
+class LRUCache(object):
+  """
+  Least recently used cache, the base of the locator, volume and image pyramid caches.
+  Every entry has a size, the least recently used entries are evicted once the sizes add up to more than
+  maximumSize, the entry just stored is kept even when it exceeds the budget on its own. Keys start with the
+  identity of the cached object followed by its state, see removeStaleEntries.
+  """
+
+  def __init__(self, maximumSize):
+    self.maximumSize = maximumSize
+    self.entries = OrderedDict()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+
+  def clear(self):
+    self.entries.clear()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+
+  def getStatistics(self):
+    return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "size": self.size}
+
+  def lookup(self, key):
+    """
+    Return the value stored for key and make it the most recently used entry, or None.
+    """
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.entries[key] = entry
+    return entry[0]
+
+  def removeStaleEntries(self, stateKey):
+    # the entries of a former state of the object are never requested again
+    for key in [key for key in self.entries if key[0] == stateKey[0] and key[:len(stateKey)] != stateKey]:
+      self.size -= self.entries.pop(key)[1]
+
+  def store(self, key, value, size=1):
+    if key in self.entries:
+      self.size -= self.entries.pop(key)[1]
+    self.entries[key] = (value, size)
+    self.size += size
+    while self.size > self.maximumSize and len(self.entries) > 1:
+      self.size -= self.entries.popitem(last=False)[1][1]
+    return value
+
+def getImageBytes(image):
+  # size of the entries holding SimpleITK images
+  return int(numpy.prod(image.GetSize())) * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
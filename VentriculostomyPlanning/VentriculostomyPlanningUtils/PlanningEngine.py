@@ -0,0 +1,709 @@
+import math
+import sys
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy
+import vtk
+from vtk.util import numpy_support
+from VentriculostomyPlanningUtils.SpatialLocatorCache import SpatialLocatorCache
+from VentriculostomyPlanningUtils.GeodesicDistance import GeodesicDistance
+from VentriculostomyPlanningUtils.Constants import CandidatePathFeasibility
+
+# the function evaluated by the forked workers of mapInParallel, set while the pool is running
+forkedFunction = None
+
+def callForkedFunction(shard):
+  return forkedFunction(shard)
+
+class PlanningEngine(object):
+  """
+  Geometric planning core of the module: sagittal plane, reference curves, candidate entry points, candidate path
+  filtering and ranking, and cannula angles. It works on NumPy arrays and VTK polydata only, without Qt or the MRML
+  scene, so it can be used from scripts, tests and worker processes. UsefulFunctions holds it next to the scene
+  dependent helpers and VentriculostomyPlanningLogic reads its inputs from the markups and nodes.
+  """
+
+  # one row per candidate path, see filterCandidatePaths
+  candidatePathDtype = numpy.dtype([("target", numpy.float64, (3,)),
+                                    ("entry", numpy.float64, (3,)),
+                                    ("skullEntry", numpy.float64, (3,)),
+                                    ("distanceToKocher", numpy.float64),
+                                    ("distanceToNasion", numpy.float64),
+                                    ("clearance", numpy.float64),
+                                    ("angleToVentricleAxis", numpy.float64),
+                                    ("feasibility", numpy.uint8)])
+
+  def __init__(self):
+    self.locatorCache = SpatialLocatorCache()
+    # candidate batches smaller than parallelShardSize are evaluated in the calling thread
+    self.numberOfWorkers = multiprocessing.cpu_count()
+    self.parallelShardSize = 4096
+    # forking is not available on Windows and not safe in a GUI process on macOS
+    self.forkProcesses = sys.platform.startswith("linux")
+
+  def cutPolyDataPoints(self, polyData, plane):
+    """
+    Cut polyData with plane (vtkCutter) and return the cut points as an (N,3) float64 array.
+    """
+    cutter = vtk.vtkCutter()
+    cutter.SetCutFunction(plane)
+    cutter.SetInputData(polyData)
+    cutter.Update()
+    points = cutter.GetOutput().GetPoints()
+    if (points is None) or (not points.GetNumberOfPoints()):
+      return numpy.zeros((0, 3))
+    return numpy_support.vtk_to_numpy(points.GetData()).astype(numpy.float64)
+
+  def vtkMatrixToNumpy(self, matrix):
+    return numpy.array([[matrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+  def numpyToVTKPoints(self, pointArray):
+    """
+    Wrap an (N,3) array as vtkPoints without copying. The caller has to keep pointArray alive
+    as long as the points are in use, because VTK only borrows the buffer.
+    """
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(pointArray), deep=False))
+    return points
+
+  def setLineSegments(self, polyData, segments):
+    """
+    Replace the points and cells of polyData with one line cell per segment of the (N,2,3) segments array.
+    The points and the cell connectivity are converted from NumPy in one call each.
+    """
+    segments = numpy.asarray(segments, dtype=numpy.float64).reshape(-1, 2, 3)
+    numberOfSegments = len(segments)
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(segments.reshape(-1, 3)), deep=True))
+    connectivity = numpy.empty((numberOfSegments, 3), dtype=numpy_support.ID_TYPE_CODE)
+    connectivity[:, 0] = 2
+    connectivity[:, 1] = numpy.arange(0, 2 * numberOfSegments, 2)
+    connectivity[:, 2] = connectivity[:, 1] + 1
+    lines = vtk.vtkCellArray()
+    lines.SetCells(numberOfSegments, numpy_support.numpy_to_vtkIdTypeArray(connectivity.ravel(), deep=True))
+    polyData.SetPoints(points)
+    polyData.SetLines(lines)
+    polyData.SetPolys(vtk.vtkCellArray())
+    polyData.Modified()
+
+  def getCandidateDiscGrid(self, entryRadius, radiusResolution, phiResolution):
+    """
+    Radii and unit directions of the candidate entry disc, the upper half circle is sampled counterclockwise from 0
+    and the lower half circle mirrored, so both start on the x axis. Returns (radii, cosines, sines).
+    """
+    radii = numpy.arange(radiusResolution, entryRadius + radiusResolution, radiusResolution)
+    upperAngles = numpy.arange(0, numpy.pi, phiResolution)
+    lowerAngles = numpy.arange(numpy.pi, 2 * numpy.pi, phiResolution)
+    cosines = numpy.concatenate((numpy.cos(upperAngles), -numpy.cos(lowerAngles)))
+    sines = numpy.concatenate((numpy.sin(upperAngles), numpy.sin(lowerAngles)))
+    return radii, cosines, sines
+
+  def generateCandidateEntryPoints(self, matrix, basePoint, entryRadius, radiusResolution, phiResolution, firstPoint=None):
+    """
+    Sample the candidate entry disc in one broadcast transform.
+    The disc lies in the xy plane of matrix and is centered at basePoint, the ordering (radius major,
+    then angle) is the same as the former nested loops. firstPoint, if given, is prepended.
+    Returns a contiguous (N,3) float32 array.
+    """
+    radii, cosines, sines = self.getCandidateDiscGrid(entryRadius, radiusResolution, phiResolution)
+    discPoints = numpy.zeros((radii.size, cosines.size, 3))
+    discPoints[:, :, 0] = radii[:, numpy.newaxis] * cosines[numpy.newaxis, :]
+    discPoints[:, :, 1] = radii[:, numpy.newaxis] * sines[numpy.newaxis, :]
+    fullMatrix = self.vtkMatrixToNumpy(matrix)
+    candidates = discPoints.reshape(-1, 3).dot(fullMatrix[:3, :3].T) + fullMatrix[:3, 3] + numpy.array(basePoint)
+    if firstPoint is not None:
+      candidates = numpy.vstack((numpy.array(firstPoint, dtype=numpy.float64).reshape(1, 3), candidates))
+    return numpy.ascontiguousarray(candidates, dtype=numpy.float32)
+
+  def adaptiveCandidateEntryPoints(self, matrix, basePoint, entryRadius, radiusResolution, phiResolution, evaluate,
+                                   coarseLevel=3, refinementBudget=3000, refinementDistance=0.0, firstPoint=None):
+    """
+    Coarse to fine counterpart of generateCandidateEntryPoints, on the radii and directions of the same disc grid.
+    The disc is first sampled on a (radius, angle) grid 2**coarseLevel times coarser than the given resolutions.
+    Level by level, the cells whose corners disagree on feasibility, or whose closest corner is within
+    refinementDistance of the point of interest, are split in four until the full resolution is reached or
+    refinementBudget points have been evaluated; the cells closest to the point of interest are split first.
+    evaluate(points) takes (N,3) points and returns their candidate path table (see evaluateCandidateEntryPoints),
+    a point is feasible when its path has all the feasibility bits.
+    Returns the evaluated points as a contiguous (N,3) float32 array and their candidate path table, so the paths do
+    not have to be tested again. firstPoint, if given, is evaluated and prepended.
+    """
+    radii, cosines, sines = self.getCandidateDiscGrid(entryRadius, radiusResolution, phiResolution)
+    # the mirrored half circles share the direction on the x axis, the directions are walked around the circle once
+    directions = numpy.unique(numpy.round(numpy.arctan2(sines, cosines), 12), return_index=True)[1]
+    cosines, sines = cosines[directions], sines[directions]
+    radii = numpy.concatenate(([0.0], radii))
+    numOfRadii = len(radii) - 1
+    numOfAngles = len(cosines)
+    fullMatrix = self.vtkMatrixToNumpy(matrix)
+    rotation = fullMatrix[:3, :3].T
+    offset = fullMatrix[:3, 3] + numpy.array(basePoint)
+    # row 0 is the disc center, which is not sampled, same as generateCandidateEntryPoints
+    evaluated = numpy.zeros((numOfRadii + 1, numOfAngles), dtype=bool)
+    candidatePaths = numpy.zeros((numOfRadii + 1, numOfAngles), dtype=self.candidatePathDtype)
+    feasible = numpy.zeros((numOfRadii + 1, numOfAngles), dtype=bool)
+    distance = numpy.full((numOfRadii + 1, numOfAngles), numpy.inf)
+
+    def toDisc(radiusIndices, angleIndices):
+      discPoints = numpy.zeros((len(radiusIndices), 3))
+      discPoints[:, 0] = radii[radiusIndices] * cosines[angleIndices]
+      discPoints[:, 1] = radii[radiusIndices] * sines[angleIndices]
+      return discPoints.dot(rotation) + offset
+
+    step = 2 ** max(0, int(coarseLevel))
+    radiusStarts = numpy.arange(1, max(numOfRadii, 2), step)
+    angleStarts = numpy.arange(0, numOfAngles, step)
+    cellRadii, cellAngles = [grid.ravel() for grid in numpy.meshgrid(radiusStarts, angleStarts, indexing='ij')]
+    while len(cellRadii) and numOfRadii:
+      radiusEnds = numpy.minimum(cellRadii + step, numOfRadii)
+      angleEnds = numpy.minimum(cellAngles + step, numOfAngles)
+      cornerRadii = numpy.stack((cellRadii, radiusEnds, cellRadii, radiusEnds), axis=1)
+      cornerAngles = numpy.stack((cellAngles, cellAngles, angleEnds, angleEnds), axis=1) % numOfAngles
+      # the corners shared by neighbouring cells, or by the parent level, are evaluated only once
+      flatIndices = numpy.unique(cornerRadii.ravel() * numOfAngles + cornerAngles.ravel())
+      pendingRadii, pendingAngles = flatIndices // numOfAngles, flatIndices % numOfAngles
+      pending = ~evaluated[pendingRadii, pendingAngles]
+      pendingRadii, pendingAngles = pendingRadii[pending], pendingAngles[pending]
+      if len(pendingRadii):
+        pendingPaths = evaluate(toDisc(pendingRadii, pendingAngles))
+        evaluated[pendingRadii, pendingAngles] = True
+        candidatePaths[pendingRadii, pendingAngles] = pendingPaths
+        feasible[pendingRadii, pendingAngles] = (pendingPaths["feasibility"] & CandidatePathFeasibility.All) == CandidatePathFeasibility.All
+        distance[pendingRadii, pendingAngles] = pendingPaths["distanceToKocher"]
+      if step == 1:
+        break
+      cornerFeasible = feasible[cornerRadii, cornerAngles]
+      cornerDistance = distance[cornerRadii, cornerAngles].min(axis=1)
+      refine = (cornerFeasible.any(axis=1) != cornerFeasible.all(axis=1)) | (cornerDistance < refinementDistance)
+      cellRadii, cellAngles, cornerDistance = cellRadii[refine], cellAngles[refine], cornerDistance[refine]
+      cellRadiusEnds, cellAngleEnds = radiusEnds[refine], angleEnds[refine]
+      # a split cell needs at most five new points
+      remaining = max(0, refinementBudget - int(evaluated.sum()))
+      if 5 * len(cellRadii) > remaining:
+        kept = numpy.argsort(cornerDistance, kind='mergesort')[:remaining // 5]
+        cellRadii, cellAngles = cellRadii[kept], cellAngles[kept]
+        cellRadiusEnds, cellAngleEnds = cellRadiusEnds[kept], cellAngleEnds[kept]
+      step //= 2
+      childRadii = numpy.concatenate((cellRadii, cellRadii + step, cellRadii, cellRadii + step))
+      childAngles = numpy.concatenate((cellAngles, cellAngles, cellAngles + step, cellAngles + step))
+      valid = (childRadii < numpy.tile(cellRadiusEnds, 4)) & (childAngles < numpy.tile(cellAngleEnds, 4))
+      cellRadii, cellAngles = childRadii[valid], childAngles[valid]
+
+    radiusIndices, angleIndices = numpy.nonzero(evaluated)
+    candidates = toDisc(radiusIndices, angleIndices)
+    candidatePaths = candidatePaths[radiusIndices, angleIndices]
+    if firstPoint is not None:
+      firstPoint = numpy.array(firstPoint, dtype=numpy.float64).reshape(1, 3)
+      candidates = numpy.vstack((firstPoint, candidates))
+      candidatePaths = numpy.concatenate((evaluate(firstPoint), candidatePaths))
+    return numpy.ascontiguousarray(candidates, dtype=numpy.float32), candidatePaths
+
+  def getTriangleArrays(self, polyData):
+    """
+    Return the vertices (V,3) and triangle vertex indices (T,3) of polyData, strips and polygons are triangulated.
+    The arrays are cached until polyData is modified.
+    """
+    if (not polyData) or (not polyData.GetNumberOfPoints()):
+      return numpy.zeros((0, 3)), numpy.zeros((0, 3), dtype=numpy.int64)
+    return self.locatorCache.get(polyData, "triangleArrays", self.buildTriangleArrays)
+
+  def buildTriangleArrays(self, polyData):
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(polyData)
+    triangleFilter.PassVertsOff()
+    triangleFilter.PassLinesOff()
+    triangleFilter.Update()
+    triangulated = triangleFilter.GetOutput()
+    if not triangulated.GetNumberOfPolys():
+      return numpy.zeros((0, 3)), numpy.zeros((0, 3), dtype=numpy.int64)
+    vertices = numpy_support.vtk_to_numpy(triangulated.GetPoints().GetData()).astype(numpy.float64)
+    cells = numpy_support.vtk_to_numpy(triangulated.GetPolys().GetData())
+    triangles = cells.reshape(-1, 4)[:, 1:].astype(numpy.int64)
+    return vertices, triangles
+
+  def getPointNormals(self, polyData):
+    """
+    Return the point normals (V,3) of polyData, computed with vtkPolyDataNormals when the model has none.
+    Undefined normals are set to zero. The array is cached until polyData is modified.
+    """
+    return self.locatorCache.get(polyData, "pointNormals", self.buildPointNormals)
+
+  def buildPointNormals(self, polyData):
+    normals = polyData.GetPointData().GetNormals()
+    if normals is None:
+      normalFilter = vtk.vtkPolyDataNormals()
+      normalFilter.SetInputData(polyData)
+      normalFilter.ComputePointNormalsOn()
+      normalFilter.ComputeCellNormalsOff()
+      normalFilter.SplittingOff()
+      normalFilter.Update()
+      normals = normalFilter.GetOutput().GetPointData().GetNormals()
+    normalArray = numpy_support.vtk_to_numpy(normals).astype(numpy.float64).reshape(-1, 3)
+    normalArray[~numpy.all(numpy.isfinite(normalArray), axis=1)] = 0.0
+    return normalArray
+
+  def getSurfaceNormals(self, polyData, positions, radius):
+    """
+    Average of the point normals of polyData within radius of each of the (N,3) positions, the normal of the
+    closest point is used where no point is within radius. Returns the normalized (N,3) normals.
+    """
+    positions = numpy.asarray(positions, dtype=numpy.float64).reshape(-1, 3)
+    if not len(positions):
+      return numpy.zeros((0, 3))
+    pointNormals = self.getPointNormals(polyData)
+    pointLocator = self.locatorCache.getPointLocator(polyData)
+    pointIds = vtk.vtkIdList()
+    neighborIds = []
+    for position in positions:
+      pointLocator.FindPointsWithinRadius(radius, position, pointIds)
+      ids = [pointIds.GetId(index) for index in range(pointIds.GetNumberOfIds())]
+      neighborIds.append(ids if ids else [pointLocator.FindClosestPoint(position)])
+    queryIds = numpy.repeat(numpy.arange(len(positions)), [len(ids) for ids in neighborIds])
+    neighborIds = numpy.concatenate([numpy.array(ids, dtype=numpy.int64) for ids in neighborIds])
+    averageNormals = numpy.zeros((len(positions), 3))
+    for axis in range(3):
+      averageNormals[:, axis] = numpy.bincount(queryIds, weights=pointNormals[neighborIds, axis], minlength=len(positions))
+    return averageNormals / numpy.maximum(numpy.linalg.norm(averageNormals, axis=1), 1e-12)[:, numpy.newaxis]
+
+  def getGeodesicDistance(self, polyData):
+    # the factorized solvers and the distance fields are kept until polyData is modified
+    return self.locatorCache.get(polyData, "geodesicDistance", self.buildGeodesicDistance)
+
+  def buildGeodesicDistance(self, polyData):
+    vertices, triangles = self.getTriangleArrays(polyData)
+    return GeodesicDistance(vertices, triangles)
+
+  def intersectSegmentsWithPolyData(self, segments, polyData, tolerance=1e-2):
+    """
+    Intersect a batch of line segments with the surface of polyData.
+    segments is an (N,2,3) array of [start, end] pairs. Returns the hit flags (N,), the first hit point
+    along each segment seen from its start (N,3) and the distance from the start to that point (N,),
+    segments without intersection get a zero point and an infinite distance. Only the interface is batched: each
+    segment is one query of the cached cell locator of polyData, with the tolerance of the former per-path ray
+    casting. A NumPy segment/triangle test over getTriangleArrays was measured to be slower than these queries.
+    """
+    segments = numpy.asarray(segments, dtype=numpy.float64).reshape(-1, 2, 3)
+    numberOfSegments = segments.shape[0]
+    hits = numpy.zeros(numberOfSegments, dtype=bool)
+    hitPoints = numpy.zeros((numberOfSegments, 3))
+    hitDistances = numpy.full(numberOfSegments, numpy.inf)
+    if numberOfSegments == 0 or (not polyData) or (not polyData.GetNumberOfCells()):
+      return hits, hitPoints, hitDistances
+    locator = self.locatorCache.getCellLocator(polyData)
+    t = vtk.mutable(0.0)
+    x = [0.0, 0.0, 0.0]
+    pcoords = [0.0, 0.0, 0.0]
+    subId = vtk.mutable(0)
+    lengths = numpy.linalg.norm(segments[:, 1, :] - segments[:, 0, :], axis=1)
+    for index, (start, end) in enumerate(segments.tolist()):
+      if locator.IntersectWithLine(start, end, tolerance, t, x, pcoords, subId):
+        hits[index] = True
+        hitPoints[index] = x
+        hitDistances[index] = float(t) * lengths[index]
+    return hits, hitPoints, hitDistances
+
+  def rankCandidatePaths(self, values, k, largestFirst=False):
+    """
+    Return the indices of the k smallest (or largest) values, best first.
+    The k best are selected with argpartition and only those are sorted, NaN values are ranked last.
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    if largestFirst:
+      values = -values
+    k = min(int(k), len(values))
+    if k <= 0:
+      return numpy.zeros(0, dtype=numpy.int64)
+    indices = numpy.arange(len(values)) if k == len(values) else numpy.argpartition(values, k - 1)[:k]
+    return indices[numpy.argsort(values[indices], kind='mergesort')]
+
+  def mapInParallel(self, function, array, numberOfWorkers=None, useProcesses=False):
+    """
+    Split array along its first axis into one shard per worker, evaluate function on the shards in a thread
+    pool and concatenate the results (function may return an array or a tuple of arrays).
+    The NumPy kernels release the GIL, so the shards run on separate cores while sharing the read-only inputs.
+    The VTK queries hold the GIL, with useProcesses their shards are evaluated in forked worker processes which
+    inherit function and the cached locators, only the shards and the results are copied. Processes are only
+    forked on Linux, see forkProcesses, elsewhere the array is evaluated in the calling thread.
+    """
+    global forkedFunction
+    if numberOfWorkers is None:
+      numberOfWorkers = self.numberOfWorkers
+    numberOfShards = min(numberOfWorkers, int(math.ceil(len(array) / float(self.parallelShardSize))))
+    if numberOfShards <= 1 or (useProcesses and not self.forkProcesses):
+      return function(array)
+    shards = numpy.array_split(array, numberOfShards)
+    if useProcesses:
+      forkedFunction = function
+      pool = multiprocessing.Pool(numberOfShards)
+      try:
+        results = pool.map(callForkedFunction, shards)
+      finally:
+        pool.close()
+        pool.join()
+        forkedFunction = None
+    else:
+      pool = ThreadPool(numberOfShards)
+      try:
+        results = pool.map(function, shards)
+      finally:
+        pool.close()
+        pool.join()
+    if isinstance(results[0], tuple):
+      return tuple(numpy.concatenate([result[index] for result in results]) for index in range(len(results[0])))
+    return numpy.concatenate(results)
+
+  def getTrueSagittalPlane(self, posNasion, posSagittal):
+    """
+    Return the yaw angle and the vtkPlane of the true sagittal plane through posNasion and posSagittal.
+    """
+    sagittalYawAngle = -numpy.arctan2(posNasion[0] - posSagittal[0], posNasion[1] - posSagittal[1])
+    trueSagittalPlane = vtk.vtkPlane()
+    trueSagittalPlane.SetOrigin(posNasion[0], posNasion[1], posNasion[2])
+    trueSagittalPlane.SetNormal(math.cos(sagittalYawAngle), math.sin(sagittalYawAngle), 0)
+    return sagittalYawAngle, trueSagittalPlane
+
+  def getAxisTransform(self, posStart, posEnd, transform=None):
+    # rotation of the z axis onto the direction from posStart to posEnd
+    direction = (numpy.array(posEnd) - numpy.array(posStart)) / numpy.linalg.norm(numpy.array(posStart) - numpy.array(posEnd))
+    angle = math.acos(numpy.dot(numpy.array([0, 0, 1.0]), direction))
+    rotationAxis = numpy.cross(numpy.array([0, 0, 1.0]), direction)
+    if transform is None:
+      transform = vtk.vtkTransform()
+    transform.Identity()
+    transform.RotateWXYZ(angle * 180.0 / numpy.pi, rotationAxis[0], rotationAxis[1], rotationAxis[2])
+    return transform
+
+  def isLeftHemisphere(self, trueSagittalPlane, posFrom, posTo):
+    # here left hemisphere means from the patient's perspective
+    return -numpy.sign(numpy.dot(numpy.array(posTo) - numpy.array(posFrom), numpy.array(trueSagittalPlane.GetNormal()))) >= 0
+
+  def extractContourPoints(self, polyData, plane, referencePoint, axis, useLeftHemisphere, targetDistance=None, planning=False):
+    """
+    Cut polyData with plane and keep the cut points on one side of referencePoint: above it for axis 0, on the
+    side of the hemisphere for axis 1. The planning curves take the opposite side, with a 1e-3 tolerance.
+    targetDistance, if given, also drops the points further away from referencePoint.
+    Returns the kept points as an (N,3) array ordered by increasing distance to referencePoint.
+    """
+    pointArray = self.cutPolyDataPoints(polyData, plane)
+    referencePoint = numpy.array(referencePoint, dtype=numpy.float64)
+    ## distance calculation could be simplified if the patient is well aligned in the scanner
+    distances = numpy.linalg.norm(pointArray - referencePoint, axis=1)
+    if axis == 0:
+      coordinate, sign = 2, 1.0
+    elif axis == 1:
+      coordinate, sign = 0, (-1.0 if useLeftHemisphere else 1.0)
+    else:
+      return numpy.zeros((0, 3))
+    if planning:
+      valid = -sign * (pointArray[:, coordinate] - referencePoint[coordinate]) > -1e-3
+    else:
+      valid = sign * (pointArray[:, coordinate] - referencePoint[coordinate]) >= 0.0
+    if targetDistance is not None:
+      valid &= distances < targetDistance
+    order = numpy.argsort(distances[valid], kind='mergesort')
+    return numpy.ascontiguousarray(pointArray[valid][order])
+
+  def selectCurveReferencePoints(self, pointArray, distance):
+    # every step-th contour point is kept until the cumulative arc length passes 85% of distance, the last fiducial
+    # is the first point beyond distance. Returns the fiducial positions, the end point of the curve and the step.
+    numOfPoints = len(pointArray)
+    step = int(0.02*numOfPoints) if int(0.02*numOfPoints) > 0 else 1
+    ApproximityPos = distance * 0.85
+    DestiationPos = distance
+
+    selected = [0]
+    for iPos in range(step, numOfPoints, step):
+      if numpy.linalg.norm(pointArray[iPos]-pointArray[selected[-1]]) <= 50.0:
+        selected.append(iPos)
+    selected = numpy.array(selected)
+    arcLength = numpy.concatenate(([0.0], numpy.cumsum(numpy.linalg.norm(numpy.diff(pointArray[selected], axis=0), axis=1))))
+    beyondApproximity = numpy.nonzero(arcLength > ApproximityPos)[0]
+    lastSelected = beyondApproximity[0] if len(beyondApproximity) else len(selected) - 1
+    selected = selected[:lastSelected+1]
+    curveLength = arcLength[lastSelected]
+    iPosValid = selected[-1]
+    candidates = numpy.arange(iPosValid, numOfPoints)
+    distanceToValid = numpy.linalg.norm(pointArray[candidates] - pointArray[iPosValid], axis=1)
+    isBeyond = (distanceToValid + curveLength > DestiationPos) | (candidates == numOfPoints-1)
+    destination = numpy.nonzero((distanceToValid <= 50.0) & isBeyond)[0]
+    jPos = numOfPoints - 1
+    if len(destination):
+      jPos = candidates[destination[0]]
+      selected = numpy.append(selected, jPos)
+    return pointArray[selected], tuple(pointArray[jPos]), step
+
+  def getGeodesicPlaneMask(self, geodesic, origin, normal):
+    # vertices of the skull model within two mean edge lengths of the plane
+    tolerance = 2.0 * numpy.mean(geodesic.edgeLengths)
+    return numpy.abs((geodesic.vertices - numpy.array(origin)).dot(numpy.array(normal, dtype=numpy.float64))) < tolerance
+
+  def getReferenceContour(self, polyData, plane, referencePoint, distance, axis, useLeftHemisphere, useGeodesic=False):
+    """
+    Ordered points of the reference curve from referencePoint, on the side given by axis as in extractContourPoints.
+    With useGeodesic it is the shortest path along the mesh edges within the band of the plane to the point at
+    distance, the plane cut is used when the skull model has no such point.
+    """
+    if useGeodesic:
+      geodesic = self.getGeodesicDistance(polyData)
+      vertices = geodesic.vertices
+      # the path is searched in the band of the plane, only its end is restricted to the side given by axis
+      bandMask = self.getGeodesicPlaneMask(geodesic, plane.GetOrigin(), plane.GetNormal())
+      if axis == 0:
+        mask = bandMask & (vertices[:, 2] >= referencePoint[2])
+      else:
+        mask = bandMask & ((vertices[:, 0] <= referencePoint[0]) if useLeftHemisphere else (vertices[:, 0] >= referencePoint[0]))
+      vertex, path = geodesic.findPointAtDistance(referencePoint, distance, mask, bandMask)
+      if vertex is not None:
+        return path
+    return self.extractContourPoints(polyData, plane, referencePoint, axis, useLeftHemisphere, distance)
+
+  def computeReferenceCurves(self, polyData, posNasion, trueSagittalPlane, sagittalYawAngle, sagittalReferenceLength,
+                             coronalReferenceLength, useGeodesic=False):
+    """
+    The sagittal reference curve runs from the nasion along the true sagittal plane for sagittalReferenceLength, the
+    coronal reference curve from its end along the coronal plane for coronalReferenceLength to the Kocher point.
+    The sagittal curve is shared, the coronal curve is computed for each hemisphere.
+    Returns a dict from useLeftHemisphere to (sagittal fiducials, sagittal step, coronal fiducials, coronal step,
+    Kocher point), hemispheres without a curve are left out.
+    """
+    curves = {}
+    sagittalPoints = self.getReferenceContour(polyData, trueSagittalPlane, posNasion, sagittalReferenceLength, 0, False, useGeodesic)
+    if not len(sagittalPoints):
+      return curves
+    sagittalPositions, posTop, sagittalStep = self.selectCurveReferencePoints(sagittalPoints, sagittalReferenceLength)
+    ##To do, calculate the curvature value points by point might be necessary to exclude the outliers
+    coronalPlane = vtk.vtkPlane()
+    coronalPlane.SetOrigin(posTop[0], posTop[1], posTop[2])
+    coronalPlane.SetNormal(math.sin(sagittalYawAngle), -math.cos(sagittalYawAngle), 0)
+    for useLeftHemisphere in (True, False):
+      coronalPoints = self.getReferenceContour(polyData, coronalPlane, posTop, coronalReferenceLength, 1, useLeftHemisphere, useGeodesic)
+      if len(coronalPoints):
+        coronalPositions, posKocher, coronalStep = self.selectCurveReferencePoints(coronalPoints, coronalReferenceLength)
+        curves[useLeftHemisphere] = (sagittalPositions, sagittalStep, coronalPositions, coronalStep, posKocher)
+    return curves
+
+  def getPathSegments(self, path):
+    # path is the flat list [target, entry, target, entry, ...], returned as (N,2,3) [entry, target] segments so
+    # that intersections are searched from the entry side, the same direction as the former per-path ray casting
+    numOfPaths = int(len(path)/2)
+    pathArray = numpy.array(path[:2*numOfPaths], dtype=numpy.float64).reshape(numOfPaths, 2, 3)
+    return numpy.ascontiguousarray(pathArray[:, ::-1, :])
+
+  def intersectPathSegments(self, segments, surfacePolyData):
+    # the locator is built before the workers are forked, so that they all query the same one
+    if surfacePolyData and surfacePolyData.GetNumberOfCells():
+      self.locatorCache.getCellLocator(surfacePolyData)
+    return self.mapInParallel(lambda shard: self.intersectSegmentsWithPolyData(shard, surfacePolyData), segments, useProcesses=True)
+
+  def getCollisionFreeMask(self, segments, vesselPolyData=None, distanceField=None, venousMargin=0.0):
+    """
+    Collision test of the (N,2,3) segments with the vessels, either the minimum of distanceField along the segments
+    is at least venousMargin, or the segments do not intersect vesselPolyData. Returns the mask and the clearance,
+    which is None without distanceField.
+    """
+    if distanceField is not None:
+      clearance = self.mapInParallel(distanceField.segmentMinimumValue, segments)
+      return clearance >= venousMargin, clearance
+    if vesselPolyData is not None:
+      return ~self.intersectPathSegments(segments, vesselPolyData)[0], None
+    return numpy.ones(len(segments), dtype=bool), None
+
+  def evaluateCandidateEntryPoints(self, posTarget, entryPoints, posKocher, posNasion, surfacePolyData, posteriorMargin,
+                                   kocherMargin, vesselPolyData=None, distanceField=None, venousMargin=0.0, ventricleDirection=None):
+    """
+    Candidate path table of the paths from posTarget to entryPoints, one row per entry point. Unlike
+    filterCandidatePaths the paths are not known to be collision free, the collision free bit is only set for the
+    paths passing the vessel collision test.
+    """
+    segments = numpy.empty((len(entryPoints), 2, 3))
+    segments[:, 0, :] = entryPoints
+    segments[:, 1, :] = posTarget
+    collisionFree, clearance = self.getCollisionFreeMask(segments, vesselPolyData, distanceField, venousMargin)
+    candidatePaths = self.filterCandidatePaths(segments, surfacePolyData, posKocher, posNasion, posteriorMargin, kocherMargin,
+                                               clearance, ventricleDirection)
+    candidatePaths["feasibility"] &= numpy.where(collisionFree, CandidatePathFeasibility.All,
+                                                 CandidatePathFeasibility.All & ~CandidatePathFeasibility.CollisionFree).astype(numpy.uint8)
+    return candidatePaths
+
+  def createCandidatePathTable(self, segments, hits, hitPoints, posKocher, posNasion, clearance=None, ventricleDirection=None):
+    """
+    Build the candidate path table of the collision free (N,2,3) [entry, target] segments and their skull intersections.
+    ventricleDirection points from the target to the distal end of the ventricle, NaN is stored for the unknown
+    values. Only the collision free bit is set.
+    """
+    candidatePaths = numpy.zeros(len(segments), dtype=self.candidatePathDtype)
+    candidatePaths["target"] = segments[:, 1, :]
+    candidatePaths["entry"] = segments[:, 0, :]
+    candidatePaths["skullEntry"] = numpy.where(hits[:, numpy.newaxis], hitPoints, numpy.nan)
+    candidatePaths["distanceToKocher"] = numpy.where(hits, numpy.linalg.norm(hitPoints - numpy.array(posKocher), axis=1), numpy.inf)
+    candidatePaths["distanceToNasion"] = numpy.where(hits, numpy.linalg.norm(hitPoints - numpy.array(posNasion), axis=1), numpy.inf)
+    candidatePaths["clearance"] = numpy.nan
+    if clearance is not None and len(clearance) == len(segments):
+      candidatePaths["clearance"] = clearance
+    candidatePaths["angleToVentricleAxis"] = numpy.nan
+    if ventricleDirection is not None:
+      directions = segments[:, 0, :] - segments[:, 1, :]
+      directions = directions / numpy.linalg.norm(directions, axis=1)[:, numpy.newaxis]
+      axis = numpy.array(ventricleDirection, dtype=numpy.float64) / numpy.linalg.norm(ventricleDirection)
+      candidatePaths["angleToVentricleAxis"] = numpy.arccos(numpy.clip(directions.dot(axis), -1.0, 1.0))
+    candidatePaths["feasibility"] = CandidatePathFeasibility.CollisionFree
+    return candidatePaths
+
+  def filterCandidatePaths(self, segments, surfacePolyData, posKocher, posNasion, posteriorMargin, kocherMargin,
+                           clearance=None, ventricleDirection=None):
+    """
+    Candidate path table of the collision free (N,2,3) [entry, target] segments, with the posterior and the Kocher
+    margin bits set from the intersection of the paths with surfacePolyData.
+    """
+    hits, hitPoints, hitDistances = self.intersectPathSegments(segments, surfacePolyData)
+    isPosteriorEnough = hits & (numpy.abs(hitPoints[:, 2] - posNasion[2]) > posteriorMargin)
+    #isPosteriorEnough = hits & (numpy.abs(hitPoints[:, 1] - posNasion[1]) > posteriorMargin)
+    candidatePaths = self.createCandidatePathTable(segments, hits, hitPoints, posKocher, posNasion, clearance, ventricleDirection)
+    isWithinKocherMargin = hits & (candidatePaths["distanceToKocher"] < kocherMargin)
+    candidatePaths["feasibility"] |= numpy.where(isPosteriorEnough, CandidatePathFeasibility.PosteriorEnough, 0).astype(numpy.uint8)
+    candidatePaths["feasibility"] |= numpy.where(isWithinKocherMargin, CandidatePathFeasibility.WithinKocherMargin, 0).astype(numpy.uint8)
+    return candidatePaths
+
+  def getTopCandidatePaths(self, candidatePaths, k=1, column="distanceToKocher", largestFirst=False, feasibility=CandidatePathFeasibility.All):
+    """
+    Return the k best rows of candidatePaths ranked by column, best first, among the paths having all the feasibility bits.
+    """
+    if candidatePaths is None:
+      return numpy.zeros(0, dtype=self.candidatePathDtype)
+    rows = candidatePaths[(candidatePaths["feasibility"] & feasibility) == feasibility]
+    return rows[self.rankCandidatePaths(rows[column], k, largestFirst)]
+
+  def computeCannulaAngles(self, posTarget, posEntry, skullNormal, sagittalYawAngle):
+    """
+    Angles in degree between the skull normal and the coronal and sagittal planes, and between the cannula and the
+    coronal plane and the skull normal. Returns (skullNormToCoronalAngle, skullNormToSagittalAngle,
+    cannulaToCoronalAngle, cannulaToNormAngle, navigationLines), the cannula angles are None when they can not be
+    computed and navigationLines are the (2,2,3) skull normal and cannula segments from the entry, or None.
+    """
+    p_ES = numpy.array([math.cos(sagittalYawAngle), math.sin(sagittalYawAngle), 0])
+    p_EC = numpy.array([-numpy.sin(sagittalYawAngle), numpy.cos(sagittalYawAngle), 0])
+    p_EN = numpy.array(skullNormal, dtype=numpy.float64)
+    skullNormToCoronalAngle = 90.0 - math.acos(abs(numpy.dot(p_EC, p_EN))) * 180.0 / numpy.pi
+    skullNormToSagittalAngle = 90.0 - math.acos(abs(numpy.dot(p_ES, p_EN))) * 180.0 / numpy.pi
+    p_EC = p_EC/numpy.linalg.norm(p_EC)
+    p_EN = p_EN/numpy.linalg.norm(p_EN)
+    p_ET = numpy.array(posEntry) - numpy.array(posTarget)
+    p_ET = p_ET / numpy.linalg.norm(p_ET)
+    cosCalc = numpy.dot(p_EN, p_ET)
+    sinCalc = math.sqrt(1 - cosCalc*cosCalc)
+    if cosCalc <= 1e-6: # p_EN and p_ET are perpendicular
+      return skullNormToCoronalAngle, skullNormToSagittalAngle, 0.0, 0.0, None
+    sinTheta1 = numpy.dot(p_EC, p_EN)
+    cosTheta1 = math.sqrt(1-sinTheta1*sinTheta1)
+    if cosTheta1 < cosCalc:  # here means no intesection between the coronal plan and the cone composed by p_EN and p_ET
+      p_EN2 = p_EN - p_EC * sinTheta1
+      p_EM = p_EN2 + p_EC * cosTheta1*(sinTheta1 * cosCalc - cosTheta1 * sinCalc) / (cosTheta1 * cosCalc + sinTheta1 * sinCalc)  # sin(theta1 - Calc) = sin(theta1)*cos(Calc) - cos(theta1)*sin(Calc)
+      p_EM = p_EM / numpy.linalg.norm(p_EM)
+    else:
+      p_EN2 = p_EN - p_EC * (sinTheta1)
+      cosTheta2 = cosCalc/cosTheta1
+      tanTheta2 =  math.sqrt(1/(cosTheta2*cosTheta2) - 1)
+      p_EM = p_EN2 + numpy.cross(p_EC, p_EN2)*tanTheta2
+      p_EM = p_EM / numpy.linalg.norm(p_EM)
+    if not p_EM.any():
+      return skullNormToCoronalAngle, skullNormToSagittalAngle, None, None, None
+    cosMT = numpy.dot(p_EM, p_ET)
+    navigationLines = numpy.array([[posEntry, numpy.array(posEntry) + p_EN * 80],
+                                   [posEntry, numpy.array(posEntry) + p_ET * 20]], dtype=numpy.float64)
+    return skullNormToCoronalAngle, skullNormToSagittalAngle, math.acos(cosMT) * 180.0 / numpy.pi, math.acos(cosCalc) * 180.0 / numpy.pi, navigationLines
+
+  def getCandidateCone(self, skullPolyData, posTarget, posDistal, cylinderRadius=2.5):
+    """
+    Cone of the candidate paths of planCandidatePaths, from the center of the ventricle axis to the entry disc beyond
+    the skull. Returns (posEntry, posCenter, entryRadius, basePoint, direction): the outermost intersection of the axis
+    with skullPolyData, the apex, the radius and the center of the disc and the unit direction of the axis, which is
+    the normal of the disc. Returns None when the axis does not meet skullPolyData.
+    """
+    posTarget, posDistal = numpy.array(posTarget, dtype=numpy.float64), numpy.array(posDistal, dtype=numpy.float64)
+    # the entry of the ventricle axis is its outermost intersection with the skull
+    direction = (posDistal - posTarget)/numpy.linalg.norm(posDistal - posTarget)
+    hits, hitPoints, hitDistances = self.intersectSegmentsWithPolyData(numpy.array([[posTarget + 1e3*direction, posTarget]]), skullPolyData)
+    if not hits[0]:
+      return None
+    posEntry = hitPoints[0]
+    posCenter = (posTarget + posDistal)/2.0
+    # all the cylinder bottom are possible target points
+    entryRadius = cylinderRadius * numpy.linalg.norm(posTarget - posEntry) / (numpy.linalg.norm(posTarget - posDistal)/2)
+    basePoint = posTarget + (posEntry - posTarget) * 1.2
+    return posEntry, posCenter, entryRadius, basePoint, direction
+
+  def getCandidateConeBounds(self, skullPolyData, posTarget, posDistal, cylinderRadius=2.5, radiusResolution=1.0):
+    """
+    RAS bounding box [lower, upper] (2,3) of the candidate cone of getCandidateCone, sampled with radiusResolution,
+    and of the entry of the ventricle axis, or None when the axis does not meet skullPolyData.
+    """
+    cone = self.getCandidateCone(skullPolyData, posTarget, posDistal, cylinderRadius)
+    if cone is None:
+      return None
+    posEntry, posCenter, entryRadius, basePoint, direction = cone
+    # extent of the disc along each axis, the outermost ring of getCandidateDiscGrid may be beyond entryRadius
+    outerRadius = max(entryRadius, numpy.arange(radiusResolution, entryRadius + radiusResolution, radiusResolution)[-1])
+    discExtent = outerRadius * numpy.sqrt(numpy.maximum(1.0 - direction * direction, 0.0))
+    points = numpy.array([posEntry, posCenter, basePoint - discExtent, basePoint + discExtent])
+    return numpy.array([points.min(axis=0), points.max(axis=0)])
+
+  def planCandidatePaths(self, skullPolyData, posNasion, posTarget, posDistal, posKocher, vesselPolyData=None, distanceField=None,
+                         cylinderRadius=2.5, posteriorMargin=60.0, kocherMargin=20.0, venousMargin=5.0, radiusResolution=1.0,
+                         phiResolution=numpy.pi/180.0, adaptiveSearch=False, coarseLevel=3, refinementBudget=3000):
+    """
+    Candidate paths from the center of the ventricle axis to entry points sampled around the axis beyond the skull,
+    tested for collisions against vesselPolyData or distanceField and for the skull entry conditions. With
+    adaptiveSearch the points are sampled by adaptiveCandidateEntryPoints, otherwise on the full grid of
+    generateCandidateEntryPoints. Returns a dict with the keys posEntry, entryRadius, entryPoints and candidatePaths,
+    one row per entry point, or None when the ventricle axis does not meet skullPolyData.
+    """
+    posNasion = numpy.array(posNasion, dtype=numpy.float64)
+    cone = self.getCandidateCone(skullPolyData, posTarget, posDistal, cylinderRadius)
+    if cone is None:
+      return None
+    posEntry, posCenter, entryRadius, basePoint, direction = cone
+    matrix = self.getAxisTransform(posTarget, posDistal).GetMatrix()
+    evaluate = lambda points: self.evaluateCandidateEntryPoints(posCenter, points, posKocher, posNasion, skullPolyData, posteriorMargin,
+                                                                kocherMargin, vesselPolyData, distanceField, venousMargin, direction)
+    if adaptiveSearch:
+      # only the boundary of the feasible region and the surrounding of the Kocher point are sampled at full resolution
+      entryPoints, candidatePaths = self.adaptiveCandidateEntryPoints(matrix, basePoint, entryRadius, radiusResolution, phiResolution, evaluate,
+                                                                      coarseLevel, refinementBudget, kocherMargin, firstPoint=posEntry)
+    else:
+      entryPoints = self.generateCandidateEntryPoints(matrix, basePoint, entryRadius, radiusResolution, phiResolution, firstPoint=posEntry)
+      candidatePaths = evaluate(entryPoints)
+    return {"posEntry": posEntry, "entryRadius": entryRadius, "entryPoints": entryPoints, "candidatePaths": candidatePaths}
+
+  def planTrajectory(self, skullPolyData, posNasion, posSagittal, posTarget, posDistal, sagittalReferenceLength, coronalReferenceLength,
+                     vesselPolyData=None, distanceField=None, cylinderRadius=2.5, posteriorMargin=60.0, kocherMargin=20.0,
+                     venousMargin=5.0, radiusResolution=1.0, phiResolution=numpy.pi/180.0, useGeodesic=False, adaptiveSearch=False):
+    """
+    Run the planning steps of the module on one case without the scene: true sagittal plane, reference curves and
+    Kocher point of the hemisphere of the ventricle, and the candidate paths of planCandidatePaths. Returns a dict
+    with the keys sagittalYawAngle, trueSagittalPlane, useLeftHemisphere, referenceCurves, posKocher, posEntry,
+    entryRadius, candidatePaths and bestPath (None when no candidate meets all the conditions).
+    """
+    posNasion, posTarget, posDistal = [numpy.array(pos, dtype=numpy.float64) for pos in (posNasion, posTarget, posDistal)]
+    sagittalYawAngle, trueSagittalPlane = self.getTrueSagittalPlane(posNasion, posSagittal)
+    useLeftHemisphere = self.isLeftHemisphere(trueSagittalPlane, posTarget, posDistal)
+    result = {"sagittalYawAngle": sagittalYawAngle, "trueSagittalPlane": trueSagittalPlane, "useLeftHemisphere": useLeftHemisphere,
+              "referenceCurves": None, "posKocher": None, "posEntry": None, "entryRadius": None,
+              "candidatePaths": numpy.zeros(0, dtype=self.candidatePathDtype), "bestPath": None}
+    curves = self.computeReferenceCurves(skullPolyData, posNasion, trueSagittalPlane, sagittalYawAngle, sagittalReferenceLength,
+                                         coronalReferenceLength, useGeodesic)
+    if not useLeftHemisphere in curves:
+      return result
+    result["referenceCurves"] = curves[useLeftHemisphere]
+    posKocher = curves[useLeftHemisphere][2][-1]
+    result["posKocher"] = posKocher
+    candidates = self.planCandidatePaths(skullPolyData, posNasion, posTarget, posDistal, posKocher, vesselPolyData, distanceField,
+                                         cylinderRadius, posteriorMargin, kocherMargin, venousMargin, radiusResolution, phiResolution,
+                                         adaptiveSearch)
+    if candidates is None:
+      return result
+    result["posEntry"], result["entryRadius"] = candidates["posEntry"], candidates["entryRadius"]
+    result["candidatePaths"] = candidates["candidatePaths"]
+    bestPaths = self.getTopCandidatePaths(candidates["candidatePaths"], 1, "distanceToKocher")
+    if len(bestPaths):
+      result["bestPath"] = bestPaths[0]
+    return result
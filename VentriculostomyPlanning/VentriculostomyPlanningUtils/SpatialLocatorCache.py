@@ -0,0 +1,49 @@
+import vtk
+from VentriculostomyPlanningUtils.LRUCache import LRUCache
+
+class SpatialLocatorCache(LRUCache):
+  """
+  Registry of prebuilt spatial search structures (locators, triangle arrays) of polydata.
+  Entries are keyed on the polydata identity and are rebuilt when GetMTime() changes, the least recently
+  used entry is evicted once more than maximumNumberOfEntries are stored.
+  """
+
+  def __init__(self, maximumNumberOfEntries=12):
+    super(SpatialLocatorCache, self).__init__(maximumNumberOfEntries)
+
+  def getCellLocator(self, polyData):
+    return self.get(polyData, "vtkCellLocator", self.buildCellLocator)
+
+  def getOBBTree(self, polyData):
+    return self.get(polyData, "vtkOBBTree", self.buildOBBTree)
+
+  def getPointLocator(self, polyData):
+    return self.get(polyData, "vtkKdTreePointLocator", self.buildPointLocator)
+
+  def get(self, polyData, kind, builder):
+    # the polydata is referenced by its entry, so its address can not be reused by another object while cached
+    stateKey = (polyData.GetAddressAsString("vtkPolyData"), polyData.GetMTime())
+    key = stateKey + (kind,)
+    entry = self.lookup(key)
+    if entry is None:
+      self.removeStaleEntries(stateKey)
+      entry = self.store(key, (polyData, builder(polyData)))
+    return entry[1]
+
+  def buildCellLocator(self, polyData):
+    locator = vtk.vtkCellLocator()
+    locator.SetDataSet(polyData)
+    locator.BuildLocator()
+    return locator
+
+  def buildPointLocator(self, polyData):
+    pointLocator = vtk.vtkKdTreePointLocator()
+    pointLocator.SetDataSet(polyData)
+    pointLocator.BuildLocator()
+    return pointLocator
+
+  def buildOBBTree(self, polyData):
+    obbTree = vtk.vtkOBBTree()
+    obbTree.SetDataSet(polyData)
+    obbTree.BuildLocator()
+    return obbTree
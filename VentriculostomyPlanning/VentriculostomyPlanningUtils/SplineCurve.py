@@ -0,0 +1,208 @@
+import vtk, slicer
+import numpy
+from contextlib import contextmanager
+from vtk.util import numpy_support
+
+class SplineCurveLogic(object):
+  """
+  Tube model interpolating the fiducials of a markups node, replaces the CurveMaker logic used by CurveManager
+  and keeps its attribute names (SourceNode, DestinationNode, CurvePoly, CurveLength, ModelColor).
+  The curve is a cubic Hermite spline: linear (0), Catmull-Rom (1) or Kochanek-Bartels (2) with the tension,
+  bias and continuity attributes. Each segment between two fiducials is tessellated and measured separately,
+  so moving one fiducial only re-evaluates the (up to four) segments it influences.
+  """
+
+  InterpolationLinear = 0
+  InterpolationCatmullRom = 1
+  InterpolationKochanek = 2
+
+  def __init__(self):
+    self.SourceNode = None
+    self.DestinationNode = None
+    self.CurvePoly = vtk.vtkPolyData()
+    self.CurveLength = 0.0
+    self.ModelColor = [0.0, 0.0, 1.0]
+    self.interpolationMethod = self.InterpolationLinear
+    self.tension = 0.0
+    self.bias = 0.0
+    self.continuity = 0.0
+    self.numberOfSegmentSamples = 20
+    self.tubeRadius = 5.0
+    self.tubeFilter = vtk.vtkTubeFilter()
+    self.tubeFilter.SetNumberOfSides(20)
+    self.tubeFilter.CappingOn()
+    self.automaticUpdate = False
+    self.observedNode = None
+    self.observerTag = None
+    # updateCurve calls made inside batchUpdate are deferred to its end
+    self.batchDepth = 0
+    self.pendingUpdate = False
+    # per segment tessellation and length, valid for controlPoints of cachedSourceNode
+    self.cachedSourceNode = None
+    self.controlPoints = numpy.zeros((0, 3))
+    self.segmentSamples = numpy.zeros((0, self.numberOfSegmentSamples, 3))
+    self.segmentLengths = numpy.zeros(0)
+    gaussNodes, gaussWeights = numpy.polynomial.legendre.leggauss(5)
+    self.quadratureNodes = (gaussNodes + 1.0) / 2.0
+    self.quadratureWeights = gaussWeights / 2.0
+
+  def enableAutomaticUpdate(self, auto):
+    if self.observedNode and self.observerTag:
+      self.observedNode.RemoveObserver(self.observerTag)
+    self.observedNode = None
+    self.observerTag = None
+    self.automaticUpdate = bool(auto)
+    if self.automaticUpdate and self.SourceNode:
+      self.observedNode = self.SourceNode
+      self.observerTag = self.SourceNode.AddObserver('ModifiedEvent', self.onSourceModified)
+      self.updateCurve()
+
+  def onSourceModified(self, caller=None, event=None):
+    self.updateCurve()
+
+  @contextmanager
+  def batchUpdate(self):
+    """
+    Group the settings and source changes done in the with block, the curve is rebuilt at most once at its end,
+    e.g. when the source, the interpolation method and the tube radius of a new curve are all set.
+    """
+    self.batchDepth += 1
+    try:
+      yield
+    finally:
+      self.batchDepth -= 1
+      if self.batchDepth == 0 and self.pendingUpdate:
+        self.pendingUpdate = False
+        self.updateCurve()
+
+  def setInterpolationMethod(self, method):
+    if method != self.interpolationMethod:
+      self.interpolationMethod = method
+      self.invalidate()
+    self.updateCurve()
+
+  def setKochanekParameters(self, tension, bias, continuity):
+    self.tension, self.bias, self.continuity = tension, bias, continuity
+    if self.interpolationMethod == self.InterpolationKochanek:
+      self.invalidate()
+    self.updateCurve()
+
+  def setTubeRadius(self, radius):
+    self.tubeRadius = radius
+    self.updateCurve()
+
+  def invalidate(self):
+    self.controlPoints = numpy.zeros((0, 3))
+
+  def getControlPoints(self):
+    if not self.SourceNode:
+      return numpy.zeros((0, 3))
+    numberOfPoints = self.SourceNode.GetNumberOfFiducials()
+    controlPoints = numpy.zeros((numberOfPoints, 3))
+    for index in range(numberOfPoints):
+      self.SourceNode.GetNthFiducialPosition(index, controlPoints[index])
+    return controlPoints
+
+  def getTangents(self, paddedPoints, segmentIndices):
+    """
+    Outgoing tangent at the start and incoming tangent at the end of the segments, paddedPoints has the
+    reflected end points prepended and appended so that segment i runs from paddedPoints[i+1] to paddedPoints[i+2].
+    """
+    previous = paddedPoints[segmentIndices]
+    start = paddedPoints[segmentIndices + 1]
+    end = paddedPoints[segmentIndices + 2]
+    following = paddedPoints[segmentIndices + 3]
+    if self.interpolationMethod == self.InterpolationLinear:
+      return end - start, end - start
+    tension, bias, continuity = 0.0, 0.0, 0.0
+    if self.interpolationMethod == self.InterpolationKochanek:
+      tension, bias, continuity = self.tension, self.bias, self.continuity
+    startTangent = ((1 - tension) * (1 + bias) * (1 + continuity) / 2.0) * (start - previous) \
+                   + ((1 - tension) * (1 - bias) * (1 - continuity) / 2.0) * (end - start)
+    endTangent = ((1 - tension) * (1 + bias) * (1 - continuity) / 2.0) * (end - start) \
+                 + ((1 - tension) * (1 - bias) * (1 + continuity) / 2.0) * (following - end)
+    return startTangent, endTangent
+
+  def evaluateSegments(self, controlPoints, segmentIndices):
+    """
+    Return the samples (S,numberOfSegmentSamples,3), excluding the end point, and the arc lengths (S,) of the
+    segments, the lengths are integrated from the spline derivative with a 5 point Gauss-Legendre rule.
+    """
+    paddedPoints = numpy.vstack((2 * controlPoints[0] - controlPoints[1], controlPoints,
+                                 2 * controlPoints[-1] - controlPoints[-2]))
+    start = paddedPoints[segmentIndices + 1]
+    end = paddedPoints[segmentIndices + 2]
+    startTangent, endTangent = self.getTangents(paddedPoints, segmentIndices)
+    coefficients = numpy.stack((start, startTangent, end, endTangent), axis=1)
+    s = numpy.arange(self.numberOfSegmentSamples) / float(self.numberOfSegmentSamples)
+    basis = numpy.stack((2 * s**3 - 3 * s**2 + 1, s**3 - 2 * s**2 + s, -2 * s**3 + 3 * s**2, s**3 - s**2), axis=1)
+    samples = numpy.einsum('nb,sbk->snk', basis, coefficients)
+    q = self.quadratureNodes
+    derivativeBasis = numpy.stack((6 * q**2 - 6 * q, 3 * q**2 - 4 * q + 1, -6 * q**2 + 6 * q, 3 * q**2 - 2 * q), axis=1)
+    speed = numpy.linalg.norm(numpy.einsum('nb,sbk->snk', derivativeBasis, coefficients), axis=2)
+    return samples, speed.dot(self.quadratureWeights)
+
+  def updateSegments(self, controlPoints):
+    numberOfSegments = len(controlPoints) - 1
+    if len(controlPoints) == len(self.controlPoints):
+      changed = numpy.nonzero(numpy.any(controlPoints != self.controlPoints, axis=1))[0]
+      # segment i depends on the control points i-1 to i+2
+      affected = numpy.unique(numpy.clip((changed[:, numpy.newaxis] + numpy.arange(-2, 2)).ravel(), 0, numberOfSegments - 1))
+    else:
+      affected = numpy.arange(numberOfSegments)
+      self.segmentSamples = numpy.zeros((numberOfSegments, self.numberOfSegmentSamples, 3))
+      self.segmentLengths = numpy.zeros(numberOfSegments)
+    if len(affected):
+      self.segmentSamples[affected], self.segmentLengths[affected] = self.evaluateSegments(controlPoints, affected)
+    self.controlPoints = controlPoints
+    return len(affected) > 0
+
+  def getCurveLength(self):
+    # arc length of the current fiducials, the tube model is not touched
+    controlPoints = self.getControlPoints()
+    if len(controlPoints) < 2:
+      return 0.0
+    if self.SourceNode == self.cachedSourceNode and numpy.array_equal(controlPoints, self.controlPoints):
+      return float(self.segmentLengths.sum())
+    return float(self.evaluateSegments(controlPoints, numpy.arange(len(controlPoints) - 1))[1].sum())
+
+  def updateCurve(self):
+    if self.batchDepth:
+      self.pendingUpdate = True
+      return
+    if not (self.SourceNode and self.DestinationNode):
+      return
+    if self.SourceNode != self.cachedSourceNode:
+      self.invalidate()
+      self.cachedSourceNode = self.SourceNode
+    controlPoints = self.getControlPoints()
+    if len(controlPoints) < 2:
+      self.invalidate()
+      self.CurveLength = 0.0
+      self.CurvePoly.Initialize()
+    else:
+      if (not self.updateSegments(controlPoints)) and self.CurvePoly.GetNumberOfPoints() \
+          and self.tubeFilter.GetRadius() == self.tubeRadius and self.DestinationNode.GetPolyData() == self.tubeFilter.GetOutput():
+        return
+      self.CurveLength = float(self.segmentLengths.sum())
+      centerline = numpy.ascontiguousarray(numpy.vstack((self.segmentSamples.reshape(-1, 3), controlPoints[-1:])))
+      points = vtk.vtkPoints()
+      points.SetData(numpy_support.numpy_to_vtk(centerline, deep=True))
+      connectivity = numpy.arange(-1, len(centerline), dtype=numpy_support.ID_TYPE_CODE)
+      connectivity[0] = len(centerline)
+      lines = vtk.vtkCellArray()
+      lines.SetCells(1, numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=True))
+      self.CurvePoly.Initialize()
+      self.CurvePoly.SetPoints(points)
+      self.CurvePoly.SetLines(lines)
+    self.tubeFilter.SetInputData(self.CurvePoly)
+    self.tubeFilter.SetRadius(self.tubeRadius)
+    self.tubeFilter.Update()
+    if self.DestinationNode.GetPolyData() != self.tubeFilter.GetOutput():
+      self.DestinationNode.SetAndObservePolyData(self.tubeFilter.GetOutput())
+    if not self.DestinationNode.GetDisplayNode():
+      modelDisplayNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelDisplayNode")
+      modelDisplayNode.SetColor(self.ModelColor)
+      slicer.mrmlScene.AddNode(modelDisplayNode)
+      self.DestinationNode.SetAndObserveDisplayNodeID(modelDisplayNode.GetID())
+    self.DestinationNode.Modified()
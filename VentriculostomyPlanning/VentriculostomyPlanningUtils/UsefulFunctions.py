@@ -2,12 +2,31 @@ import vtk, qt, ctk, slicer
 import numpy
 import SimpleITK as sitk
 import sitkUtils
+from vtk.util import numpy_support
 import math
+import itertools
+import os
+import sys
+try:
+  import resource
+except ImportError:
+  resource = None
+from VentriculostomyPlanningUtils.PlanningEngine import PlanningEngine
+from VentriculostomyPlanningUtils.ImagePyramidCache import ImagePyramidCache
+from VentriculostomyPlanningUtils.VolumeAccessCache import VolumeAccessCache
 
 class UsefulFunctions(object):
 
-  def __init__(self):
-    pass
+  def __init__(self, engine=None):
+    # the scene independent planning core, shared with the logic
+    self.engine = engine if engine is not None else PlanningEngine()
+    self.volumeAccess = VolumeAccessCache()
+    self.imagePyramid = ImagePyramidCache(self.volumeAccess)
+    # (stage, size of the stage image, resident memory of the process at the start, at the peak and at the end of the
+    # stage) of the last skull morphology, in bytes. See recordMorphologyStage for the peak
+    self.morphologyMemoryReport = []
+    self.morphologyStageStartBytes = None
+    self.morphologyPeakPerStage = False
 
   def clipVolumeWithModelNode(self, inputVolume, clippingModelNode, clipOutsideSurface, fillValue):
     """
@@ -89,14 +108,7 @@ class UsefulFunctions(object):
     
     holeFillKernelSize = morphologyParameters[0]
     maskKernelSize = morphologyParameters[1]
-    resampleFilter = sitk.ResampleImageFilter()
-    ventricleImage = sitk.Cast(sitkUtils.PullFromSlicer(ventricleVolume.GetID()), sitk.sitkInt16)
-    
-    resampleFilter.SetSize(numpy.array(ventricleImage.GetSize()) / samplingFactor)
-    resampleFilter.SetOutputSpacing(numpy.array(ventricleImage.GetSpacing()) * samplingFactor)
-    resampleFilter.SetOutputDirection(ventricleImage.GetDirection())
-    resampleFilter.SetOutputOrigin(numpy.array(ventricleImage.GetOrigin()))
-    resampledImage = resampleFilter.Execute(ventricleImage)
+    resampledImage = self.imagePyramid.getImage(ventricleVolume, samplingFactor, antiAlias=False)
     thresholdFilter = sitk.BinaryThresholdImageFilter()
     thresholdImage = thresholdFilter.Execute(resampledImage, thresholdValue, 10000, 1, 0)
 
@@ -131,20 +143,42 @@ class UsefulFunctions(object):
     return holefilledImageNode, subtractedImageNode
 
 
-  def createHoleFilledVolumeNode2(self, ventricleVolume, thresholdValue, samplingFactor, morphologyParameters):
+  def createHoleFilledVolumeNode2(self, ventricleVolume, thresholdValue, samplingFactor, morphologyParameters, restrictToHead=False):
+    """
+    With restrictToHead, the morphology only runs inside the bounding box of the thresholded head, enlarged by the
+    kernel sizes, and the results are pasted into images of the full geometry. The memory used by each stage is
+    kept in morphologyMemoryReport.
+    """
     maskKernelSize = morphologyParameters[1]
+    self.startMorphologyReport()
 
     ## Convert to binary image by threshold
-    resampleFilter = sitk.ResampleImageFilter()
-    ventricleImage = sitk.Cast(sitkUtils.PullFromSlicer(ventricleVolume.GetID()), sitk.sitkInt16)
-    resampleFilter.SetSize(numpy.array(ventricleImage.GetSize()) / samplingFactor)
-    resampleFilter.SetOutputSpacing(numpy.array(ventricleImage.GetSpacing()) * samplingFactor)
-    resampleFilter.SetOutputDirection(ventricleImage.GetDirection())
-    resampleFilter.SetOutputOrigin(numpy.array(ventricleImage.GetOrigin()))
-    resampledImage = resampleFilter.Execute(ventricleImage)
+    resampledImage = self.imagePyramid.getImage(ventricleVolume, samplingFactor, antiAlias=False)
+    self.recordMorphologyStage("resample", resampledImage)
     thresholdFilter = sitk.BinaryThresholdImageFilter()
     thresholdImage = thresholdFilter.Execute(resampledImage, thresholdValue, 10000, 1, 0)
-    
+    self.recordMorphologyStage("threshold", thresholdImage)
+
+    if restrictToHead:
+      # the margin keeps the closing (radius 1) and the mask dilation within the crop
+      headIndex, headSize = self.getHeadBoundingBox(thresholdImage, numpy.array(maskKernelSize) + 2)
+      croppedImage = sitk.RegionOfInterest(thresholdImage, headSize, headIndex)
+      self.recordMorphologyStage("crop", croppedImage)
+      holefilledImage, subtractedImage = self.fillSkullHoles(croppedImage, maskKernelSize)
+      holefilledImage = self.pasteIntoPaddedImage(holefilledImage, thresholdImage, headIndex)
+      subtractedImage = self.pasteIntoPaddedImage(subtractedImage, thresholdImage, headIndex)
+      self.recordMorphologyStage("paste", subtractedImage)
+    else:
+      holefilledImage, subtractedImage = self.fillSkullHoles(thresholdImage, maskKernelSize)
+    holefilledImageNode = sitkUtils.PushToSlicer(holefilledImage, "holefilledImage", 0, False)
+    subtractedImageNode = sitkUtils.PushToSlicer(subtractedImage, "subtractedImage", 0, False)
+    return holefilledImageNode, subtractedImageNode
+
+  def fillSkullHoles(self, thresholdImage, maskKernelSize):
+    """
+    Morphology of createHoleFilledVolumeNode2 on a binary image: the holes of the top and bottom slices and of the
+    closed volume are filled, the mask is the dilation minus the filled volume. The outputs are padded by one voxel.
+    """
     ## Close the holes at top and bottom slices
     inputSize = list(thresholdImage.GetSize())
     extractFilter = sitk.ExtractImageFilter()
@@ -171,37 +205,182 @@ class UsefulFunctions(object):
     bottomVolumeFillHole = sitk.JoinSeries(bottomSliceFillHole)
     pasteFilter.SetDestinationIndex([0, 0, inputSize[2]-1])
     topBottomClosedThresholdImage = pasteFilter.Execute(topClosedThresholdImage, bottomVolumeFillHole)
+    self.recordMorphologyStage("sliceFillHole", topBottomClosedThresholdImage)
 
     ## Padding
     padFilter = sitk.ConstantPadImageFilter()
     padFilter.SetPadLowerBound([1,1,1])
     padFilter.SetPadUpperBound([1,1,1])
     paddedImage = padFilter.Execute(topBottomClosedThresholdImage)
+    self.recordMorphologyStage("pad", paddedImage)
     
     ## Close
     closingFilter = sitk.BinaryMorphologicalClosingImageFilter()
     closingFilter.SetForegroundValue(1)
     closingFilter.SafeBorderOn()
     closedImage = closingFilter.Execute(paddedImage)
+    self.recordMorphologyStage("close", closedImage)
 
     ## Fill the holes in 3D
     fillHoleFilter = sitk.BinaryFillholeImageFilter()
     holefilledImage = fillHoleFilter.Execute(closedImage)
+    self.recordMorphologyStage("fillHole", holefilledImage)
     
     dilateFilter = sitk.BinaryDilateImageFilter()
     dilateFilter.SetKernelRadius(maskKernelSize)
     dilateFilter.SetBackgroundValue(0)
     dilateFilter.SetForegroundValue(1)
     dilatedImage = dilateFilter.Execute(holefilledImage)
+    self.recordMorphologyStage("dilate", dilatedImage)
     
     subtractFilter = sitk.SubtractImageFilter()
     subtractedImage = subtractFilter.Execute(dilatedImage, holefilledImage)
-    holefilledImageNode = sitkUtils.PushToSlicer(holefilledImage, "holefilledImage", 0, False)
-    subtractedImageNode = sitkUtils.PushToSlicer(subtractedImage, "subtractedImage", 0, False)
-    return holefilledImageNode, subtractedImageNode
+    self.recordMorphologyStage("subtract", subtractedImage)
+    return holefilledImage, subtractedImage
+
+  def getHeadBoundingBox(self, thresholdImage, margin):
+    """
+    Index and size of the bounding box of the foreground of thresholdImage, enlarged by margin voxels (per axis) and
+    clipped to the image. The box comes from the projections of the mask on the three axes.
+    """
+    mask = self.volumeAccess.getArray(thresholdImage)
+    imageSize = numpy.array(thresholdImage.GetSize())
+    lower, upper = numpy.zeros(3, dtype=int), imageSize - 1
+    # the array is indexed [k, j, i]
+    for axis, projectionAxes in enumerate([(0, 1), (0, 2), (1, 2)]):
+      indices = numpy.nonzero(mask.any(axis=projectionAxes))[0]
+      if not len(indices):
+        return [0, 0, 0], [int(size) for size in imageSize]
+      lower[axis], upper[axis] = indices[0], indices[-1]
+    lower = numpy.maximum(lower - margin, 0)
+    upper = numpy.minimum(upper + margin, imageSize - 1)
+    return [int(index) for index in lower], [int(size) for size in upper - lower + 1]
+
+  def pasteIntoPaddedImage(self, croppedImage, fullImage, index):
+    """
+    Place croppedImage, a result of fillSkullHoles on the crop of fullImage at index, into an image of the geometry of
+    fullImage padded by one voxel. The result is the zero padding of croppedImage, allocated once by ConstantPad.
+    """
+    # croppedImage is already padded by one voxel, so it starts at index in the padded geometry
+    paddedSize = numpy.array(fullImage.GetSize()) + 2
+    upperBound = paddedSize - numpy.array(index) - numpy.array(croppedImage.GetSize())
+    return sitk.ConstantPad(croppedImage, [int(bound) for bound in index], [int(bound) for bound in upperBound], 0)
 
+  def getNarrowBandDistanceMap(self, labelImage, distanceMapFilter, bandWidth, bounds=None, blockSize=64):
+    """
+    Signed distance map of the foreground of labelImage within bandWidth (in the units of the filter) of it. The box
+    of the band, the bounding box of the foreground grown by bandWidth and one voxel, is split in blocks of blockSize
+    voxels and only the blocks with foreground within that margin are computed, each with distanceMapFilter on the
+    block grown by the margin, which is zero padded beyond labelImage. bounds, the RAS [lower, upper] corners of the
+    region of interest such as the box of the candidate cone, also restricts the box. The map covers the box and is
+    clamped to bandWidth plus one voxel, the value of the blocks which are not computed, so that the contour at
+    bandWidth is closed.
+    """
+    mask = self.volumeAccess.getArray(labelImage) != 0
+    if not mask.any():
+      return distanceMapFilter.Execute(labelImage)
+    spacing = numpy.array(labelImage.GetSpacing()) if distanceMapFilter.GetUseImageSpacing() else numpy.ones(3)
+    limit = bandWidth + spacing.max()
+    outsideValue = -limit if distanceMapFilter.GetInsideIsPositive() else limit
+    # the arrays are indexed [k, j, i], the margin and the box follow them
+    margin = (numpy.ceil(bandWidth / spacing).astype(int) + 1)[::-1]
+    shape = numpy.array(mask.shape)
+    lower, upper = numpy.zeros(3, dtype=int), numpy.zeros(3, dtype=int)
+    for axis, projectionAxes in enumerate([(1, 2), (0, 2), (0, 1)]):
+      indices = numpy.nonzero(mask.any(axis=projectionAxes))[0]
+      lower[axis], upper[axis] = indices[0] - margin[axis], indices[-1] + margin[axis] + 1
+    if bounds is not None:
+      # RAS corners of the region to continuous LPS indices
+      corners = numpy.array([[x, y, z] for x in bounds[:, 0] for y in bounds[:, 1] for z in bounds[:, 2]]) * [-1.0, -1.0, 1.0]
+      indices = numpy.array([labelImage.TransformPhysicalPointToContinuousIndex(corner) for corner in corners.tolist()])[:, ::-1]
+      lower = numpy.maximum(lower, numpy.floor(indices.min(axis=0)).astype(int))
+      upper = numpy.minimum(upper, numpy.ceil(indices.max(axis=0)).astype(int) + 1)
+    upper = numpy.maximum(upper, lower + 1)
+    distanceArray = numpy.full(upper - lower, outsideValue, dtype=numpy.float32)
+    for blockLower in itertools.product(*[range(lower[axis], upper[axis], blockSize) for axis in range(3)]):
+      blockLower = numpy.array(blockLower)
+      blockUpper = numpy.minimum(blockLower + blockSize, upper)
+      haloLower, haloUpper = blockLower - margin, blockUpper + margin
+      # the part of the halo inside of labelImage, the rest is padding
+      cropLower, cropUpper = numpy.maximum(haloLower, 0), numpy.minimum(haloUpper, shape)
+      if (cropUpper <= cropLower).any():
+        continue
+      haloMask = mask[tuple(slice(first, last) for first, last in zip(cropLower, cropUpper))]
+      if not haloMask.any():
+        continue
+      target = tuple(slice(first - origin, last - origin) for first, last, origin in zip(blockLower, blockUpper, lower))
+      isPadded = (cropLower > haloLower).any() or (cropUpper < haloUpper).any()
+      if haloMask.all() and not isPadded:
+        distanceArray[target] = -outsideValue
+        continue
+      haloImage = sitk.RegionOfInterest(labelImage, [int(size) for size in (cropUpper - cropLower)[::-1]], [int(index) for index in cropLower[::-1]])
+      if isPadded:
+        haloImage = sitk.ConstantPad(haloImage, [int(bound) for bound in (cropLower - haloLower)[::-1]],
+                                     [int(bound) for bound in (haloUpper - cropUpper)[::-1]], 0)
+      haloDistanceImage = distanceMapFilter.Execute(haloImage)
+      haloDistance = self.volumeAccess.getArray(haloDistanceImage)
+      core = tuple(slice(first - origin, last - origin) for first, last, origin in zip(blockLower, blockUpper, haloLower))
+      distanceArray[target] = numpy.clip(haloDistance[core], -limit, limit)
+    distanceImage = sitk.GetImageFromArray(distanceArray)
+    distanceImage.SetSpacing(labelImage.GetSpacing())
+    distanceImage.SetDirection(labelImage.GetDirection())
+    # the box can start beyond labelImage, where TransformIndexToPhysicalPoint does not apply
+    direction = numpy.array(labelImage.GetDirection()).reshape(3, 3)
+    origin = numpy.array(labelImage.GetOrigin()) + direction.dot(numpy.array(labelImage.GetSpacing()) * lower[::-1])
+    distanceImage.SetOrigin([float(value) for value in origin])
+    return distanceImage
+
+  def getResidentBytes(self):
+    # current resident memory of the process, only known where /proc is available
+    try:
+      with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+      return None
+
+  def getPeakResidentBytes(self):
+    # high water mark of the resident memory since the last resetPeakResidentBytes, or since the start of the process
+    try:
+      with open("/proc/self/status") as status:
+        for line in status:
+          if line.startswith("VmHWM:"):
+            return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+      pass
+    if resource:
+      # ru_maxrss is in kilobytes, in bytes on macOS
+      maximumResident = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+      return maximumResident if sys.platform == "darwin" else maximumResident * 1024
+    return None
+
+  def resetPeakResidentBytes(self):
+    # the high water mark can only be reset on Linux 4.0 and later
+    try:
+      with open("/proc/self/clear_refs", "w") as clearRefs:
+        clearRefs.write("5")
+      return True
+    except (IOError, OSError):
+      return False
+
+  def startMorphologyReport(self):
+    self.morphologyMemoryReport = []
+    self.morphologyStageStartBytes = self.getResidentBytes()
+    self.morphologyPeakPerStage = self.resetPeakResidentBytes()
+
+  def recordMorphologyStage(self, stage, image):
+    """
+    A stage starts where the previous one was recorded. Its peak is the high water mark of the resident memory since
+    then when it can be reset (morphologyPeakPerStage), otherwise the high water mark of the process, which is the
+    peak of the stage only when the stage raised it.
+    """
+    imageBytes = int(numpy.prod(image.GetSize())) * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+    peakBytes = self.getPeakResidentBytes()
+    endBytes = self.getResidentBytes()
+    self.morphologyMemoryReport.append((stage, imageBytes, self.morphologyStageStartBytes, peakBytes, endBytes))
+    self.morphologyStageStartBytes = endBytes
+    if self.morphologyPeakPerStage:
+      self.resetPeakResidentBytes()
 
-  
   def createModelBaseOnVolume(self, holefilledImageNode, outputModelNode):
     if holefilledImageNode:
       holefilledImageData = holefilledImageNode.GetImageData()
@@ -311,6 +490,67 @@ class UsefulFunctions(object):
       slicer.mrmlScene.RemoveNode(labelVolumeNode)
     pass
 
+  def createIsoSurfaceModel(self, image, isoValue, outputModelNode, decimation=0.25):
+    """
+    Contour the SimpleITK image at isoValue straight from its voxel array and set the surface, in RAS, as the poly data
+    of outputModelNode. No volume node or CLI module is involved. Flying edges is used when VTK provides it (multithreaded),
+    marching cubes otherwise. decimation is the target reduction of the number of triangles, 0 keeps all of them.
+    """
+    # the array only has to live until the contour is updated below, the surface does not reference it
+    voxelArray = numpy.ascontiguousarray(self.volumeAccess.getArray(image))
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(image.GetSize())
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxelArray.ravel(), deep=False))
+    lpsToRAS = numpy.diag([-1.0, -1.0, 1.0])
+    indexToRAS = lpsToRAS.dot(numpy.array(image.GetDirection()).reshape(3, 3)).dot(numpy.diag(image.GetSpacing()))
+    originRAS = lpsToRAS.dot(numpy.array(image.GetOrigin()))
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(3):
+      for column in range(3):
+        matrix.SetElement(row, column, indexToRAS[row, column])
+      matrix.SetElement(row, 3, originRAS[row])
+    transformIJKtoRAS = vtk.vtkTransform()
+    transformIJKtoRAS.SetMatrix(matrix)
+
+    cubes = vtk.vtkFlyingEdges3D() if hasattr(vtk, "vtkFlyingEdges3D") else vtk.vtkMarchingCubes()
+    cubes.SetInputData(imageData)
+    cubes.SetValue(0, isoValue)
+    cubes.ComputeNormalsOff()
+    cubes.ComputeGradientsOff()
+    cubes.ComputeScalarsOff()
+    cubes.Update()
+    surfacePort = cubes.GetOutputPort()
+
+    if decimation > 0:
+      decimator = vtk.vtkDecimatePro()
+      decimator.SetInputConnection(surfacePort)
+      decimator.SetFeatureAngle(60)
+      decimator.SplittingOff()
+      decimator.PreserveTopologyOn()
+      decimator.SetMaximumError(1)
+      decimator.SetTargetReduction(decimation)
+      surfacePort = decimator.GetOutputPort()
+
+    if matrix.Determinant() < 0:
+      reverser = vtk.vtkReverseSense()
+      reverser.SetInputConnection(surfacePort)
+      reverser.ReverseNormalsOn()
+      surfacePort = reverser.GetOutputPort()
+
+    transformer = vtk.vtkTransformPolyDataFilter()
+    transformer.SetInputConnection(surfacePort)
+    transformer.SetTransform(transformIJKtoRAS)
+
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(transformer.GetOutputPort())
+    normals.SetFeatureAngle(60)
+    normals.SetSplitting(True)
+    normals.Update()
+
+    outputModel = normals.GetOutput()
+    outputModelNode.SetAndObservePolyData(outputModel)
+    return outputModel
+
   def getClosedCuttedModel(self, cutPlanes, polyData):
     clipper = vtk.vtkClipClosedSurface()
     clipper.SetClippingPlanes(cutPlanes)
@@ -320,28 +560,9 @@ class UsefulFunctions(object):
     cuttedPolyData = clipper.GetOutput()
     return cuttedPolyData
 
-  def sortVTKPoints(self, inputPointVector, referencePoint):
-    minDistanceIndex = 0
-    minDistance = 1e10
-    for iPos in range(inputPointVector.GetNumberOfPoints()):
-      currentPos = numpy.array(inputPointVector.GetPoint(iPos))
-      minDistance = numpy.linalg.norm(currentPos-referencePoint)
-      minDistanceIndex = iPos
-      for jPos in range(iPos, inputPointVector.GetNumberOfPoints()):
-        posModelPost = numpy.array(inputPointVector.GetPoint(jPos))
-        distanceModelPostNasion = numpy.linalg.norm(posModelPost-referencePoint)
-        if distanceModelPostNasion <  minDistance:
-          minDistanceIndex = jPos
-          minDistance = distanceModelPostNasion
-      inputPointVector.SetPoint(iPos,inputPointVector.GetPoint(minDistanceIndex))
-      inputPointVector.SetPoint(minDistanceIndex,currentPos)
-    pass
-
   def calculateLineModelIntersect(self, polyData, posFirst, posSecond, intersectionNode=None):
     if polyData:
-      obbTree = vtk.vtkOBBTree()
-      obbTree.SetDataSet(polyData)
-      obbTree.BuildLocator()
+      obbTree = self.engine.locatorCache.getOBBTree(polyData)
       pointsVTKintersection = vtk.vtkPoints()
       hasIntersection = obbTree.IntersectWithLine(posFirst, posSecond, pointsVTKintersection, None)
       if hasIntersection > 0:
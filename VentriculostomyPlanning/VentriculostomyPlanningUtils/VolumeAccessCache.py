@@ -0,0 +1,57 @@
+import SimpleITK as sitk
+import sitkUtils
+import slicer
+from vtk.util import numpy_support
+from VentriculostomyPlanningUtils.LRUCache import LRUCache, getImageBytes
+
+class VolumeAccessCache(LRUCache):
+  """
+  Voxel access to volume nodes without repeated copies. getArray returns a NumPy view of the image data of the node,
+  or of a SimpleITK image, getImage a SimpleITK image which is pulled from the scene once and then shared.
+  Images are keyed on the node ID and the modification time and geometry of its image data: as soon as the node is
+  modified the next request pulls it again and drops the images of its former state. The least recently used images
+  are evicted once they take more than maximumNumberOfBytes.
+  """
+
+  def __init__(self, maximumNumberOfBytes=512 * 1024 * 1024):
+    super(VolumeAccessCache, self).__init__(maximumNumberOfBytes)
+
+  def getVolumeKey(self, volumeNode):
+    imageData = volumeNode.GetImageData()
+    return (volumeNode.GetID(), imageData.GetMTime() if imageData else 0, tuple(volumeNode.GetOrigin()), tuple(volumeNode.GetSpacing()))
+
+  def getArray(self, volume):
+    """
+    Return the voxels of a volume node or of a SimpleITK image as a NumPy array indexed [k, j, i] without copying them.
+    The array of a node shares the memory of its image data, writing to it modifies the node, which has to be notified
+    with Modified(). The array of an image is read-only, it is a copy when SimpleITK has no GetArrayViewFromImage.
+    """
+    if isinstance(volume, sitk.Image):
+      if hasattr(sitk, "GetArrayViewFromImage"):
+        return sitk.GetArrayViewFromImage(volume)
+      array = sitk.GetArrayFromImage(volume)
+      array.flags.writeable = False
+      return array
+    if hasattr(slicer.util, "arrayFromVolume"):
+      return slicer.util.arrayFromVolume(volume)
+    imageData = volume.GetImageData()
+    shape = list(imageData.GetDimensions())[::-1]
+    if imageData.GetNumberOfScalarComponents() > 1:
+      shape.append(imageData.GetNumberOfScalarComponents())
+    return numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(shape)
+
+  def getImage(self, volumeNode, pixelType=None):
+    """
+    Return volumeNode as a SimpleITK image, cast to pixelType if given. The image is shared by all callers and must
+    not be modified.
+    """
+    volumeKey = self.getVolumeKey(volumeNode)
+    key = volumeKey + (pixelType,)
+    image = self.lookup(key)
+    if image is not None:
+      return image
+    self.removeStaleEntries(volumeKey)
+    image = sitkUtils.PullFromSlicer(volumeNode.GetID())
+    if pixelType is not None and image.GetPixelID() != pixelType:
+      image = sitk.Cast(image, pixelType)
+    return self.store(key, image, getImageBytes(image))